@@ -1,22 +1,42 @@
+import array
 from datetime import timezone
+import functools
 import json
 import math
 import re
+import struct
+import sys
 import time
 
 from fastapi import Depends, Response, status, BackgroundTasks, HTTPException, Form, Security, Request
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 import psycopg2
+from starlette.concurrency import run_in_threadpool
 
 from .fastapiutils import APIRouter, AuthenticatedUser, validate_user_authentication, api_authorization_header
 import validators
 from datatypes import (AccessDeniedError, Account, Bot, Dashboard, Entity, Credential, Sensor, Measurement,
-    Path, PathInputValue, PathFilter, Permission, Timestamp, UnfinishedPathFilter, ValidationError, Widget, Stats,
+    Path, PathInputValue, PathFilter, Permission, Timestamp, UnfinishedPathFilter, ValidationError, Widget,
+)
+from dbutils import db
+from .common import mqtt_publish_changed
+from .ingest import (INGEST_MODE, INGEST_MODE_QUEUE, enqueue_values, ingest_executor, publish_values_changes,
+    save_values_and_stats_batched,
 )
-from .common import mqtt_publish_changed, mqtt_publish_changed_multiple_payloads
 from const import SYSTEM_PATH_INSERTED_COUNT, SYSTEM_PATH_UPDATED_COUNT, SYSTEM_PATH_CHANGED_COUNT
 
 
+VALUES_JSON_CHUNK_SIZE = 1000  # number of values written to the streamed response at once
+# Values can be returned in different formats (negotiated via Accept header); JSON with a dict per value is the default:
+VALUES_FORMAT_JSON = 'application/json'
+# {"paths": {"<path>": {"next_data_point": ..., "t": [...], "v": [...], "minv": [...], "maxv": [...]}}}
+VALUES_FORMAT_COLUMNAR_JSON = 'application/vnd.grafolean.columnar+json'
+# for each path: uint32 length of path, path (UTF-8), uint32 number of values (n), uint32 number of columns, float64
+# next_data_point (NaN if null), and then the columns (t, v[, minv, maxv]), each an array of n float64 - all of it
+# little-endian:
+VALUES_FORMAT_BINARY = 'application/vnd.grafolean.float64le'
+
+
 accounts_api = APIRouter()
 
 
@@ -77,6 +97,44 @@ def accounts_apidoc_schemas():
             },
         },
     }
+    yield "ValuesColumnarGET", {
+        'type': 'object',
+        'properties': {
+            'paths': {
+                'type': 'object',
+                'additionalProperties': {
+                    'type': 'object',
+                    'properties': {
+                        'next_data_point': {
+                            'type': ['number', 'null'],
+                            'description': "Measurements time (UNIX timestamp) of the next value - null if limit was not reached",
+                            'example': 1234567890.123456,
+                        },
+                        't': {
+                            'type': 'array',
+                            'description': "Measurements times (UNIX timestamps) - middle of aggregation bucket if aggregation was requested",
+                            'items': {'type': 'number'},
+                        },
+                        'v': {
+                            'type': 'array',
+                            'description': "Measurement values; median values if aggregation was requested",
+                            'items': {'type': 'number'},
+                        },
+                        'minv': {
+                            'type': 'array',
+                            'description': "Minimum values (only if aggregation was requested)",
+                            'items': {'type': 'number'},
+                        },
+                        'maxv': {
+                            'type': 'array',
+                            'description': "Maximum values (only if aggregation was requested)",
+                            'items': {'type': 'number'},
+                        },
+                    },
+                },
+            },
+        },
+    }
     yield "TopValuesGET", {
         'type': 'object',
         'properties': {
@@ -289,7 +347,7 @@ def account_bot_delete(account_id: int, user_id: int, auth: AuthenticatedUser =
 def account_bot_token_get(account_id: int, user_id: int, auth: AuthenticatedUser = Depends(validate_user_authentication)):
     # make sure the user who is requesting to see the bot token has every permission that this token has, and
     # also that this user can add the bot:
-    request_user_permissions = Permission.get_list(int(auth.user_id))
+    request_user_permissions = Permission.get_compiled(auth.user_id).permissions
     if not Permission.has_all_permissions(request_user_permissions, user_id):
         raise HTTPException(status_code=403, detail="Not enough permissions to see this bot's token")
     if not Permission.can_grant_permission(request_user_permissions, 'accounts/{}/bots'.format(account_id), 'POST'):
@@ -515,39 +573,39 @@ def account_bot_permission_delete(account_id: int, user_id: int, permission_id:
     return Response(status_code=204)
 
 
+async def _read_json_body(request):
+    """
+        Request connection was already checked out (for authentication), but a slow client could keep it for as long
+        as it takes to upload the body - so it is returned to the pool first (and checked out again when needed).
+    """
+    db.release_request_connection()
+    return await request.json()
+
+
 @accounts_api.put("/api/accounts/{account_id}/values")
 async def values_put(account_id: int, request: Request, auth: AuthenticatedUser = Depends(validate_user_authentication)):
-    data = await request.json()
+    data = await _read_json_body(request)
 
-    # let's just pretend our data is of correct form, otherwise Exception will be thrown and Flask will return error response:
-    try:
-        newly_created_paths = Measurement.save_values_data_to_db(account_id, data)
-    except psycopg2.IntegrityError:
-        raise HTTPException(status_code=400, detail="Invalid input format")
-
-    # save the stats:
     minute = math.floor(time.time() / 60) * 60
     stats_updates = {
         SYSTEM_PATH_UPDATED_COUNT: { 'v': len(data), 't': minute },
         SYSTEM_PATH_CHANGED_COUNT: { 'v': len(data), 't': minute },
     }
-    topics_with_payloads_stats = Stats.update_account_stats(account_id, stats_updates)
 
-    # publish the changes over MQTT:
-    topics_with_payloads = [(
-        f"accounts/{account_id}/values/{d['p']}",
-        { 'v': d['v'], 't': d['t'] },
-    ) for d in data]
-    topics_with_payloads.extend(topics_with_payloads_stats)
-    if newly_created_paths:
-        topics_with_payloads.append(
-            (
-                f"accounts/{account_id}/paths",
-                [{"p": p.path, "id": p.force_id} for p in newly_created_paths],
-            ),
-        )
+    if INGEST_MODE == INGEST_MODE_QUEUE:
+        # values will be saved (and changes published) by ingest consumer:
+        await ingest_executor.run(enqueue_values, account_id, data, stats_updates)
+        return Response(status_code=202)
+
+    # save the values and the stats (possibly together with values from other concurrent requests); let's just
+    # pretend our data is of correct form, otherwise Exception will be thrown and we will return error response:
+    try:
+        newly_created_paths = await save_values_and_stats_batched(account_id, data, stats_updates)
+    except psycopg2.IntegrityError:
+        raise HTTPException(status_code=400, detail="Invalid input format")
 
-    mqtt_publish_changed_multiple_payloads(topics_with_payloads)
+    # publish the changes over MQTT:
+    await ingest_executor.run(publish_values_changes, account_id, data, newly_created_paths)
     return Response(status_code=204)
 
 
@@ -557,7 +615,7 @@ async def values_post(account_id: int, request: Request, auth: AuthenticatedUser
     # piece, then we use the same function as for PUT:
     data = []
     now = time.time()
-    json_data = await request.json()
+    json_data = await _read_json_body(request)
     query_params_p = request.query_params.get('p')
     if json_data:
         for x in json_data:
@@ -579,35 +637,26 @@ async def values_post(account_id: int, request: Request, auth: AuthenticatedUser
     else:
         raise HTTPException(status_code=400, detail="Missing data")
 
-    # let's just pretend our data is of correct form, otherwise Exception will be thrown and Flask will return error response:
-    try:
-        newly_created_paths = Measurement.save_values_data_to_db(account_id, data)
-    except psycopg2.IntegrityError:
-        raise HTTPException(status_code=400, detail="Invalid input format")
-
-    # update stats:
     minute = math.floor(time.time() / 60) * 60
     stats_updates = {
         SYSTEM_PATH_INSERTED_COUNT: { 'v': len(data), 't': minute },
         SYSTEM_PATH_CHANGED_COUNT: { 'v': len(data), 't': minute },
     }
-    topics_with_payloads_stats = Stats.update_account_stats(account_id, stats_updates)
 
-    # publish the changes over MQTT:
-    topics_with_payloads = [(
-        f"accounts/{account_id}/values/{d['p']}",
-        { 'v': d['v'], 't': d['t'] },
-    ) for d in data]
-    topics_with_payloads.extend(topics_with_payloads_stats)
-    if newly_created_paths:
-        topics_with_payloads.append(
-            (
-                f"accounts/{account_id}/paths",
-                [{"p": p.path, "id": p.force_id} for p in newly_created_paths],
-            ),
-        )
+    if INGEST_MODE == INGEST_MODE_QUEUE:
+        # values will be saved (and changes published) by ingest consumer:
+        await ingest_executor.run(enqueue_values, account_id, data, stats_updates)
+        return Response(status_code=202)
+
+    # save the values and the stats (possibly together with values from other concurrent requests); let's just
+    # pretend our data is of correct form, otherwise Exception will be thrown and we will return error response:
+    try:
+        newly_created_paths = await save_values_and_stats_batched(account_id, data, stats_updates)
+    except psycopg2.IntegrityError:
+        raise HTTPException(status_code=400, detail="Invalid input format")
 
-    mqtt_publish_changed_multiple_payloads(topics_with_payloads)
+    # publish the changes over MQTT:
+    await ingest_executor.run(publish_values_changes, account_id, data, newly_created_paths)
     return Response(status_code=204)
 
 
@@ -621,6 +670,8 @@ def values_get(account_id: int, path: str, request: Request, auth: Authenticated
             - Accounts
           description:
             Returns the values for the specified path. Similar to POST /accounts/<account_id>/getvalues/, except that only a single path can be specified (and GET is used).
+
+            Instead of the default JSON (a dict per value), values can be requested (via Accept header) in columnar JSON or in binary format.
           parameters:
             - name: account_id
               in: path
@@ -661,18 +712,33 @@ def values_get(account_id: int, path: str, request: Request, auth: Authenticated
                 type: integer
                 minimum: 1
                 maximum: 100000
+            - name: max_points
+              in: query
+              description: "Downsample the returned values (using LTTB) to at most this many points per path, so that they can still be charted faithfully"
+              required: false
+              schema:
+                type: integer
+                minimum: 3
           responses:
             200:
               content:
                 application/json:
                   schema:
                     "$ref": '#/definitions/ValuesGET'
+                application/vnd.grafolean.columnar+json:
+                  schema:
+                    "$ref": '#/definitions/ValuesColumnarGET'
+                application/vnd.grafolean.float64le:
+                  schema:
+                    type: string
+                    format: binary
+                    description: "For each path: uint32 length of path, path (UTF-8), uint32 number of values (n), uint32 number of columns, float64 next_data_point (NaN if null), and then the columns (t, v and, with aggregation, minv and maxv), each an array of n float64 - all little-endian"
     """
     args = request.query_params
     if "," in path:
         raise HTTPException(status_code=400, detail="Only a single path is allowed")
     paths_input = path
-    return _values_get(account_id, paths_input, None, args)
+    return _values_get(account_id, paths_input, None, args, request.headers.get('accept'))
 
 
 @accounts_api.post("/api/accounts/{account_id}/getvalues")
@@ -680,14 +746,15 @@ async def values_get_with_post(account_id: int, request: Request, auth: Authenti
     # when we request data for too many paths at once, we run in trouble with URLs being too long. Using
     # POST is not ideal, but it works... We do however keep the interface as close to GET as possible, so
     # we use the same arguments:
-    args = await request.json()
+    args = await _read_json_body(request)
     paths_input = args.get('p')
-    return _values_get(account_id, paths_input, None, args)
+    # fetching (and encoding) the values blocks, so it must not run on the event loop:
+    return await run_in_threadpool(_values_get, account_id, paths_input, None, args, request.headers.get('accept'))
 
 
 @accounts_api.post("/api/accounts/{account_id}/getaggrvalues")
 async def aggrvalues_get_with_post(account_id: int, request: Request, auth: AuthenticatedUser = Depends(validate_user_authentication)):
-    args = await request.json()
+    args = await _read_json_body(request)
     paths_input = args.get('p')
 
     try:
@@ -697,10 +764,10 @@ async def aggrvalues_get_with_post(account_id: int, request: Request, auth: Auth
     if not (0 <= aggr_level <= 6):
         raise HTTPException(status_code=400, detail="Invalid parameter a (should be a number in range from 0 to 6).")
 
-    return _values_get(account_id, paths_input, aggr_level, args)
+    return await run_in_threadpool(_values_get, account_id, paths_input, aggr_level, args, request.headers.get('accept'))
 
 
-def _values_get(account_id, paths_input, aggr_level, args):
+def _values_get(account_id, paths_input, aggr_level, args, accept=None):
     if paths_input is None:
         raise HTTPException(status_code=400, detail="Path(s) not specified")
     try:
@@ -740,6 +807,7 @@ def _values_get(account_id, paths_input, aggr_level, args):
         raise HTTPException(status_code=400, detail="Invalid parameter: sort (should be 'asc' or 'desc')")
     should_sort_asc = True if sort_order == 'asc' else False
 
+    limit_requested = 'limit' in args
     try:
         max_records = int(args.get('limit', Measurement.MAX_DATAPOINTS_RETURNED))
         if max_records > Measurement.MAX_DATAPOINTS_RETURNED:
@@ -747,9 +815,108 @@ def _values_get(account_id, paths_input, aggr_level, args):
     except:
         raise HTTPException(status_code=400, detail="Invalid parameter: limit")
 
-    # finally, return the data:
-    paths_data = Measurement.fetch_data(account_id, paths, aggr_level, t_froms, t_to, should_sort_asc, max_records)
-    return JSONResponse(content={'paths': paths_data}, status_code=200)
+    # raw values can be downsampled (aggregated values are already aggregated into fixed buckets):
+    max_points = args.get('max_points')
+    if max_points is not None:
+        if aggr_level is not None:
+            raise HTTPException(status_code=400, detail="Invalid parameter: max_points (only raw values can be downsampled)")
+        try:
+            max_points = int(max_points)
+        except:
+            raise HTTPException(status_code=400, detail="Invalid parameter: max_points")
+        if max_points < 3:
+            raise HTTPException(status_code=400, detail="Invalid parameter: max_points (min. value is 3)")
+
+    # finally, return the data - large results are written to the response while they are being read from DB:
+    values_format = _negotiate_values_format(accept)
+    headers = {'Vary': 'Accept'}
+    if values_format == VALUES_FORMAT_JSON:
+        if Measurement.should_stream_data(paths, aggr_level, t_froms, t_to, max_records, limit_requested):
+            paths_values = Measurement.stream_data(account_id, paths, aggr_level, t_froms, t_to, should_sort_asc, max_records, max_points=max_points)
+            return StreamingResponse(_values_json_chunks(paths_values), media_type=values_format, headers=headers, status_code=200)
+        paths_data = Measurement.fetch_data(account_id, paths, aggr_level, t_froms, t_to, should_sort_asc, max_records, max_points)
+        return JSONResponse(content={'paths': paths_data}, headers=headers, status_code=200)
+
+    # other formats are built from tuples (not dicts) of values, one path at a time:
+    paths_values = Measurement.iter_data(account_id, paths, aggr_level, t_froms, t_to, should_sort_asc, max_records, as_tuples=True, max_points=max_points, limit_requested=limit_requested)
+    columns = ['t', 'v'] if aggr_level is None else ['t', 'v', 'minv', 'maxv']
+    if values_format == VALUES_FORMAT_COLUMNAR_JSON:
+        return StreamingResponse(_values_columnar_json_chunks(paths_values, columns), media_type=values_format, headers=headers, status_code=200)
+    return StreamingResponse(_values_binary_chunks(paths_values, columns), media_type=values_format, headers=headers, status_code=200)
+
+
+def _negotiate_values_format(accept):
+    """ Returns the values format which client prefers (according to Accept header), JSON if none of them is supported. """
+    if not accept:
+        return VALUES_FORMAT_JSON
+    candidates = []
+    for n, media_range in enumerate(accept.split(',')):
+        media_type, *params = [x.strip() for x in media_range.split(';')]
+        q = 1.0
+        for param in params:
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if q > 0:
+            candidates.append((-q, n, media_type.lower()))
+    for _, _, media_type in sorted(candidates):
+        if media_type in [VALUES_FORMAT_JSON, VALUES_FORMAT_COLUMNAR_JSON, VALUES_FORMAT_BINARY]:
+            return media_type
+        if media_type in ['*/*', 'application/*']:
+            return VALUES_FORMAT_JSON
+    return VALUES_FORMAT_JSON
+
+
+def _values_json_chunks(paths_values):
+    """ Writes {'paths': {...}} (the same as JSONResponse would) incrementally, a chunk of values at a time. """
+    dumps = functools.partial(json.dumps, ensure_ascii=False, allow_nan=False, separators=(",", ":"))
+    yield '{"paths":{'
+    for n, (path, values) in enumerate(paths_values):
+        yield '{}{}:{{"data":['.format(',' if n > 0 else '', dumps(path))
+        chunk = []
+        first_chunk = True
+        for point in values:
+            chunk.append(dumps(point))
+            if len(chunk) >= VALUES_JSON_CHUNK_SIZE:
+                yield ('' if first_chunk else ',') + ','.join(chunk)
+                chunk, first_chunk = [], False
+        if chunk:
+            yield ('' if first_chunk else ',') + ','.join(chunk)
+        yield '],"next_data_point":{}}}'.format(dumps(values.next_data_point))
+    yield '}}'
+
+
+def _values_columnar_json_chunks(paths_values, columns):
+    """ Writes {'paths': {...}} in columnar format, one path at a time. """
+    dumps = functools.partial(json.dumps, ensure_ascii=False, allow_nan=False, separators=(",", ":"))
+    yield '{"paths":{'
+    for n, (path, values) in enumerate(paths_values):
+        points = list(values)
+        path_data = {'next_data_point': values.next_data_point}
+        for name, column in zip(columns, zip(*points) if points else [() for _ in columns]):
+            path_data[name] = column
+        yield '{}{}:{}'.format(',' if n > 0 else '', dumps(path), dumps(path_data))
+    yield '}}'
+
+
+def _values_binary_chunks(paths_values, columns):
+    """ Writes the values in VALUES_FORMAT_BINARY, one path at a time. """
+    for path, values in paths_values:
+        points = list(values)
+        path_encoded = path.encode('utf-8')
+        next_data_point = values.next_data_point
+        header = struct.pack('<I', len(path_encoded)) + path_encoded + struct.pack(
+            '<IId', len(points), len(columns), math.nan if next_data_point is None else next_data_point,
+        )
+        body = array.array('d')
+        for column in (zip(*points) if points else []):
+            body.extend(column)
+        if sys.byteorder == 'big':
+            body.byteswap()
+        yield header + body.tobytes()
 
 
 @accounts_api.get("/api/accounts/{account_id}/topvalues")
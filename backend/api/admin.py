@@ -1,4 +1,6 @@
 import json
+import os
+import time
 import urllib.parse
 
 from fastapi import Depends, Response, status, BackgroundTasks, HTTPException, Form, Security
@@ -6,17 +8,54 @@ from fastapi.responses import JSONResponse
 
 from .fastapiutils import APIRouter, AuthenticatedUser, validate_user_authentication, api_authorization_header
 from .objschemas import ReqPersonPOST, ResId, ReqAccountsPOST
-from .common import mqtt_publish_changed
-from datatypes import Account, Permission, Person, Bot
+from .common import mqtt_publish_changed, mqtt_publisher
+from .ingest import INGEST_MODE, values_batcher
+from datatypes import Account, Permission, Person, Bot, Path, IngestQueue, Measurement
 from auth import Auth, JWT, AuthFailedException
 import dbutils
-from utils import log, TelemetryActions, telemetry_send
+from utils import log, LRUCache, TelemetryActions, telemetry_send
 import validators
 
 
 admin_api = APIRouter()
 
 
+# Mosquitto asks us about every subscription and every message delivered to a client, so the decisions are cached
+# (for at most MQTT_AUTH_CACHE_TTL seconds, or until the user's permissions change):
+MQTT_AUTH_CACHE_SIZE = int(os.environ.get('MQTT_AUTH_CACHE_SIZE', 10000))
+MQTT_AUTH_CACHE_TTL = float(os.environ.get('MQTT_AUTH_CACHE_TTL', 60))
+mqtt_auth_cache = LRUCache(MQTT_AUTH_CACHE_SIZE)  # (check type, token, topic, acc) => (is_allowed, user_id, valid_until)
+
+
+def _mqtt_auth_cached_decision(cache_key):
+    """ Returns True / False if the decision is cached, None otherwise. """
+    cached = mqtt_auth_cache.get(cache_key)
+    if cached is None:
+        return None
+    is_allowed, _, valid_until = cached
+    if time.time() >= valid_until:
+        mqtt_auth_cache.invalidate(cache_key)
+        return None
+    return is_allowed
+
+
+def _mqtt_auth_cache_decision(cache_key, is_allowed, received_jwt, leeway):
+    user_id = received_jwt.data.get('user_id')
+    valid_until = min(time.time() + MQTT_AUTH_CACHE_TTL, received_jwt.data['exp'] + leeway)
+    mqtt_auth_cache.set(cache_key, (is_allowed, None if user_id is None else int(user_id), valid_until))
+
+
+def _on_permissions_changed_notification(payload):
+    if payload is None:
+        mqtt_auth_cache.clear()
+    else:
+        user_id = int(payload)
+        mqtt_auth_cache.invalidate_where(lambda k, v: v[1] == user_id)
+
+
+dbutils.db_listen(Permission.PERMISSIONS_CHANGED_CHANNEL, _on_permissions_changed_notification)
+
+
 def admin_apidoc_schemas():
     yield "AccountSchemaInputs", validators.AccountSchemaInputs
 
@@ -134,11 +173,15 @@ def admin_mqttauth_plug_getuser(authorization_header: str = Depends(lambda autho
     """
     # mqtt-auth-plug urlencodes JWT tokens, so we must decode them here:
     authorization_header = urllib.parse.unquote(authorization_header, encoding='utf-8')
+    cache_key = ('getuser', authorization_header)
+    if _mqtt_auth_cached_decision(cache_key):
+        return Response(status_code=200, content="")
     try:
         # we don't complicate about newly expired tokens here - if they are at all valid, browser will refresh them anyway.
         received_jwt = JWT.forge_from_authorization_header(authorization_header, allow_leeway=JWT.TOKEN_CAN_BE_REFRESHED_FOR)
         # jwt token was successfully decoded, so we can allow for the fact that this is a valid user - we'll still see about
         # access rights though (might be superuser, in which case everything goes, or it might be checked via aclcheck)
+        _mqtt_auth_cache_decision(cache_key, True, received_jwt, JWT.TOKEN_CAN_BE_REFRESHED_FOR)
         return Response(status_code=200, content="")
 
     except AuthFailedException as ex:
@@ -153,11 +196,18 @@ def admin_mqttauth_plug_getuser(authorization_header: str = Depends(lambda autho
 def admin_mqttauth_plug_superuser(authorization_header: str = Depends(lambda authorization_header = Security(api_authorization_header): authorization_header)):
     # mqtt-auth-plug urlencodes JWT tokens, so we must decode them here:
     authorization_header = urllib.parse.unquote(authorization_header, encoding='utf-8')
+    cache_key = ('superuser', authorization_header)
+    is_superuser = _mqtt_auth_cached_decision(cache_key)
+    if is_superuser is not None:
+        if is_superuser:
+            return Response(status_code=200, content="")
+        raise HTTPException(status_code=401, detail="Access denied")
     try:
         # we don't complicate about newly expired tokens here - if they are at all valid, browser will refresh them anyway.
         received_jwt = JWT.forge_from_authorization_header(authorization_header, allow_leeway=JWT.TOKEN_CAN_BE_REFRESHED_FOR)
         # is this our own attempt to publish something to MQTT, and the mosquitto auth plugin is asking us to authenticate ourselves?
         is_superuser = bool(received_jwt.data.get('superuser', False))
+        _mqtt_auth_cache_decision(cache_key, is_superuser, received_jwt, JWT.TOKEN_CAN_BE_REFRESHED_FOR)
         if is_superuser:
             return Response(status_code=200, content="")
 
@@ -176,15 +226,23 @@ def admin_mqttauth_plug_superuser(authorization_header: str = Depends(lambda aut
 def admin_mqttauth_plug_aclcheck(acc: int = Form(...), topic: str = Form(...), authorization_header: str = Depends(lambda authorization_header = Security(api_authorization_header): authorization_header)):
     # mqtt-auth-plug urlencodes JWT tokens, so we must decode them here:
     authorization_header = urllib.parse.unquote(authorization_header, encoding='utf-8')
+    cache_key = ('aclcheck', authorization_header, topic, acc)
+    is_allowed = _mqtt_auth_cached_decision(cache_key)
+    if is_allowed is not None:
+        if is_allowed:
+            return Response(status_code=200, content="")
+        raise HTTPException(status_code=401, detail="Access denied")
     try:
 
         # When client connects, username is jwt token. However subscribing to topics doesn't necessarily reconnect so
         # fresh JWT token is not sent and we are getting the old one. This is OK though - if user kept the connection
         # we can assume that they would just keep refreshing the token. So we allow for some large leeway (10 years)
-        received_jwt = JWT.forge_from_authorization_header(authorization_header, allow_leeway=3600*24*365*10)
+        leeway = 3600*24*365*10
+        received_jwt = JWT.forge_from_authorization_header(authorization_header, allow_leeway=leeway)
         # superusers can do whatever they want to:
         is_superuser = bool(received_jwt.data.get('superuser', False))
         if is_superuser:
+            _mqtt_auth_cache_decision(cache_key, True, received_jwt, leeway)
             return Response(status_code=200, content="")
 
 
@@ -215,11 +273,13 @@ def admin_mqttauth_plug_aclcheck(acc: int = Form(...), topic: str = Form(...), a
         if requested_access not in [1, 4] :  # NONE = 0, READ = 1, WRITE = 2, SUBSCRIBE = 4
             instead_got = {0: "0/NONE", 2: "2/WRITE"}.get(requested_access, requested_access)
             log.info(f"Access denied (only 1/READ or 4/SUBSCRIBE allowed, requested access: {instead_got})")
+            _mqtt_auth_cache_decision(cache_key, False, received_jwt, leeway)
             raise HTTPException(status_code=401, detail="Access denied")
 
         # only 'changed/#' can actually be read by normal users:
         if topic[:8] != 'changed/':
             log.info("Access denied (wrong topic)")
+            _mqtt_auth_cache_decision(cache_key, False, received_jwt, leeway)
             raise HTTPException(status_code=401, detail="Access denied")
         resource = topic[8:]  # remove 'changed/' from the start of the topic to get the resource
         resource = resource.rstrip('/')
@@ -231,6 +291,7 @@ def admin_mqttauth_plug_aclcheck(acc: int = Form(...), topic: str = Form(...), a
             resource=resource,
             method='GET',  # users can only request read access (apart from backend, which is superuser anyway)
         )
+        _mqtt_auth_cache_decision(cache_key, is_allowed, received_jwt, leeway)
         if is_allowed:
             return Response(status_code=200, content="")
 
@@ -312,3 +373,93 @@ def accounts_crud_post(account: ReqAccountsPOST, auth: AuthenticatedUser = Depen
     account_record = Account.forge_from_input(account.dict())
     account_id = account_record.insert()
     return JSONResponse(content={'name': account_record.name, 'id': account_id}, status_code=201)
+
+
+@admin_api.get('/api/admin/metrics')
+def admin_metrics_get(auth: AuthenticatedUser = Depends(validate_user_authentication)):
+    """
+        ---
+        get:
+          summary: Get internal metrics
+          tags:
+            - Admin
+          description:
+            Returns internal metrics (like cache hit rates) of the worker process which served the request. Note that
+            each worker keeps its own metrics.
+          responses:
+            200:
+              content:
+                application/json:
+                  schema:
+                    type: object
+                    properties:
+                      caches:
+                        type: object
+                        description: "Per-cache stats (size, maxsize, hits, misses, hit_rate); size and maxsize of aggr_buckets are in bytes (with the number of entries in entries)"
+                      ingest:
+                        type: object
+                        description: "Values group commit counters (batches, requests, rows, fallbacks)"
+                      mqtt:
+                        type: object
+                        description: "MQTT publisher state and counters (published, dropped, delayed messages,...)"
+                      db_pool:
+                        type: object
+                        description: "DB connection pool size and counters (checkouts, timeouts, wait time,...)"
+                      prepared_statements:
+                        type: object
+                        description: "Per-statement counters (prepares, executions, total_time_ms) and average planning and execution time of the sampled executions (samples, avg_planning_ms, avg_execution_ms - see DB_EXPLAIN_SAMPLE_INTERVAL)"
+                      db_replica:
+                        type: object
+                        description: "Read replica state (usable, lag_s) and counters, null if replica is not configured"
+    """
+    result = {
+        'caches': {
+            'path_ids': Path.path_ids_cache.stats(),
+            'bot_tokens': Bot.token_cache.stats(),
+            'permissions': Permission.compiled_cache.stats(),
+            'jwt_tokens': JWT.decoded_cache.stats(),
+            'mqtt_auth': mqtt_auth_cache.stats(),
+            'aggr_buckets': Measurement.aggr_buckets_cache.stats(),
+        },
+        'ingest': dict(values_batcher.counters),
+        'mqtt': mqtt_publisher.stats(),
+        'db_pool': dbutils.db_pool.stats() if dbutils.db_pool is not None else None,
+        'prepared_statements': dbutils.PreparedStatement.stats(),
+        'db_replica': dbutils.db_replica.stats() if dbutils.db_replica is not None else None,
+    }
+    return JSONResponse(content=result, status_code=200)
+
+
+@admin_api.get('/api/admin/ingest-queue')
+def admin_ingest_queue_get(auth: AuthenticatedUser = Depends(validate_user_authentication)):
+    """
+        ---
+        get:
+          summary: Get ingest queue status
+          tags:
+            - Admin
+          description:
+            Returns the number of requests with values which were received but not yet saved (when INGEST_MODE is
+            set to "queue"), and the age of the oldest of them.
+          responses:
+            200:
+              content:
+                application/json:
+                  schema:
+                    type: object
+                    properties:
+                      mode:
+                        type: string
+                        description: "Ingest mode (direct or queue)"
+                      depth:
+                        type: integer
+                        description: "Number of queued requests"
+                      lag_s:
+                        type: number
+                        description: "Age of the oldest queued request in seconds (0 if queue is empty)"
+    """
+    result = {
+        'mode': INGEST_MODE,
+        **IngestQueue.get_status(),
+    }
+    return JSONResponse(content=result, status_code=200)
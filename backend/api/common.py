@@ -1,18 +1,23 @@
+import collections
 import json
 import os
+import socket
+import threading
 import time
-import traceback
 
-import paho.mqtt.publish as mqtt_publish
+import paho.mqtt.client as paho
 
 from auth import JWT
-from utils import log, telemetry_send
+from utils import log, telemetry_send, ForkSafeThread
 
 
 MQTT_HOSTNAME = os.environ.get('MQTT_HOSTNAME')
 MQTT_PORT = int(os.environ.get('MQTT_PORT', 1883))
 MQTT_WS_HOSTNAME = os.environ.get('MQTT_WS_HOSTNAME', '')
 MQTT_WS_PORT = os.environ.get('MQTT_WS_PORT', '')
+MQTT_PUBLISH_QUEUE_SIZE = int(os.environ.get('MQTT_PUBLISH_QUEUE_SIZE', 1000))  # max. number of buffered publish calls
+MQTT_CIRCUIT_BREAKER_TIMEOUT = float(os.environ.get('MQTT_CIRCUIT_BREAKER_TIMEOUT', 10))  # seconds without connection before we stop buffering
+MQTT_MESSAGE_MAX_AGE = float(os.environ.get('MQTT_MESSAGE_MAX_AGE', 60))  # older (buffered) change notifications are dropped
 
 
 CORS_DOMAINS = list(filter(len, os.environ.get('GRAFOLEAN_CORS_DOMAINS', '').lower().split(",")))
@@ -60,15 +65,200 @@ def mqtt_publish_changed(topics, payload='1'):
     mqtt_publish_changed_multiple_payloads(topics_with_payloads)
 
 
+class MQTTPublisher(object):
+    """
+        Long-lived MQTT connection (one per worker process) which is used to publish notifications about changes.
+        Connecting for each publish would mean a new TCP connection, CONNECT and (because of mosquitto-go-auth)
+        additional requests to our /api/admin/mqtt-auth-plug/ endpoints - for every request which changes anything.
+
+        Callers never wait for the broker: messages are put to a bounded buffer and published by a background thread
+        once the connection is established. Paho takes care of reconnecting (with exponential backoff). Since the
+        messages only notify about changes, they lose their value quickly, so we rather drop them than let them pile
+        up:
+          - if the buffer is full, the oldest messages are dropped
+          - messages which waited longer than max_age seconds are dropped
+          - if the broker is unreachable for more than circuit_breaker_timeout seconds, the circuit breaker opens;
+            buffered messages are dropped, and so are new ones until the connection is reestablished
+
+        Publishing is called from request threads, so it must never block - the client is created (and the
+        credentials, which might need DB, are obtained) in the publisher's own thread.
+    """
+    RECONNECT_MIN_DELAY = 1
+    RECONNECT_MAX_DELAY = 30
+    DELAYED_THRESHOLD = 1.0  # messages which waited longer than this (seconds) are counted as delayed
+
+    def __init__(self, hostname, port, queue_size, circuit_breaker_timeout, max_age):
+        self.hostname = hostname
+        self.port = port
+        self.queue_size = queue_size
+        self.circuit_breaker_timeout = circuit_breaker_timeout
+        self.max_age = max_age
+        self.client = None
+        self.thread = ForkSafeThread(self._run, 'mqtt-publisher', on_start=self._reset)
+        self.buffer = collections.deque()  # (enqueued_at, msgs)
+        self.buffer_cond = threading.Condition()
+        self.connected = threading.Event()
+        self.lock = threading.Lock()  # protects disconnected_since, counters and max_delay
+        self.disconnected_since = None
+        self.counters = {
+            'published': 0,
+            'dropped_overflow': 0,
+            'dropped_stale': 0,
+            'dropped_circuit_open': 0,
+            'delayed': 0,
+            'connects': 0,
+        }
+        self.max_delay = 0.0
+
+    def start(self):
+        self.thread.start()
+
+    def _reset(self):
+        self.buffer.clear()
+        self.connected.clear()
+        self.client = None
+        with self.lock:
+            self.disconnected_since = time.monotonic()
+
+    def _connect(self):
+        client = paho.Client(client_id=f'grafolean-backend-{socket.gethostname()}-{os.getpid()}')
+        client.on_connect = self._on_connect
+        client.on_disconnect = self._on_disconnect
+        client.reconnect_delay_set(min_delay=self.RECONNECT_MIN_DELAY, max_delay=self.RECONNECT_MAX_DELAY)
+        self.client = client
+        self._set_credentials()
+        client.connect_async(self.hostname, self.port)
+        client.loop_start()
+
+    def _count(self, counter, n=1):
+        with self.lock:
+            self.counters[counter] += n
+
+    def _set_credentials(self):
+        # broker checks the token only when we connect, but we need a valid one whenever we reconnect:
+        superuser_jwt_token = SuperuserJWTToken.get_valid_token('backend_changed_notif')
+        self.client.username_pw_set(superuser_jwt_token, "not.used")
+
+    @property
+    def circuit_open(self):
+        disconnected_since = self.disconnected_since
+        return disconnected_since is not None and time.monotonic() - disconnected_since > self.circuit_breaker_timeout
+
+    def _on_connect(self, client, userdata, flags, rc):
+        if rc != 0:
+            log.error(f"MQTT publishing: connection refused ({paho.connack_string(rc)})")
+            self._set_credentials()
+            return
+        if self.circuit_open:
+            log.info("MQTT publishing: connected, closing circuit breaker")
+        with self.lock:
+            self.counters['connects'] += 1
+            self.disconnected_since = None
+        self.connected.set()
+
+    def _on_disconnect(self, client, userdata, rc):
+        self.connected.clear()
+        with self.lock:
+            if self.disconnected_since is None:
+                self.disconnected_since = time.monotonic()
+        if rc != 0:
+            log.warning("MQTT publishing: connection lost, reconnecting")
+        try:
+            self._set_credentials()
+        except:
+            log.exception("MQTT publishing: could not refresh credentials")
+
+    def publish(self, msgs):
+        """ Enqueues a list of (topic, payload) messages without blocking. """
+        try:
+            self.start()
+        except Exception as ex:
+            log.error(f"MQTT publishing: could not start publisher: {str(ex)}")
+            return
+        if self.circuit_open:
+            self._count('dropped_circuit_open', len(msgs))
+            return
+        with self.buffer_cond:
+            if len(self.buffer) >= self.queue_size:
+                _, dropped_msgs = self.buffer.popleft()
+                self._count('dropped_overflow', len(dropped_msgs))
+            self.buffer.append((time.monotonic(), msgs))
+            self.buffer_cond.notify()
+
+    def _drop_buffered(self):
+        with self.buffer_cond:
+            n_dropped = sum(len(msgs) for _, msgs in self.buffer)
+            self.buffer.clear()
+        if n_dropped:
+            log.warning(f"MQTT publishing: broker unreachable, dropped {n_dropped} messages")
+        self._count('dropped_circuit_open', n_dropped)
+
+    def _run(self):
+        while True:
+            try:
+                self._connect()
+                break
+            except:
+                log.exception("MQTT publishing: could not connect")
+            if self.circuit_open:
+                self._drop_buffered()
+            time.sleep(self.RECONNECT_MAX_DELAY)
+
+        while True:
+            with self.buffer_cond:
+                while not self.buffer:
+                    self.buffer_cond.wait()
+                enqueued_at, msgs = self.buffer.popleft()
+
+            while not self.connected.wait(timeout=0.5):
+                if self.circuit_open:
+                    self._count('dropped_circuit_open', len(msgs))
+                    self._drop_buffered()
+                    msgs = None
+                    break
+            if msgs is None:
+                continue
+
+            delay = time.monotonic() - enqueued_at
+            if delay > self.max_age:
+                self._count('dropped_stale', len(msgs))
+                continue
+            with self.lock:
+                if delay > self.DELAYED_THRESHOLD:
+                    self.counters['delayed'] += len(msgs)
+                self.max_delay = max(self.max_delay, delay)
+            for topic, payload in msgs:
+                try:
+                    self.client.publish(topic, payload, qos=1)
+                    self._count('published')
+                except Exception as ex:
+                    log.error(f"MQTT publishing: could not publish to {topic}: {str(ex)}")
+
+    def flush(self, timeout):
+        """ Waits (at most timeout seconds) until the buffered messages are handed over to paho. """
+        deadline = time.monotonic() + timeout
+        while self.buffer and not self.circuit_open and time.monotonic() < deadline:
+            time.sleep(0.05)
+
+    def stats(self):
+        with self.lock:
+            counters = dict(self.counters)
+            max_delay = self.max_delay
+        return {
+            **counters,
+            'max_delay_s': max_delay,
+            'buffered': len(self.buffer),
+            'connected': self.connected.is_set(),
+            'circuit_open': self.circuit_open,
+        }
+
+
+mqtt_publisher = MQTTPublisher(MQTT_HOSTNAME, MQTT_PORT, MQTT_PUBLISH_QUEUE_SIZE, MQTT_CIRCUIT_BREAKER_TIMEOUT, MQTT_MESSAGE_MAX_AGE)
+
+
 def mqtt_publish_changed_multiple_payloads(topics_with_payloads):
     if not MQTT_HOSTNAME:
         log.warn("MQTT not connected, not publishing change")
         return
-    superuserJwtToken = SuperuserJWTToken.get_valid_token('backend_changed_notif')
-
-    # https://www.eclipse.org/paho/clients/python/docs/#id2
-    try:
-        msgs = [('changed/{}'.format(t), json.dumps(p), 1, False) for t, p, in topics_with_payloads]
-        mqtt_publish.multiple(msgs, hostname=MQTT_HOSTNAME, port=MQTT_PORT, auth={"username": superuserJwtToken, "password": "not.used"})
-    except Exception as ex:
-        log.error(f"MQTT publishing: exception {''.join(traceback.format_exception(None, ex, ex.__traceback__))}")
+    msgs = [('changed/{}'.format(t), json.dumps(p)) for t, p, in topics_with_payloads]
+    mqtt_publisher.publish(msgs)
@@ -0,0 +1,265 @@
+import asyncio
+from concurrent.futures import Future
+import functools
+import os
+import queue
+import threading
+import time
+
+from .common import mqtt_publish_changed_multiple_payloads
+from datatypes import IngestQueue, Measurement, Stats, ValidationError
+from dbutils import db
+from utils import log, ForkSafeThread, ForkSafeThreadPool
+
+
+# With INGEST_MODE=queue the values are only validated and appended to ingest_queue (and 202 is returned), while
+# a separate process (ingest_consumer.py) saves them to DB and publishes the changes via MQTT:
+INGEST_MODE_DIRECT = 'direct'
+INGEST_MODE_QUEUE = 'queue'
+INGEST_MODE = os.environ.get('INGEST_MODE', INGEST_MODE_DIRECT).lower()
+# Values from concurrent requests are collected for at most INGEST_BATCH_MAX_DELAY_MS (or until INGEST_BATCH_MAX_ROWS
+# values are collected) and written to DB together. Setting INGEST_BATCH_MAX_DELAY_MS to 0 disables batching.
+INGEST_BATCH_MAX_DELAY_MS = float(os.environ.get('INGEST_BATCH_MAX_DELAY_MS', 5))
+INGEST_BATCH_MAX_ROWS = int(os.environ.get('INGEST_BATCH_MAX_ROWS', 1000))
+# blocking stages of ingest (DB writes, MQTT publishing) are run on a bounded thread pool so that they don't block
+# the event loop; keep this below the size of DB connection pool:
+INGEST_EXECUTOR_THREADS = int(os.environ.get('INGEST_EXECUTOR_THREADS', 8))
+# account stats are written (and published) every STATS_FLUSH_INTERVAL seconds:
+STATS_FLUSH_INTERVAL = float(os.environ.get('STATS_FLUSH_INTERVAL', 5))
+
+
+class IngestExecutor(ForkSafeThreadPool):
+    def __init__(self, max_workers):
+        super().__init__(max_workers, 'ingest')
+
+    async def run(self, func, *args):
+        """ Runs a blocking function in a thread and waits for it without blocking the event loop. """
+        # the thread uses a connection of its own, so we must not hold the request connection while waiting for it:
+        db.release_request_connection()
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.get(), functools.partial(func, *args))
+
+
+ingest_executor = IngestExecutor(INGEST_EXECUTOR_THREADS)
+
+
+class StatsAccumulator(object):
+    """
+        Keeps the account stats counters (system.stats.*) in memory and periodically writes them to DB with a single
+        upsert. Otherwise all the workers would compete for the same (per-minute) rows with every request. The new
+        values of the counters are published via MQTT after they are written. With flush interval 0, the counters
+        are written immediately.
+    """
+    def __init__(self, flush_interval):
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.pending = {}  # (account_id, path, t) => increment
+        self.thread = ForkSafeThread(self._run, 'stats-accumulator')
+
+    def start(self):
+        self.thread.start()
+
+    def add(self, account_id, stats_updates):
+        """
+            Called after the values were saved, so it must not fail - the client would retry the request. If the
+            counters can't be written, they are kept and written with the next flush.
+        """
+        with self.lock:
+            for p, update in stats_updates.items():
+                key = (account_id, p, update['t'])
+                self.pending[key] = self.pending.get(key, 0) + update['v']
+        try:
+            if self.flush_interval > 0:
+                self.start()
+            else:
+                self.flush()
+        except:
+            log.exception("Error writing account stats")
+
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                pending, self.pending = self.pending, {}
+            if not pending:
+                return
+            try:
+                topics_with_payloads = Stats.update_stats_multiple(pending)
+            except:
+                # don't lose the counters, we will try again with the next flush:
+                with self.lock:
+                    for key, v in pending.items():
+                        self.pending[key] = self.pending.get(key, 0) + v
+                raise
+        mqtt_publish_changed_multiple_payloads(topics_with_payloads)
+
+    def clear(self):
+        with self.lock:
+            self.pending = {}
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except:
+                log.exception("Error writing account stats")
+
+
+stats_accumulator = StatsAccumulator(STATS_FLUSH_INTERVAL)
+
+
+def save_values_and_stats(account_id, data, stats_updates):
+    """
+        Saves the values and updates the account stats (see StatsAccumulator). Returns newly created paths.
+    """
+    newly_created_paths = Measurement.save_values_data_to_db(account_id, data)
+    stats_accumulator.add(account_id, stats_updates)
+    return newly_created_paths
+
+
+def save_values_and_stats_multiple(items):
+    """
+        Saves values and updates account stats for multiple (account_id, data, stats_updates) items at once. Returns
+        a list of newly created paths for each of the items. If saving fails, nothing is saved.
+    """
+    newly_created_paths = Measurement.save_values_batch_to_db([(account_id, data) for account_id, data, _ in items])
+    for account_id, _, stats_updates in items:
+        stats_accumulator.add(account_id, stats_updates)
+    return newly_created_paths
+
+
+def publish_values_changes(account_id, data, newly_created_paths):
+    topics_with_payloads = [(
+        f"accounts/{account_id}/values/{d['p']}",
+        { 'v': d['v'], 't': d['t'] },
+    ) for d in data]
+    if newly_created_paths:
+        topics_with_payloads.append(
+            (
+                f"accounts/{account_id}/paths",
+                [{"p": p.path, "id": p.force_id} for p in newly_created_paths],
+            ),
+        )
+    mqtt_publish_changed_multiple_payloads(topics_with_payloads)
+
+
+def enqueue_values(account_id, data, stats_updates):
+    """ Validates the values and appends them to ingest_queue; they will be saved by ingest_consumer.py. """
+    Measurement.validate_values_data(data)
+    IngestQueue.enqueue(account_id, data, stats_updates)
+
+
+class ValuesBatcher(object):
+    """
+        Group commit for values which are being written by concurrent requests. Requests submit their values and
+        wait; a background thread collects them for a few milliseconds, writes all of them with a single INSERT
+        and only then resolves the requests' futures - so a request is still only answered after its values were
+        committed.
+
+        Items with invalid values are rejected before the batch is written. If writing the batch still fails, each of
+        the items is written separately, so that a single item doesn't cause the whole batch to fail.
+    """
+    def __init__(self, max_delay_ms, max_rows):
+        self.max_delay = max_delay_ms / 1000.0
+        self.max_rows = max_rows
+        self.queue = queue.Queue()
+        self.thread = ForkSafeThread(self._run, 'values-batcher', on_start=self._reset)
+        self.counters = { 'batches': 0, 'requests': 0, 'rows': 0, 'fallbacks': 0 }
+
+    @property
+    def enabled(self):
+        return self.max_delay > 0 and self.max_rows > 0
+
+    def start(self):
+        self.thread.start()
+
+    def _reset(self):
+        self.queue = queue.Queue()
+
+    def submit(self, account_id, data, stats_updates):
+        """ Returns a concurrent.futures.Future which resolves to the list of newly created paths. """
+        self.start()
+        future = Future()
+        self.queue.put((account_id, data, stats_updates, future))
+        return future
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            n_rows = len(batch[0][1])
+            deadline = time.monotonic() + self.max_delay
+            while n_rows < self.max_rows:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                batch.append(item)
+                n_rows += len(item[1])
+            try:
+                self._write_batch(batch)
+            except:
+                log.exception("Unexpected error while writing a batch of values")
+
+    def _write_batch(self, batch):
+        self.counters['batches'] += 1
+        self.counters['requests'] += len(batch)
+        self.counters['rows'] += sum(len(data) for _, data, _, _ in batch)
+        if len(batch) > 1:
+            batch = self._reject_invalid(batch)
+        if len(batch) > 1:
+            try:
+                results = self._save_batch(batch)
+            except Exception:
+                log.warning(f"Saving a batch of {len(batch)} requests failed, saving them one by one")
+                self.counters['fallbacks'] += 1
+            else:
+                for (_, _, _, future), result in zip(batch, results):
+                    future.set_result(result)
+                return
+
+        for account_id, data, stats_updates, future in batch:
+            try:
+                result = save_values_and_stats(account_id, data, stats_updates)
+            except Exception as ex:
+                future.set_exception(ex)
+            else:
+                future.set_result(result)
+
+    @staticmethod
+    def _reject_invalid(batch):
+        """
+            Fails the items with invalid values and returns the rest. Paths are created (and committed) before the
+            values are written, so if an invalid item failed the batch, the fallback would not report the paths of
+            the other items as newly created anymore.
+        """
+        valid_batch = []
+        for item in batch:
+            try:
+                Measurement.validate_values_data(item[1])
+            except ValidationError as ex:
+                item[3].set_exception(ex)
+            else:
+                valid_batch.append(item)
+        return valid_batch
+
+    @staticmethod
+    def _save_batch(batch):
+        return save_values_and_stats_multiple([(account_id, data, stats_updates) for account_id, data, stats_updates, _ in batch])
+
+
+values_batcher = ValuesBatcher(INGEST_BATCH_MAX_DELAY_MS, INGEST_BATCH_MAX_ROWS)
+
+
+async def save_values_and_stats_batched(account_id, data, stats_updates):
+    """
+        Saves the values and updates account stats, possibly together with values from other concurrent requests.
+        Large requests are written directly, as there is nothing to be gained by batching them.
+    """
+    if not values_batcher.enabled or len(data) >= values_batcher.max_rows:
+        return await ingest_executor.run(save_values_and_stats, account_id, data, stats_updates)
+    db.release_request_connection()
+    return await asyncio.wrap_future(values_batcher.submit(account_id, data, stats_updates))
@@ -302,7 +302,7 @@ def users_bot_crud_delete(user_id: int, auth: AuthenticatedUser = Depends(valida
 def users_bot_token_get(user_id: int, auth: AuthenticatedUser = Depends(validate_user_authentication)):
     # make sure the user who is requesting to see the bot token has every permission that this token has, and
     # also that this user can add the bot:
-    request_user_permissions = Permission.get_list(int(auth.user_id))
+    request_user_permissions = Permission.get_compiled(auth.user_id).permissions
     if not Permission.has_all_permissions(request_user_permissions, user_id):
         raise HTTPException(status_code=403, detail="Not enough permissions to see this bot's token")
     if not Permission.can_grant_permission(request_user_permissions, 'bots', 'POST'):
@@ -1,10 +1,16 @@
 import datetime
 import jwt
+import os
 from passlib.context import CryptContext
 import secrets
+import threading
+import time
 
 from dbutils import db
-from utils import log
+from utils import log, LRUCache
+
+
+JWT_DECODED_CACHE_SIZE = int(os.environ.get('JWT_DECODED_CACHE_SIZE', 10000))
 
 
 class AuthFailedException(Exception):
@@ -28,6 +34,13 @@ class JWT(object):
     TOKEN_CAN_BE_REFRESHED_FOR = 600 # when token expires, how long can it be refreshed for (/refresh/ endpoint)
     PRIVATE_KEY_EXTENDED_VALIDITY = MAX_TOKEN_VALID_FOR + TOKEN_CAN_BE_REFRESHED_FOR + 30  # accept expired keys for some extra time
 
+    # Private keys are only ever added (and removed once they are too old), so we can keep them in memory and only
+    # reload them when we see an unknown key id (created by another worker) or when our newest key expires:
+    key_ring = {}  # key id (str) => (key, use_until)
+    key_ring_lock = threading.Lock()
+    # decoded payloads of (valid) tokens, so that we don't need to verify the same token with every request:
+    decoded_cache = LRUCache(JWT_DECODED_CACHE_SIZE)  # (key id, token) => decoded payload
+
     data = None
     decoded_with_leeway = False
 
@@ -48,6 +61,13 @@ class JWT(object):
             log.info(authorization_header)
             raise AuthFailedException("Invalid Authorization header - missing key id")
         key_id, jwt_token = authorization_header.split(':', 1)
+        jwt_decoded = cls.decoded_cache.get((key_id, jwt_token))
+        if jwt_decoded is not None:
+            if time.time() < jwt_decoded['exp']:
+                return cls(dict(jwt_decoded), False)
+            # expired - decode it again so that leeway is taken into account:
+            cls.decoded_cache.invalidate((key_id, jwt_token))
+
         key = JWT._private_jwt_key_for_decoding(key_id)
         if key is None:
             raise AuthFailedException("Unknown or expired key (key id: {})".format(key_id))
@@ -65,6 +85,8 @@ class JWT(object):
         except Exception as ex:
             raise AuthFailedException("Error decoding JWT token") from ex
 
+        if not decoded_with_leeway and isinstance(jwt_decoded.get('exp'), (int, float)):
+            cls.decoded_cache.set((key_id, jwt_token), dict(jwt_decoded))
         return cls(jwt_decoded, decoded_with_leeway)
 
     def encode_as_authorization_header(self, token_valid_for_s=None):
@@ -82,27 +104,61 @@ class JWT(object):
 
     @classmethod
     def _private_jwt_key_for_decoding(cls, key_id):
-        with db.cursor() as c:
-            c.execute('SELECT key FROM private_jwt_keys WHERE id=%s AND EXTRACT(EPOCH FROM NOW()) < use_until + {};'.format(JWT.PRIVATE_KEY_EXTENDED_VALIDITY,), (key_id,))
-            res = c.fetchone()
-            if not res:
+        key_id = str(key_id)
+        record = cls.key_ring.get(key_id)
+        if record is None:
+            cls._load_key_ring()
+            record = cls.key_ring.get(key_id)
+            if record is None:
                 return None
-            key = res[0]
-            return key
+        key, use_until = record
+        if time.time() >= use_until + JWT.PRIVATE_KEY_EXTENDED_VALIDITY:
+            cls._load_key_ring()  # drop the expired keys
+            return None
+        return key
 
     @classmethod
     def _private_jwt_key_for_encoding(cls):
-        with db.cursor() as c:
-            # fetch the newest private key that is still valid:
-            c.execute('SELECT id, key FROM private_jwt_keys WHERE EXTRACT(EPOCH FROM NOW()) < use_until ORDER BY use_until DESC LIMIT 1;')
-            res = c.fetchone()
-            if not res:
+        res = cls._newest_valid_key()
+        if res is None:
+            # maybe another worker has already created a new key:
+            cls._load_key_ring()
+            res = cls._newest_valid_key()
+        if res is None:
+            with db.cursor() as c:
                 cls._remove_old_jwt_keys()
                 new_key = secrets.token_hex(512 // 8)  # 512 bits
-                c.execute('INSERT INTO private_jwt_keys (key) VALUES (%s) RETURNING id, key;', (new_key,))
-                res = c.fetchone()
-            key_id, key = res
-            return key_id, key
+                c.execute('INSERT INTO private_jwt_keys (key) VALUES (%s) RETURNING id, key, use_until;', (new_key,))
+                key_id, key, use_until = c.fetchone()
+            with cls.key_ring_lock:
+                cls.key_ring[str(key_id)] = (key, float(use_until))
+            res = str(key_id), key
+        return res
+
+    @classmethod
+    def _newest_valid_key(cls):
+        """ Returns (key_id, key) of the newest private key that is still valid, or None. """
+        now = time.time()
+        with cls.key_ring_lock:
+            valid = [(use_until, key_id, key) for key_id, (key, use_until) in cls.key_ring.items() if now < use_until]
+        if not valid:
+            return None
+        _, key_id, key = max(valid)
+        return key_id, key
+
+    @classmethod
+    def _load_key_ring(cls):
+        with db.cursor() as c:
+            c.execute('SELECT id, key, use_until FROM private_jwt_keys WHERE EXTRACT(EPOCH FROM NOW()) < use_until + {};'.format(JWT.PRIVATE_KEY_EXTENDED_VALIDITY,))
+            key_ring = {str(key_id): (key, float(use_until)) for key_id, key, use_until in c}
+        with cls.key_ring_lock:
+            cls.key_ring = key_ring
+
+    @classmethod
+    def clear_cache(cls):
+        with cls.key_ring_lock:
+            cls.key_ring = {}
+        cls.decoded_cache.clear()
 
     @classmethod
     def _remove_old_jwt_keys(cls):
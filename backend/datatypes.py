@@ -1,25 +1,31 @@
+from array import array
+import bisect
 import calendar
 import dns
 from collections import defaultdict
 from datetime import datetime, timezone, timedelta
 from functools import lru_cache
 import io
+import itertools
 import json
 import math
 import os
 import re
+import sys
 import tarfile
+import threading
 import time
 
 from fastapi import HTTPException
 from fastapi.encoders import jsonable_encoder
 import jsonschema
+import psycopg2.errors
 import psycopg2.extras
 import requests
 from slugify import slugify
 
-from dbutils import db
-from utils import log
+from dbutils import db, db_listen, db_notify, IteratorFile, copy_escape, PreparedStatement, TIMESCALE_DB_EPOCH
+from utils import log, LRUCache, ForkSafeThread, ForkSafeThreadPool, lttb_indices
 from validators import (
     DashboardInputs, WidgetSchemaInputs, WidgetsPositionsSchemaInputs, PersonSchemaInputsPOST,
     PersonSchemaInputsPUT, PersonCredentialSchemaInputs, AccountSchemaInputs, PermissionSchemaInputs,
@@ -32,12 +38,40 @@ from auth import Auth
 from const import SYSTEM_PATH_PREFIX, SYSTEM_PATH_INSERTED_COUNT
 
 
+PATH_IDS_CACHE_SIZE = int(os.environ.get('PATH_IDS_CACHE_SIZE', 100000))
+PERMISSIONS_CACHE_SIZE = int(os.environ.get('PERMISSIONS_CACHE_SIZE', 10000))
+BOT_TOKENS_CACHE_SIZE = int(os.environ.get('BOT_TOKENS_CACHE_SIZE', 10000))
+BOT_TOKENS_CACHE_TTL = float(os.environ.get('BOT_TOKENS_CACHE_TTL', 60))  # seconds
+BOT_LAST_LOGIN_FLUSH_INTERVAL = float(os.environ.get('BOT_LAST_LOGIN_FLUSH_INTERVAL', 10))  # seconds
+# Fetching values for many paths (or for a long time range) is split into units which are fetched concurrently, each
+# on its own DB connection. Setting FETCH_PARALLEL_WORKERS to 1 disables this.
+FETCH_PARALLEL_WORKERS = int(os.environ.get('FETCH_PARALLEL_WORKERS', 4))
+FETCH_PATHS_PER_UNIT = int(os.environ.get('FETCH_PATHS_PER_UNIT', 20))
+# raw values are fetched in time slices of (at least) this length - by default the same as TimescaleDB chunk interval:
+FETCH_SLICE_INTERVAL = float(os.environ.get('FETCH_SLICE_INTERVAL', 7 * 24 * 3600))  # seconds
+# If a request could return more than this many values, they are streamed from a server-side cursor (and written to
+# the response as they are read) instead of being fetched (in parallel) into memory:
+FETCH_STREAMING_THRESHOLD = int(os.environ.get('FETCH_STREAMING_THRESHOLD', 10000))
+# Aggregated values which were not yet materialized by TimescaleDB (continuous aggregates) are computed from raw values
+# on the fly; materialization watermarks are checked every AGGR_WATERMARK_CHECK_INTERVAL seconds. The views only return
+# materialized buckets (see migration_step_33()), so if this is disabled the latest buckets are missing until the next
+# refresh:
+AGGR_REALTIME = os.environ.get('AGGR_REALTIME', 'true').lower() in ['true', 'yes', 'on', '1']
+AGGR_WATERMARK_CHECK_INTERVAL = float(os.environ.get('AGGR_WATERMARK_CHECK_INTERVAL', 10))
+# Aggregated buckets below the watermark don't change anymore (unless values arrive late), so they are cached in memory
+# (per worker); this is the upper limit of memory (in bytes) used by the cache. Setting it to 0 disables the cache:
+AGGR_CACHE_MAX_BYTES = int(os.environ.get('AGGR_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+
+
 def clear_all_lru_cache():
     # when testing, it is important to clear memoization cache in between runs, or the results will be... interesting.
     # Dashboard.get_id.cache_clear()
-    # Path._get_path_id_from_db.cache_clear()
+    Path.path_ids_cache.clear()
+    Bot.token_cache.clear()
+    Permission.compiled_cache.clear()
+    Measurement.aggr_buckets_cache.clear()
+    Measurement.aggr_cache_late_paths.clear()
     # PathFilter._find_matching_paths_for_filter.cache_clear()
-    pass
 
 
 class ValidationError(HTTPException):
@@ -73,6 +107,11 @@ class PathInputValue(_RegexValidatedInputValue):
     _regex = re.compile(r'^([a-zA-Z0-9_-]|([%](2e|3a)))+([.]([a-zA-Z0-9_-]|([%](2e|3a)))+)*$')
 
 class Path(object):
+    # (account_id, path) => path_id; only paths which exist in DB are cached, and the entries are invalidated (in all
+    # workers) via DB notifications whenever a path is renamed or removed:
+    path_ids_cache = LRUCache(PATH_IDS_CACHE_SIZE)
+    PATHS_CHANGED_CHANNEL = 'paths_changed'
+    PATH_ID_STATEMENT = PreparedStatement('path_id', 'SELECT id FROM paths WHERE account = %s AND path = %s;', ['integer', 'text'], read_only=True)
 
     def __init__(self, path, account_id, force_id=None, newly_created=False):
         self.path = str(PathInputValue(path))
@@ -96,6 +135,60 @@ class Path(object):
             path_id = Path._insert_path_to_db(account_id, path)
             return cls(path, account_id, path_id, newly_created=True)
 
+    @classmethod
+    def forge_from_paths(cls, paths, account_id, allow_system=False):
+        """
+            Bulk version of forge_from_path() (with ensure_in_db=True) - makes sure all the paths exist in DB, using
+            a constant number of queries regardless of the number of paths. Returns a dict which maps each (distinct)
+            path to its Path object, in the order in which paths were first encountered.
+        """
+        paths_objects = {}
+        for path in paths:
+            if path in paths_objects:
+                continue
+            if not allow_system and path.startswith(SYSTEM_PATH_PREFIX):
+                raise ValidationError("Invalid path - should not start with 'system.'!")
+            paths_objects[path] = cls(path, account_id)
+        if not paths_objects:
+            return paths_objects
+
+        generation = Path.path_ids_cache.generation
+        existing_ids = {}
+        for p in paths_objects:
+            path_id = Path.path_ids_cache.get((account_id, p.strip()))
+            if path_id is not None:
+                existing_ids[p] = path_id
+        missing_paths = [p for p in paths_objects if p not in existing_ids]
+        if missing_paths:
+            with db.cursor() as c:
+                existing_ids.update(Path._get_path_ids_from_db(c, account_id, missing_paths))
+                missing_paths = [p for p in missing_paths if p not in existing_ids]
+                if missing_paths:
+                    # another worker might be inserting the same paths at the same time - in this case the conflicting paths are
+                    # not returned by our INSERT, so we look them up again (and we don't report them as newly created):
+                    inserted = psycopg2.extras.execute_values(c,
+                        "INSERT INTO paths (account, path) VALUES %s ON CONFLICT (account, path) DO NOTHING RETURNING path, id;",
+                        [(account_id, p.strip(),) for p in missing_paths], "(%s, %s)", page_size=len(missing_paths), fetch=True)
+                    inserted_ids = dict(inserted)
+                    for p in missing_paths:
+                        if p in inserted_ids:
+                            paths_objects[p].newly_created = True
+                    existing_ids.update(inserted_ids)
+                    conflicting_paths = [p for p in missing_paths if p not in existing_ids]
+                    if conflicting_paths:
+                        existing_ids.update(Path._get_path_ids_from_db(c, account_id, conflicting_paths))
+
+        for p, path_object in paths_objects.items():
+            path_object.force_id = existing_ids[p]
+            Path.path_ids_cache.set((account_id, p.strip()), existing_ids[p], generation)
+        return paths_objects
+
+    @staticmethod
+    def _get_path_ids_from_db(c, account_id, paths):
+        """ Returns a dict (path => path_id) with the paths which already exist in DB. """
+        c.execute('SELECT path, id FROM paths WHERE account = %s AND path = ANY(%s);', (account_id, [p.strip() for p in paths],))
+        return dict(c.fetchall())
+
     @classmethod
     def forge_from_input(cls, json_data, account_id, force_id=None):
         jsonschema.validate(json_data, PathSchemaInputs)
@@ -104,24 +197,60 @@ class Path(object):
         return cls(path, account_id, force_id=force_id)
 
     @staticmethod
-    # The problem with lru_cache: when do we clear it? Any change should invalidate cache, but in multi-worker
-    # setup this means clearing lru_cache in another process. For this reason we disable cache until a better
-    # solution is found.
-    #@lru_cache(maxsize=None)
     def _get_path_id_from_db(account_id, path):
+        path_cleaned = path.strip()
+        path_id = Path.path_ids_cache.get((account_id, path_cleaned))
+        if path_id is not None:
+            return path_id
+
+        # the path might be renamed or removed while we are looking it up - see LRUCache:
+        generation = Path.path_ids_cache.generation
         with db.cursor() as c:
-            path_cleaned = path.strip()
-            c.execute('SELECT id FROM paths WHERE account = %s AND path=%s;', (account_id, path_cleaned,))
+            Path.PATH_ID_STATEMENT.execute(c, (account_id, path_cleaned,))
             res = c.fetchone()
             if not res:
-                # If path record doesn't exist (yet), we avoid lru_cache by throwing an exception. This works
-                # as of Python 3.6 but is not documented behaviour. The tests will warn us if it ever
-                # starts failing.
+                # we never cache the paths which don't exist (yet), otherwise we would need to invalidate the
+                # cache whenever a path is inserted:
                 raise PathNotInDBError()
 
             path_id = res[0]
+            Path.path_ids_cache.set((account_id, path_cleaned), path_id, generation)
             return path_id
 
+    @staticmethod
+    def _get_path_ids(account_id, paths):
+        """ Returns a list of path ids (in the same order as paths), looking up all the uncached ones with a single query. """
+        paths_cleaned = [p.strip() for p in paths]
+        path_ids = {p: Path.path_ids_cache.get((account_id, p)) for p in paths_cleaned}
+        missing_paths = [p for p, path_id in path_ids.items() if path_id is None]
+        if missing_paths:
+            generation = Path.path_ids_cache.generation
+            with db.cursor() as c:
+                found = Path._get_path_ids_from_db(c, account_id, missing_paths)
+            if len(found) < len(missing_paths):
+                raise PathNotInDBError()
+            for p, path_id in found.items():
+                Path.path_ids_cache.set((account_id, p), path_id, generation)
+            path_ids.update(found)
+        return [path_ids[p] for p in paths_cleaned]
+
+    @staticmethod
+    def invalidate_cached_path_id(path_id):
+        """ Removes the path from the cache in this worker - use notify_path_changed() to do it in all of them. """
+        Path.path_ids_cache.invalidate_where(lambda k, v: v == path_id)
+
+    @staticmethod
+    def notify_path_changed(c, path_id):
+        Path.invalidate_cached_path_id(path_id)
+        db_notify(c, Path.PATHS_CHANGED_CHANNEL, str(path_id))
+
+    @staticmethod
+    def _on_paths_changed_notification(payload):
+        if payload is None:
+            Path.path_ids_cache.clear()
+        else:
+            Path.invalidate_cached_path_id(int(payload))
+
     @staticmethod
     def _insert_path_to_db(account_id, path):
         with db.cursor() as c:
@@ -134,14 +263,18 @@ class Path(object):
     @staticmethod
     def get(path_id, account_id):
         with db.cursor() as c:
-            c.execute('SELECT path FROM paths WHERE account = %s AND id = %s;', (account_id, path_id,))
+            c.execute('SELECT p.path, r.first_ts, r.last_ts, r.last_value FROM paths p LEFT JOIN paths_ts_range r ON r.path = p.id WHERE p.account = %s AND p.id = %s;', (account_id, path_id,))
             res = c.fetchone()
             if not res:
                 return None
-            path = res[0]
+            path, first_ts, last_ts, last_value = res
 
+        # the time range of the values lets UI know how far back the data goes (and whether the path is stale):
         return {
             'path': path,
+            't0': None if first_ts is None else first_ts.replace(tzinfo=timezone.utc).timestamp(),
+            't1': None if last_ts is None else last_ts.replace(tzinfo=timezone.utc).timestamp(),
+            'v': None if last_value is None else float(last_value),
         }
 
     def update(self):
@@ -149,18 +282,23 @@ class Path(object):
             return 0
         with db.cursor() as c:
             c.execute("UPDATE paths SET path = %s WHERE id = %s AND account = %s;", (self.path, self.force_id, self.account_id,))
-            # if c.rowcount:
-            #     Path._get_path_id_from_db.cache_clear()
-            return c.rowcount
+            rowcount = c.rowcount
+            if rowcount:
+                Path.notify_path_changed(c, self.force_id)
+            return rowcount
 
     @staticmethod
     def delete(path_id, account_id):
         with db.cursor() as c:
             # delete just the path, "ON DELETE CASCADE" takes care of removing values:
             c.execute("DELETE FROM paths WHERE id = %s AND account = %s;", (path_id, account_id,))
-            # if c.rowcount:
-            #     Path._get_path_id_from_db.cache_clear()
-            return c.rowcount
+            rowcount = c.rowcount
+            if rowcount:
+                Path.notify_path_changed(c, path_id)
+            return rowcount
+
+
+db_listen(Path.PATHS_CHANGED_CHANNEL, Path._on_paths_changed_notification)
 
 
 class PathFilter(_RegexValidatedInputValue):
@@ -169,7 +307,7 @@ class PathFilter(_RegexValidatedInputValue):
     @staticmethod
     def find_matching_paths(account_id, path_filter, limit=200, allow_trailing_chars=False):
         pf_regex = PathFilter._regex_from_filter(path_filter, allow_trailing_chars)
-        with db.cursor() as c:
+        with db.cursor(read_only=True) as c:
             c.execute('SELECT id, path FROM paths WHERE account = %s AND path ~ %s ORDER BY path LIMIT %s;', (account_id, pf_regex, limit + 1,))
             found_paths = [{
                 "id": r[0],
@@ -288,33 +426,356 @@ class EmailAddress(object):
         return self.v
 
 
+class ValuesStream(object):
+    """
+        Iterates over (at most max_records) values of a single path as they are read from DB. One value more than
+        max_records is fetched; if it exists, it is not returned, but it tells the client where to continue from -
+        next_data_point is known once the values were iterated over. Values are dicts, or tuples (t, v[, minv, maxv])
+        if they were fetched with as_tuples=True.
+
+        If max_points is set, the values of the path are collected and downsampled first (see
+        Measurement.downsample()).
+    """
+    def __init__(self, points, max_records, max_points=None):
+        self.points = points
+        self.max_records = max_records
+        self.max_points = max_points
+        self.next_data_point = None
+
+    def __iter__(self):
+        if self.max_points is not None:
+            yield from Measurement.downsample(list(self._iter_points()), self.max_points)
+        else:
+            yield from self._iter_points()
+
+    def _iter_points(self):
+        for n, point in enumerate(self.points):
+            if n == self.max_records:
+                self.next_data_point = point[0] if isinstance(point, tuple) else point['t']
+                return
+            yield point
+
+
+class AggrBuckets(object):
+    """
+        Closed aggregated buckets of a single path which cover the period range [start, end) - timestamps are in
+        seconds since epoch. Instances are never changed once they are in the cache (see Measurement.fetch_data()),
+        values are kept in arrays of doubles to save memory.
+    """
+    __slots__ = ('start', 'end', 'periods', 'averages', 'minimums', 'maximums')
+
+    def __init__(self, start, end, periods=None, averages=None, minimums=None, maximums=None):
+        self.start = start
+        self.end = end
+        self.periods = periods if periods is not None else array('d')
+        self.averages = averages if averages is not None else array('d')
+        self.minimums = minimums if minimums is not None else array('d')
+        self.maximums = maximums if maximums is not None else array('d')
+
+    def extended(self, end, points, move_ts_to_middle_of_interval):
+        """ Returns a copy with ascending points (dicts or tuples) appended, covering the range up to end. """
+        result = AggrBuckets(self.start, end, array('d', self.periods), array('d', self.averages), array('d', self.minimums), array('d', self.maximums))
+        for p in points:
+            if isinstance(p, tuple):
+                t, v, minv, maxv = p
+            else:
+                t, v, minv, maxv = p['t'], p['v'], p['minv'], p['maxv']
+            result.periods.append(t - move_ts_to_middle_of_interval)
+            result.averages.append(v)
+            result.minimums.append(minv)
+            result.maximums.append(maxv)
+        return result
+
+    def points(self, t_from, t_to, should_sort_asc, move_ts_to_middle_of_interval, as_tuples=False):
+        """ Returns the values (dicts or tuples, as they would be fetched from DB) with t_from <= period <= t_to. """
+        first, last = bisect.bisect_left(self.periods, t_from), bisect.bisect_right(self.periods, t_to)
+        indices = range(first, last) if should_sort_asc else range(last - 1, first - 1, -1)
+        if as_tuples:
+            return [(self.periods[i] + move_ts_to_middle_of_interval, self.averages[i], self.minimums[i], self.maximums[i]) for i in indices]
+        return [{'t': self.periods[i] + move_ts_to_middle_of_interval, 'v': self.averages[i], 'minv': self.minimums[i], 'maxv': self.maximums[i]} for i in indices]
+
+    def sizeof(self):
+        return sys.getsizeof(self) + sum(sys.getsizeof(a) for a in (self.periods, self.averages, self.minimums, self.maximums))
+
+
 class Measurement(object):
     AGGR_FACTOR = 3
     MAX_AGGR_LEVEL = 6  # 0 == one point per 1h; 1 == 1 point per 3h; ...; 6 == one point per ~month
     MAX_DATAPOINTS_RETURNED = 100000
+    BULK_INSERT_THRESHOLD = int(os.environ.get('VALUES_BULK_INSERT_THRESHOLD', 1000))  # use COPY when saving this many values at once
+
+    # paths_ts_range holds the first and the last timestamp (and the last value) of each path, so that we don't need
+    # to scan all the chunks of measurements to find them. It is updated by the same statement that writes the values
+    # (rows from source must have unique (path, ts) when ordered by order_by); since the values can arrive out of
+    # order, the range can only be extended:
+    PATHS_TS_RANGE_UPSERT_SQL = """
+        INSERT INTO paths_ts_range (path, first_ts, last_ts, last_value)
+            SELECT DISTINCT ON (path) path, MIN(ts) OVER w, MAX(ts) OVER w, value
+            FROM {source}
+            WINDOW w AS (PARTITION BY path)
+            ORDER BY path, {order_by}
+        ON CONFLICT (path) DO UPDATE SET
+            first_ts = LEAST(paths_ts_range.first_ts, excluded.first_ts),
+            last_ts = GREATEST(paths_ts_range.last_ts, excluded.last_ts),
+            last_value = CASE WHEN excluded.last_ts >= paths_ts_range.last_ts THEN excluded.last_value ELSE paths_ts_range.last_value END
+    """
+    # the hot statements are prepared (see dbutils.PreparedStatement); sort order can't be parametrized, so we
+    # need a statement for each of them:
+    UPSERT_STATEMENT = PreparedStatement('measurements_upsert', """
+        WITH m AS (
+            INSERT INTO measurements (path, ts, value)
+                SELECT * FROM unnest(%s, %s, %s)
+            ON CONFLICT (path, ts) DO UPDATE SET value=excluded.value
+            RETURNING path, ts, value
+        )
+    """ + PATHS_TS_RANGE_UPSERT_SQL.format(source='m', order_by='ts DESC') + ";", ['integer[]', 'timestamp[]', 'numeric[]'])
+    # All the paths are fetched with a single statement; each path has its own t_from and its own limit:
+    FETCH_RAW_STATEMENTS = {
+        sort_order: PreparedStatement(
+            f'measurements_raw_{sort_order.lower()}',
+            f"""
+                SELECT q.idx, m.ts, m.value
+                FROM
+                    unnest(%s, %s) WITH ORDINALITY AS q(path, t_from, idx)
+                    CROSS JOIN LATERAL (
+                        SELECT ts, value
+                        FROM measurements
+                        WHERE path = q.path AND ts >= q.t_from AND ts <= %s
+                        ORDER BY ts {sort_order}
+                        LIMIT %s
+                    ) m
+                ORDER BY q.idx, m.ts {sort_order}
+            """,
+            ['integer[]', 'timestamp[]', 'timestamp', 'bigint'],
+            read_only=True,
+        ) for sort_order in ['ASC', 'DESC']
+    }
+    FETCH_AGGR_STATEMENTS = {
+        (aggr_level, sort_order): PreparedStatement(
+            f'measurements_aggr_{aggr_level}_{sort_order.lower()}',
+            f"""
+                SELECT q.idx, m.period, m.average, m.minimum, m.maximum
+                FROM
+                    unnest(%s, %s) WITH ORDINALITY AS q(path, t_from, idx)
+                    CROSS JOIN LATERAL (
+                        SELECT period, average, minimum, maximum
+                        FROM measurements_aggr_{aggr_level}
+                        WHERE path = q.path AND period >= q.t_from AND period <= %s
+                        ORDER BY period {sort_order}
+                        LIMIT %s
+                    ) m
+                ORDER BY q.idx, m.period {sort_order}
+            """,
+            ['integer[]', 'timestamp[]', 'timestamp', 'bigint'],
+            read_only=True,
+        ) for aggr_level in range(0, MAX_AGGR_LEVEL + 1) for sort_order in ['ASC', 'DESC']
+    }
+    # Continuous aggregates are only materialized up to a watermark (completed threshold) - since the views are
+    # materialized-only (see migration_step_33()), the buckets after it are missing or partial until the next refresh.
+    # These statements take the materialized buckets before the watermark and aggregate the rest from raw measurements
+    # (which must end before the last param - end of t_to's bucket):
+    FETCH_AGGR_REALTIME_STATEMENTS = {
+        (aggr_level, sort_order): PreparedStatement(
+            f'measurements_aggr_{aggr_level}_{sort_order.lower()}_realtime',
+            f"""
+                SELECT q.idx, m.period, m.average, m.minimum, m.maximum
+                FROM
+                    unnest(%s, %s) WITH ORDINALITY AS q(path, t_from, idx)
+                    CROSS JOIN LATERAL (
+                        SELECT period, average, minimum, maximum
+                        FROM (
+                            SELECT period, average, minimum, maximum
+                            FROM measurements_aggr_{aggr_level}
+                            WHERE path = q.path AND period < TIME_BUCKET('{3 ** aggr_level} hour'::interval, %s)
+                            UNION ALL
+                            SELECT TIME_BUCKET('{3 ** aggr_level} hour'::interval, ts) AS period, AVG(value), MIN(value), MAX(value)
+                            FROM measurements
+                            WHERE path = q.path AND ts >= GREATEST(TIME_BUCKET('{3 ** aggr_level} hour'::interval, %s), q.t_from) AND ts < %s
+                            GROUP BY 1
+                        ) a
+                        WHERE period >= q.t_from AND period <= %s
+                        ORDER BY period {sort_order}
+                        LIMIT %s
+                    ) m
+                ORDER BY q.idx, m.period {sort_order}
+            """,
+            ['integer[]', 'timestamp[]', 'timestamp', 'timestamp', 'timestamp', 'timestamp', 'bigint'],
+            read_only=True,
+        ) for aggr_level in range(0, MAX_AGGR_LEVEL + 1) for sort_order in ['ASC', 'DESC']
+    }
+    aggr_watermarks = {}  # aggr_level => datetime up to which the continuous aggregate is materialized
+    aggr_watermarks_checked_at = None
+    aggr_watermarks_lock = threading.Lock()
+    # (path_id, aggr_level) => AggrBuckets:
+    aggr_buckets_cache = LRUCache(AGGR_CACHE_MAX_BYTES, sizeof=AggrBuckets.sizeof)
+    # path_id (None for all of them) => {aggr_level: watermark} - paths which received late values are not cached
+    # again until the watermark advances (until then TimescaleDB might not have re-materialized their buckets yet);
+    # they are forgotten once all the watermarks have advanced:
+    aggr_cache_late_paths = {}
+    aggr_cache_late_paths_lock = threading.Lock()
+    LATE_VALUES_CHANNEL = 'late_values'
 
     @classmethod
     def save_values_data_to_db(cls, account_id, put_data):
+        return cls.save_values_batch_to_db([(account_id, put_data)])[0]
 
-        paths = [Path.forge_from_path(x['p'], account_id, ensure_in_db=True, allow_system=False) for x in put_data]
+    @staticmethod
+    def validate_values_data(put_data):
+        """ Checks the values without saving them, raises ValidationError if they are invalid. """
+        if not isinstance(put_data, list):
+            raise ValidationError("Invalid input format")
+        for x in put_data:
+            try:
+                path, t, v = x['p'], x['t'], x['v']
+            except (KeyError, TypeError):
+                raise ValidationError("Invalid input format")
+            PathInputValue(path)
+            if path.startswith(SYSTEM_PATH_PREFIX):
+                raise ValidationError("Invalid path - should not start with 'system.'!")
+            Timestamp(t)
+            MeasuredValue(v)
+
+    @classmethod
+    def save_values_batch_to_db(cls, batch):
+        """
+            Saves values from multiple (account_id, put_data) items (possibly for different accounts) using a single
+            INSERT. Returns a list of newly created paths for each of the items. Path which was created is reported
+            only with the first item which mentions it.
+        """
+        try:
+            return cls._save_values_batch_to_db(batch)
+        except psycopg2.errors.ForeignKeyViolation:
+            # a path was removed in the meantime (possibly in another worker), but we still had its id cached. The
+            # notification will arrive soon, but we don't want to fail in the meantime, so we retry with fresh ids:
+            account_ids = set(account_id for account_id, _ in batch)
+            Path.path_ids_cache.invalidate_where(lambda k, v: k[0] in account_ids)
+            return cls._save_values_batch_to_db(batch)
+
+    @classmethod
+    def _save_values_batch_to_db(cls, batch):
+        # resolve (and create if needed) all the paths at once, one query per account:
+        paths_by_account = {}
+        for account_id, put_data in batch:
+            paths_by_account.setdefault(account_id, []).extend(x['p'] for x in put_data)
+        paths = {
+            account_id: Path.forge_from_paths(account_paths, account_id, allow_system=False)
+            for account_id, account_paths in paths_by_account.items()
+        }
 
         # to use execute_values, we need an iterator which will feed our data:
-        def _get_data(put_data, paths):
-            for x, path in zip(put_data, paths):
-                yield (
-                    path.force_id,
-                    datetime.utcfromtimestamp(float(Timestamp(x['t']))),
-                    str(MeasuredValue(x['v'])),
-                )
+        def _get_data(batch, paths):
+            for account_id, put_data in batch:
+                for x in put_data:
+                    yield (
+                        paths[account_id][x['p']].force_id,
+                        datetime.utcfromtimestamp(float(Timestamp(x['t']))),
+                        str(MeasuredValue(x['v'])),
+                    )
+
+        data_iterator = _get_data(batch, paths)
+        # values older than the aggregation watermark change the buckets which might be cached:
+        late_path_ids = set()
+        late_before = cls._aggr_cache_horizon()
+        if late_before is not None:
+            data_iterator = cls._track_late_values(data_iterator, datetime.utcfromtimestamp(late_before), late_path_ids)
+
+        with db.cursor() as c:
+            if sum(len(put_data) for _, put_data in batch) >= cls.BULK_INSERT_THRESHOLD:
+                cls._insert_values_bulk(c, data_iterator)
+            else:
+                # the same (path, ts) can't be updated twice within the same statement, so the last value wins (as it
+                # would if the values were sent in separate requests):
+                rows = {(path_id, ts): value for path_id, ts, value in data_iterator}
+                # values are passed as arrays, so that the same (prepared) statement can be used for any number of rows:
+                cls.UPSERT_STATEMENT.execute(c, (
+                    [path_id for path_id, _ in rows],
+                    [ts for _, ts in rows],
+                    list(rows.values()),
+                ))
+            if late_path_ids:
+                cls.notify_late_values(c, late_path_ids)
+
+        result = []
+        reported = set()
+        for account_id, put_data in batch:
+            newly_created_paths = []
+            for x in put_data:
+                p = paths[account_id][x['p']]
+                if p.newly_created and (account_id, p.path) not in reported:
+                    reported.add((account_id, p.path))
+                    newly_created_paths.append(p)
+            result.append(newly_created_paths)
+        return result
 
-        data_iterator = _get_data(put_data, paths)
+    @staticmethod
+    def _track_late_values(data_iterator, late_before, late_path_ids):
+        """ Passes the data through, remembering the ids of paths which have values older than late_before. """
+        for path_id, ts, value in data_iterator:
+            if ts < late_before:
+                late_path_ids.add(path_id)
+            yield path_id, ts, value
 
-        with db.cursor() as c:
-            # https://stackoverflow.com/a/34529505/593487
-            psycopg2.extras.execute_values(c, "INSERT INTO measurements (path, ts, value) VALUES %s ON CONFLICT (path, ts) DO UPDATE SET value=excluded.value", data_iterator, "(%s, %s, %s)", page_size=100)
+    @classmethod
+    def notify_late_values(cls, c, path_ids):
+        """ Invalidates cached aggregated buckets of the paths (in all workers). """
+        cls._invalidate_aggr_buckets(path_ids, c)
+        payload = ','.join(str(path_id) for path_id in sorted(path_ids))
+        # NOTIFY payload must be shorter than 8000 bytes; if there are too many paths, invalidate all of them:
+        db_notify(c, cls.LATE_VALUES_CHANNEL, payload if len(payload) < 7900 else None)
 
-        newly_created_paths = [p for p in paths if p.newly_created]
-        return newly_created_paths
+    @classmethod
+    def _on_late_values_notification(cls, payload):
+        cls._invalidate_aggr_buckets(None if payload is None else [int(x) for x in payload.split(',')])
+
+    @classmethod
+    def _invalidate_aggr_buckets(cls, path_ids, c=None):
+        # the baseline must be read after the late values were written - aggr_watermarks might be older than that,
+        # so a refresh which happened before the write would count as the watermark advancing:
+        watermarks = cls._get_aggr_watermarks_from_db(c)
+        with cls.aggr_cache_late_paths_lock:
+            if path_ids is None:
+                cls.aggr_cache_late_paths[None] = watermarks
+            else:
+                path_ids = set(path_ids)
+                for path_id in path_ids:
+                    cls.aggr_cache_late_paths[path_id] = watermarks
+        if path_ids is None:
+            cls.aggr_buckets_cache.clear()
+        else:
+            cls.aggr_buckets_cache.invalidate_where(lambda k, v: k[0] in path_ids)
+
+    @staticmethod
+    def _insert_values_bulk(c, data_iterator):
+        """
+            Streams the rows to a (temporary, thus not WAL-logged) staging table using COPY, then merges them into
+            measurements with a single INSERT. This is much faster than sending many INSERT statements when there
+            is a lot of data. If the same (path, ts) is present more than once, the last value wins (as it would
+            if the values were sent in separate requests).
+        """
+        def _get_lines(data_iterator):
+            for path_id, ts, value in data_iterator:
+                yield f"{path_id}\t{ts.isoformat()}\t{copy_escape(value)}\n"
+
+        lines_file = IteratorFile(_get_lines(data_iterator))
+        c.execute("BEGIN;")
+        try:
+            c.execute("CREATE TEMPORARY TABLE measurements_staging (seq BIGSERIAL, path INTEGER NOT NULL, ts TIMESTAMP NOT NULL, value NUMERIC NOT NULL) ON COMMIT DROP;")
+            try:
+                c.copy_expert("COPY measurements_staging (path, ts, value) FROM STDIN;", lines_file)
+            except psycopg2.errors.QueryCanceled:
+                if lines_file.exception is not None:
+                    raise lines_file.exception
+                raise
+            c.execute("""
+                INSERT INTO measurements (path, ts, value)
+                    SELECT DISTINCT ON (path, ts) path, ts, value FROM measurements_staging ORDER BY path, ts, seq DESC
+                ON CONFLICT (path, ts) DO UPDATE SET value=excluded.value;
+            """)
+            c.execute(Measurement.PATHS_TS_RANGE_UPSERT_SQL.format(source='measurements_staging', order_by='ts DESC, seq DESC') + ";")
+            c.execute("COMMIT;")
+        except:
+            c.execute("ROLLBACK;")
+            raise
 
     @classmethod
     def get_suggested_aggr_level(cls, t_from, t_to, max_points=100):
@@ -332,64 +793,396 @@ class Measurement(object):
         return cls.MAX_AGGR_LEVEL
 
     @classmethod
-    def fetch_data(cls, account_id, paths, aggr_level, t_froms, t_to, should_sort_asc, max_records):
+    def fetch_data(cls, account_id, paths, aggr_level, t_froms, t_to, should_sort_asc, max_records, max_points=None):
         # t_froms: an array of t_from, one for each path (because the subsequent fetchings usually request a different t_from for each path)
+        str_paths = [str(p) for p in paths]
+        paths_rows = cls._fetch_paths_rows(account_id, str_paths, aggr_level, t_froms, t_to, should_sort_asc, max_records)
+
         paths_data = {}
-        sort_order = 'ASC' if should_sort_asc else 'DESC'  # PgSQL doesn't allow sort order to be parametrized
-        t_to_timestamp = datetime.utcfromtimestamp(float(t_to))
-        with db.cursor() as c:
-            for p, t_from in zip(paths, t_froms):
-                str_p = str(p)
-                path_data = []
-                path_id = Path._get_path_id_from_db(account_id, str_p)
-                t_from_timestamp = datetime.utcfromtimestamp(float(t_from))
-
-                # trick: fetch one result more than is allowed (by MAX_DATAPOINTS_RETURNED) so that we know that the result set is not complete and where the client should continue from
-                if aggr_level is None:  # fetch raw data
-                    c.execute('SELECT ts, value FROM measurements WHERE path = %s AND ts >= %s AND ts <= %s ORDER BY ts ' + sort_order + ' LIMIT %s;', (path_id, t_from_timestamp, t_to_timestamp, max_records + 1,))
-                    for ts, value in c.fetchall():
-                        path_data.append({'t': ts.replace(tzinfo=timezone.utc).timestamp(), 'v': float(value)})
-                else:  # fetch aggregated data
-                    aggr_interval_h = cls.AGGR_FACTOR ** aggr_level
-                    # TimescaleDB quirk: while we could change the offset to `TIMESTAMP '1970-01-01'` for normal SQL queries, we would not be able to create an index for
-                    # such time_bucket, so we must align our buckets with TIMESCALEDB_EPOCH (2000-01-03).
-                    c.execute(f"""
-                        SELECT
-                            period,
-                            average,
-                            minimum,
-                            maximum
-                        FROM
-                            measurements_aggr_{aggr_level}
-                        WHERE
-                            path = %s AND
-                            period >= %s AND
-                            period <= %s
-                        ORDER BY
-                            period {sort_order}
-                    """, (path_id, t_from_timestamp, t_to_timestamp,))
-                    move_ts_to_middle_of_interval = aggr_interval_h * 1800
-                    for ts, vavg, vmin, vmax in c.fetchall():
-                        path_data.append({'t': ts.replace(tzinfo=timezone.utc).timestamp() + move_ts_to_middle_of_interval, 'v': float(vavg), 'minv': float(vmin), 'maxv': float(vmax)})
-
-                # if we have one result too many, eliminate it and set "next_data_point" field:
-                if len(path_data) > max_records:
-                    paths_data[str_p] = {
-                        'next_data_point': path_data[max_records]['t'],
-                        'data': path_data[:max_records],
-                    }
-                else:
-                    paths_data[str_p] = {
-                        'next_data_point': None,
-                        'data': path_data,
-                    }
+        for str_p, path_data in zip(str_paths, paths_rows):
+            # if we have one result too many, eliminate it and set "next_data_point" field:
+            if len(path_data) > max_records:
+                paths_data[str_p] = {
+                    'next_data_point': path_data[max_records]['t'],
+                    'data': cls.downsample(path_data[:max_records], max_points),
+                }
+            else:
+                paths_data[str_p] = {
+                    'next_data_point': None,
+                    'data': cls.downsample(path_data, max_points),
+                }
 
         return paths_data
 
+    @classmethod
+    def iter_data(cls, account_id, paths, aggr_level, t_froms, t_to, should_sort_asc, max_records, as_tuples=False, max_points=None, limit_requested=True):
+        """
+            Returns an iterator over (path, ValuesStream) pairs. Large results are streamed from DB (see
+            stream_data()), smaller ones are fetched (in parallel) first.
+        """
+        if cls.should_stream_data(paths, aggr_level, t_froms, t_to, max_records, limit_requested):
+            return cls.stream_data(account_id, paths, aggr_level, t_froms, t_to, should_sort_asc, max_records, as_tuples, max_points)
+        str_paths = [str(p) for p in paths]
+        paths_rows = cls._fetch_paths_rows(account_id, str_paths, aggr_level, t_froms, t_to, should_sort_asc, max_records, as_tuples)
+        return ((str_p, ValuesStream(path_data, max_records, max_points)) for str_p, path_data in zip(str_paths, paths_rows))
+
+    @classmethod
+    def _fetch_paths_rows(cls, account_id, str_paths, aggr_level, t_froms, t_to, should_sort_asc, max_records, as_tuples=False):
+        """ Returns a list of lists of (at most max_records + 1) values, one for each of the paths. """
+        t_to_timestamp = datetime.utcfromtimestamp(float(t_to))
+        # path ids are looked up on primary (the path might have just been created), but values can be read from replica:
+        path_ids = Path._get_path_ids(account_id, str_paths)
+        t_from_timestamps = [datetime.utcfromtimestamp(float(t_from)) for t_from in t_froms]
+
+        closed_before = cls._aggr_cache_closed_before(aggr_level)
+        if closed_before is None:
+            return cls._fetch_paths_rows_from_db(path_ids, aggr_level, t_from_timestamps, t_to_timestamp, should_sort_asc, max_records, as_tuples)
+        return cls._fetch_paths_rows_cached(path_ids, aggr_level, t_from_timestamps, t_to_timestamp, should_sort_asc, max_records, as_tuples, closed_before)
+
+    @classmethod
+    def _fetch_paths_rows_cached(cls, path_ids, aggr_level, t_from_timestamps, t_to_timestamp, should_sort_asc, max_records, as_tuples, closed_before):
+        """
+            Like _fetch_paths_rows(), but takes aggregated buckets from the cache where possible, so that only the
+            rest of them (usually just the last few) are fetched from DB. Closed buckets (older than closed_before)
+            which were fetched are added to the cache.
+        """
+        move_ts_to_middle_of_interval = cls.AGGR_FACTOR ** aggr_level * 1800
+        bucket_s = cls.AGGR_FACTOR ** aggr_level * 3600
+        t_to_ts = t_to_timestamp.replace(tzinfo=timezone.utc).timestamp()
+        # buckets with period <= t_to were requested, so we know everything up to the start of the next bucket:
+        fetched_up_to = min(closed_before, TIMESCALE_DB_EPOCH + (math.floor((t_to_ts - TIMESCALE_DB_EPOCH) / bucket_s) + 1) * bucket_s)
+
+        entries, cached_points, db_t_from_timestamps = [], [], []
+        for path_id, t_from_timestamp in zip(path_ids, t_from_timestamps):
+            t_from_ts = t_from_timestamp.replace(tzinfo=timezone.utc).timestamp()
+            entry = cls.aggr_buckets_cache.get((path_id, aggr_level))
+            if entry is not None and entry.start <= t_from_ts < entry.end:
+                cached_points.append(entry.points(t_from_ts, t_to_ts, should_sort_asc, move_ts_to_middle_of_interval, as_tuples))
+                db_t_from_timestamps.append(datetime.utcfromtimestamp(entry.end))
+            else:
+                entry = None
+                cached_points.append([])
+                db_t_from_timestamps.append(t_from_timestamp)
+            entries.append(entry)
+
+        # paths which are completely cached don't need to be fetched at all:
+        db_indices = [i for i, t_from_timestamp in enumerate(db_t_from_timestamps) if t_from_timestamp <= t_to_timestamp]
+        db_paths_rows = {}
+        if db_indices:
+            fetched = cls._fetch_paths_rows_from_db(
+                [path_ids[i] for i in db_indices],
+                aggr_level,
+                [db_t_from_timestamps[i] for i in db_indices],
+                t_to_timestamp,
+                should_sort_asc,
+                max_records,
+                as_tuples,
+            )
+            db_paths_rows = dict(zip(db_indices, fetched))
+
+        paths_rows = []
+        for i, path_id in enumerate(path_ids):
+            db_rows = db_paths_rows.get(i, [])
+            rows = cached_points[i] + db_rows if should_sort_asc else db_rows + cached_points[i]
+            paths_rows.append(rows[:max_records + 1])
+
+            # if the result was cut, we don't know whether we have all the buckets:
+            if i not in db_paths_rows or len(db_rows) > max_records or not cls._can_cache_aggr_buckets(path_id, aggr_level):
+                continue
+            closed = [
+                p for p in (db_rows if should_sort_asc else reversed(db_rows))
+                if (p[0] if as_tuples else p['t']) - move_ts_to_middle_of_interval < fetched_up_to
+            ]
+            entry = entries[i]
+            if entry is None:
+                start = db_t_from_timestamps[i].replace(tzinfo=timezone.utc).timestamp()
+                if fetched_up_to > start:
+                    cls.aggr_buckets_cache.set((path_id, aggr_level), AggrBuckets(start, start).extended(fetched_up_to, closed, move_ts_to_middle_of_interval))
+            elif fetched_up_to > entry.end:
+                cls.aggr_buckets_cache.set((path_id, aggr_level), entry.extended(fetched_up_to, closed, move_ts_to_middle_of_interval))
+        return paths_rows
+
+    @classmethod
+    def _fetch_paths_rows_from_db(cls, path_ids, aggr_level, t_from_timestamps, t_to_timestamp, should_sort_asc, max_records, as_tuples=False):
+        # trick: fetch one result more than is allowed (by MAX_DATAPOINTS_RETURNED) so that we know that the result set is not complete and where the client should continue from
+        units = cls._split_fetch_into_units(len(path_ids), aggr_level, t_from_timestamps, t_to_timestamp)
+        groups = {}  # (first, last) => list of (slice_from, slice_to)
+        for first, last, slice_from, slice_to in units:
+            groups.setdefault((first, last), []).append((slice_from, slice_to))
+        if len(groups) == 1:
+            return cls._fetch_slices(path_ids, aggr_level, t_from_timestamps, groups[(0, len(path_ids))], should_sort_asc, max_records + 1, as_tuples)
+
+        # path groups are fetched in parallel, on connections of their own:
+        db.release_request_connection()
+        executor = fetch_executor.get()
+        futures = [
+            executor.submit(
+                cls._fetch_slices,
+                path_ids[first:last],
+                aggr_level,
+                t_from_timestamps[first:last],
+                slices,
+                should_sort_asc,
+                max_records + 1,
+                as_tuples,
+            ) for (first, last), slices in groups.items()
+        ]
+        paths_rows = []
+        for future in futures:
+            paths_rows.extend(future.result())
+        return paths_rows
+
+    @classmethod
+    def _fetch_slices(cls, path_ids, aggr_level, t_from_timestamps, slices, should_sort_asc, limit, as_tuples=False):
+        """
+            Fetches (at most `limit`) values for each of the paths, one time slice after another (in sort order), so
+            that the paths which already have enough values are not fetched from the remaining slices.
+        """
+        paths_rows = [[] for _ in path_ids]
+        for slice_from, slice_to in (slices if should_sort_asc else reversed(slices)):
+            # limit applies to all the paths of a query, so the paths which need the same number of values are
+            # fetched together (usually all of them, unless some path ran out of values in previous slices):
+            remaining = defaultdict(list)  # number of values still needed => path indices
+            for i, rows in enumerate(paths_rows):
+                if len(rows) < limit:
+                    remaining[limit - len(rows)].append(i)
+            if not remaining:
+                break
+            for slice_limit, indices in remaining.items():
+                fetched = cls._fetch_unit(
+                    [path_ids[i] for i in indices],
+                    aggr_level,
+                    [max(t_from_timestamps[i], slice_from) for i in indices],
+                    slice_to,
+                    should_sort_asc,
+                    slice_limit,
+                    as_tuples,
+                )
+                for i, rows in zip(indices, fetched):
+                    paths_rows[i].extend(rows)
+        return paths_rows
+
+    @staticmethod
+    def downsample(points, max_points):
+        """
+            Returns (at most max_points) of the raw values (dicts or tuples), selected with LTTB so that the chart
+            still looks the same. Unlike aggregation, it works with any number of points, not just whole hours.
+        """
+        if max_points is None or len(points) <= max_points:
+            return points
+        if isinstance(points[0], tuple):
+            xs, ys = [p[0] for p in points], [p[1] for p in points]
+        else:
+            xs, ys = [p['t'] for p in points], [p['v'] for p in points]
+        return [points[i] for i in lttb_indices(xs, ys, max_points)]
+
+    @classmethod
+    def should_stream_data(cls, paths, aggr_level, t_froms, t_to, max_records, limit_requested=True):
+        """
+            Returns True if the number of values that could be returned is too big to fetch them into memory. The
+            number of raw values can't be estimated from the time range, so they are only streamed if the client
+            requested a large limit - the default limit (MAX_DATAPOINTS_RETURNED) would cause most of the requests
+            to be streamed, even though they are usually much smaller.
+        """
+        if aggr_level is None:
+            if not limit_requested:
+                return False
+            max_rows = len(paths) * (max_records + 1)
+        else:
+            # the number of aggregated values is limited by the time range too:
+            aggr_interval_s = cls.AGGR_FACTOR ** aggr_level * 3600
+            max_rows = sum(min(max_records + 1, int((float(t_to) - float(t_from)) // aggr_interval_s) + 2) for t_from in t_froms)
+        return max_rows > FETCH_STREAMING_THRESHOLD
+
+    @classmethod
+    def stream_data(cls, account_id, paths, aggr_level, t_froms, t_to, should_sort_asc, max_records, as_tuples=False, max_points=None):
+        """
+            Like fetch_data(), but returns an iterator over (path, ValuesStream) pairs. Values are read from a single
+            server-side cursor as they are consumed, so memory usage doesn't depend on the size of the result. Values
+            of a path must be consumed before moving on to the next path (the skipped ones are lost).
+        """
+        str_paths = [str(p) for p in paths]
+        # path ids are looked up immediately, so that a missing path is reported before we start streaming:
+        path_ids = Path._get_path_ids(account_id, str_paths)
+        t_from_timestamps = [datetime.utcfromtimestamp(float(t_from)) for t_from in t_froms]
+        t_to_timestamp = datetime.utcfromtimestamp(float(t_to))
+        return cls._stream_paths_values(str_paths, path_ids, aggr_level, t_from_timestamps, t_to_timestamp, should_sort_asc, max_records, as_tuples, max_points)
+
+    @classmethod
+    def _stream_paths_values(cls, str_paths, path_ids, aggr_level, t_from_timestamps, t_to_timestamp, should_sort_asc, max_records, as_tuples, max_points):
+        sort_order = 'ASC' if should_sort_asc else 'DESC'
+        if aggr_level is None:
+            statement, params = cls.FETCH_RAW_STATEMENTS[sort_order], (path_ids, t_from_timestamps, t_to_timestamp, max_records + 1,)
+        else:
+            statement, params = cls._aggr_statement_and_params(aggr_level, sort_order, path_ids, t_from_timestamps, t_to_timestamp, max_records + 1)
+        row_to_point = cls._row_to_point_func(aggr_level, as_tuples)
+        with db.streaming_cursor(read_only=True) as c:
+            # server-side cursors can't use prepared statements:
+            c.execute(statement.plain_sql, params)
+            # rows are ordered by path index (1-based), paths without values have no rows:
+            groups = itertools.groupby(c, key=lambda row: row[0])
+            idx, rows = next(groups, (None, None))
+            for i, str_p in enumerate(str_paths, start=1):
+                if idx != i:
+                    yield str_p, ValuesStream(iter(()), max_records, max_points)
+                    continue
+                yield str_p, ValuesStream(map(row_to_point, rows), max_records, max_points)
+                idx, rows = next(groups, (None, None))
+
+    @classmethod
+    def _row_to_point_func(cls, aggr_level, as_tuples=False):
+        """ Returns a function which converts a fetched (idx, ts, value...) row to a value (dict or tuple). """
+        if aggr_level is None:
+            if as_tuples:
+                return lambda row: (row[1].replace(tzinfo=timezone.utc).timestamp(), float(row[2]))
+            return lambda row: {'t': row[1].replace(tzinfo=timezone.utc).timestamp(), 'v': float(row[2])}
+
+        move_ts_to_middle_of_interval = cls.AGGR_FACTOR ** aggr_level * 1800
+        if as_tuples:
+            return lambda row: (row[1].replace(tzinfo=timezone.utc).timestamp() + move_ts_to_middle_of_interval, float(row[2]), float(row[3]), float(row[4]))
+        return lambda row: {'t': row[1].replace(tzinfo=timezone.utc).timestamp() + move_ts_to_middle_of_interval, 'v': float(row[2]), 'minv': float(row[3]), 'maxv': float(row[4])}
+
+    @classmethod
+    def get_aggr_watermark(cls, aggr_level):
+        """
+            Returns the time up to which the continuous aggregate of aggr_level is materialized, or None if it is
+            complete (or if we don't know).
+        """
+        if not AGGR_REALTIME:
+            return None
+        now = time.monotonic()
+        with cls.aggr_watermarks_lock:
+            if cls.aggr_watermarks_checked_at is None or now - cls.aggr_watermarks_checked_at >= AGGR_WATERMARK_CHECK_INTERVAL:
+                cls.aggr_watermarks_checked_at = now
+                cls.aggr_watermarks = cls._get_aggr_watermarks_from_db()
+                cls._forget_aggr_cache_late_paths(cls.aggr_watermarks)
+            return cls.aggr_watermarks.get(aggr_level)
+
+    @classmethod
+    def _get_aggr_watermarks_from_db(cls, c=None):
+        if c is None:
+            # watermarks on replica might lag behind, and then late values would not be noticed (see
+            # _aggr_cache_horizon()):
+            with db.cursor() as c:
+                return cls._get_aggr_watermarks_from_db(c)
+        try:
+            c.execute("SELECT view_name::text, completed_threshold::timestamp FROM timescaledb_information.continuous_aggregate_stats;")
+        except psycopg2.ProgrammingError:
+            # no TimescaleDB (or a version without continuous aggregates) - aggregates are plain views, which are
+            # always up to date:
+            return {}
+        watermarks = {}
+        for view_name, completed_threshold in c.fetchall():
+            m = re.match(r'^(.*\.)?measurements_aggr_([0-9]+)$', view_name)
+            if not m:
+                continue
+            # nothing was materialized yet:
+            watermarks[int(m.group(2))] = completed_threshold if completed_threshold is not None else datetime(1970, 1, 1)
+        return watermarks
+
+    @classmethod
+    def _aggr_cache_closed_before(cls, aggr_level):
+        """
+            Returns the start of the first aggregated bucket (seconds since epoch) which might still change, or None
+            if aggregated buckets can't be cached (we don't know the watermark).
+        """
+        if aggr_level is None or AGGR_CACHE_MAX_BYTES <= 0:
+            return None
+        watermark = cls.get_aggr_watermark(aggr_level)
+        if watermark is None:
+            return None
+        bucket_s = cls.AGGR_FACTOR ** aggr_level * 3600
+        watermark_ts = watermark.replace(tzinfo=timezone.utc).timestamp()
+        return TIMESCALE_DB_EPOCH + math.floor((watermark_ts - TIMESCALE_DB_EPOCH) / bucket_s) * bucket_s
+
+    @classmethod
+    def _aggr_cache_horizon(cls):
+        """ Returns the time (seconds since epoch) before which new values could change the cached buckets. """
+        closed_befores = [cls._aggr_cache_closed_before(aggr_level) for aggr_level in range(0, cls.MAX_AGGR_LEVEL + 1)]
+        closed_befores = [x for x in closed_befores if x is not None]
+        return max(closed_befores) if closed_befores else None
+
+    @classmethod
+    def _can_cache_aggr_buckets(cls, path_id, aggr_level):
+        """ Paths with late values can be cached again once the watermark has moved on since they were received. """
+        watermark = cls.get_aggr_watermark(aggr_level)
+        if watermark is None:
+            return False
+        with cls.aggr_cache_late_paths_lock:
+            for key in (None, path_id):
+                baseline = cls.aggr_cache_late_paths.get(key, {}).get(aggr_level)
+                if baseline is not None and baseline >= watermark:
+                    return False
+        return True
+
+    @classmethod
+    def _forget_aggr_cache_late_paths(cls, watermarks):
+        """ Removes the paths with late values for which all the watermarks have moved on. """
+        with cls.aggr_cache_late_paths_lock:
+            for key, baseline in list(cls.aggr_cache_late_paths.items()):
+                if all(watermarks.get(aggr_level) is None or watermarks[aggr_level] > w for aggr_level, w in baseline.items()):
+                    del cls.aggr_cache_late_paths[key]
+
+    @classmethod
+    def _aggr_statement_and_params(cls, aggr_level, sort_order, path_ids, t_from_timestamps, t_to_timestamp, limit):
+        """ Returns the statement (and its params) which fetches aggregated values, stitched with raw ones if needed. """
+        bucket_end = t_to_timestamp + timedelta(hours=cls.AGGR_FACTOR ** aggr_level)
+        watermark = cls.get_aggr_watermark(aggr_level)
+        if watermark is None or watermark >= bucket_end:
+            return cls.FETCH_AGGR_STATEMENTS[(aggr_level, sort_order)], (path_ids, t_from_timestamps, t_to_timestamp, limit,)
+        return cls.FETCH_AGGR_REALTIME_STATEMENTS[(aggr_level, sort_order)], (path_ids, t_from_timestamps, watermark, watermark, bucket_end, t_to_timestamp, limit,)
+
+    @classmethod
+    def _split_fetch_into_units(cls, n_paths, aggr_level, t_from_timestamps, t_to_timestamp):
+        """
+            Returns a list of (first path index, last path index, slice_from, slice_to) units. Paths are split into
+            groups of FETCH_PATHS_PER_UNIT, which can be fetched independently; long time ranges of raw values are
+            additionally split into slices (at most FETCH_PARALLEL_WORKERS per path group), which are fetched one
+            after another (see _fetch_slices()). Slices are ordered by time within each path group.
+        """
+        if FETCH_PARALLEL_WORKERS <= 1:
+            return [(0, n_paths, min(t_from_timestamps), t_to_timestamp)]
+        groups = [(first, min(first + FETCH_PATHS_PER_UNIT, n_paths)) for first in range(0, n_paths, FETCH_PATHS_PER_UNIT)]
+
+        range_from = min(t_from_timestamps)
+        n_slices = 1
+        if aggr_level is None and t_to_timestamp > range_from:
+            n_slices = min(
+                math.ceil((t_to_timestamp - range_from).total_seconds() / FETCH_SLICE_INTERVAL),
+                max(1, FETCH_PARALLEL_WORKERS // len(groups)),
+            )
+        slice_length = (t_to_timestamp - range_from) / n_slices
+        units = []
+        for first, last in groups:
+            for i in range(n_slices):
+                slice_from = range_from + i * slice_length
+                # ts <= slice_to is inclusive, so the next slice must start after it:
+                slice_to = t_to_timestamp if i == n_slices - 1 else range_from + (i + 1) * slice_length - timedelta(microseconds=1)
+                units.append((first, last, slice_from, slice_to))
+        return units
+
+    @classmethod
+    def _fetch_unit(cls, path_ids, aggr_level, t_from_timestamps, t_to_timestamp, should_sort_asc, limit, as_tuples=False):
+        """ Fetches (at most `limit`) values for each of the paths, returns a list of lists (one for each path). """
+        sort_order = 'ASC' if should_sort_asc else 'DESC'  # PgSQL doesn't allow sort order to be parametrized
+        paths_rows = [[] for _ in path_ids]
+        if aggr_level is None:  # fetch raw data
+            statement, params = cls.FETCH_RAW_STATEMENTS[sort_order], (path_ids, t_from_timestamps, t_to_timestamp, limit,)
+        else:  # fetch aggregated data
+            # TimescaleDB quirk: while we could change the offset to `TIMESTAMP '1970-01-01'` for normal SQL queries, we would not be able to create an index for
+            # such time_bucket, so we must align our buckets with TIMESCALEDB_EPOCH (2000-01-03).
+            statement, params = cls._aggr_statement_and_params(aggr_level, sort_order, path_ids, t_from_timestamps, t_to_timestamp, limit)
+        with db.cursor(read_only=True) as c:
+            statement.execute(c, params)
+            row_to_point = cls._row_to_point_func(aggr_level, as_tuples)
+            for row in c:
+                paths_rows[row[0] - 1].append(row_to_point(row))
+        return paths_rows
+
     @classmethod
     def fetch_topn(cls, account_id, path_filter, ts_to, max_results):
         pf_regex = PathFilter._regex_from_filter(path_filter, allow_trailing_chars=False)
-        with db.cursor() as c, db.cursor() as c2:
+        with db.cursor(read_only=True) as c, db.cursor(read_only=True) as c2:
             # Correct, but slow:
             # """
             #     SELECT m.ts, p.path, m.value
@@ -462,38 +1255,108 @@ class Measurement(object):
 
     @classmethod
     def get_oldest_measurement_time(cls, account_id, paths):
-        path_ids = tuple(Path._get_path_id_from_db(account_id, str(p)) for p in paths)
-        with db.cursor() as c:
-            c.execute('SELECT MIN(ts) FROM measurements WHERE path IN %s;', (path_ids,))
-            res = c.fetchone()
-            if not res:
+        path_ids = Path._get_path_ids(account_id, [str(p) for p in paths])
+        with db.cursor(read_only=True) as c:
+            c.execute('SELECT MIN(first_ts) FROM paths_ts_range WHERE path = ANY(%s);', (path_ids,))
+            ts, = c.fetchone()
+            if ts is None:
                 return None
-            ts = res[0]
             return ts.replace(tzinfo=timezone.utc).timestamp()
 
 
+fetch_executor = ForkSafeThreadPool(FETCH_PARALLEL_WORKERS, 'fetch')
+
+
+db_listen(Measurement.LATE_VALUES_CHANNEL, Measurement._on_late_values_notification)
+
+
 class Stats(object):
     @classmethod
-    def update_account_stats(cls, account_id, stats_updates):
-        with db.cursor() as c:
-            topics_with_payloads = []
-            for k in stats_updates:
-                path = Path.forge_from_path(k, account_id, allow_system=True)
-                t = stats_updates[k]['t']
-                v = stats_updates[k]['v']
-                c.execute("INSERT INTO measurements (path, ts, value) VALUES (%s, %s, %s) ON CONFLICT (path, ts) DO UPDATE SET value = measurements.value + excluded.value RETURNING value;",
-                (
-                    path.force_id,
-                    datetime.utcfromtimestamp(t),
-                    str(MeasuredValue(v)),
-                ))
-                new_value = float(c.fetchone()[0])
-                topics_with_payloads.append((
-                    f'accounts/{account_id}/values/{k}',
-                    { 'v': new_value, 't': t },
-                ))
-            # returns new values in a form which is ready for mqtt_publish_changed_multiple_payloads function:
-            return topics_with_payloads
+    def update_stats_multiple(cls, stats_updates):
+        """
+            Increments account stats counters. Parameter stats_updates is a dict (account_id, path, t) => increment.
+            All counters are updated with a single upsert; new values are returned in a form which is ready for
+            mqtt_publish_changed_multiple_payloads function.
+        """
+        # accounts could have been removed in the meantime, in which case their stats are no longer needed:
+        with db.cursor() as c:
+            c.execute("SELECT id FROM accounts WHERE id = ANY(%s);", (list(set(account_id for account_id, _, _ in stats_updates)),))
+            existing_account_ids = set(account_id for account_id, in c)
+        stats_updates = {k: v for k, v in stats_updates.items() if k[0] in existing_account_ids}
+        if not stats_updates:
+            return []
+
+        paths_by_account = {}
+        for account_id, path, _ in stats_updates:
+            paths_by_account.setdefault(account_id, []).append(path)
+        paths = {
+            account_id: Path.forge_from_paths(account_paths, account_id, allow_system=True)
+            for account_id, account_paths in paths_by_account.items()
+        }
+
+        keys = {}
+        for (account_id, path, t), v in stats_updates.items():
+            keys[(paths[account_id][path].force_id, datetime.utcfromtimestamp(t))] = (account_id, path, t, v)
+        # rows are always locked in the same order, so that concurrent updates (from other workers) can't deadlock:
+        rows = [(path_id, ts, str(MeasuredValue(v))) for (path_id, ts), (_, _, _, v) in sorted(keys.items())]
+        with db.cursor() as c:
+            results = psycopg2.extras.execute_values(c, """
+                WITH m AS (
+                    INSERT INTO measurements (path, ts, value) VALUES %s
+                    ON CONFLICT (path, ts) DO UPDATE SET value = measurements.value + excluded.value
+                    RETURNING path, ts, value
+                ), r AS (
+            """ + Measurement.PATHS_TS_RANGE_UPSERT_SQL.format(source='m', order_by='ts DESC') + """
+                )
+                SELECT path, ts, value FROM m;
+            """, rows, "(%s, %s, %s)", page_size=len(rows), fetch=True)
+
+        new_values = {(path_id, ts): new_value for path_id, ts, new_value in results}
+        topics_with_payloads = []
+        for key, (account_id, path, t, _) in keys.items():
+            topics_with_payloads.append((
+                f'accounts/{account_id}/values/{path}',
+                { 'v': float(new_values[key]), 't': t },
+            ))
+        return topics_with_payloads
+
+
+class IngestQueue(object):
+    """
+        Durable queue of values which were received, but not yet saved to measurements. Values are appended by the
+        API workers and consumed (in large batches) by a separate process - see ingest_consumer.py.
+    """
+    CHANNEL = 'ingest_queue'
+
+    @classmethod
+    def enqueue(cls, account_id, data, stats_updates):
+        with db.cursor() as c:
+            c.execute("INSERT INTO ingest_queue (account, data, stats) VALUES (%s, %s, %s);", (account_id, json.dumps(data), json.dumps(stats_updates),))
+            db_notify(c, cls.CHANNEL, '')
+
+    @staticmethod
+    def dequeue(c, max_items):
+        """
+            Removes (at most max_items) oldest items from the queue and returns them as a list of (account_id,
+            data, stats_updates) tuples. Should be called within a transaction - the items are only really
+            removed when it is committed, and other consumers skip them in the meantime.
+        """
+        c.execute("""
+            DELETE FROM ingest_queue WHERE id IN (
+                SELECT id FROM ingest_queue ORDER BY id LIMIT %s FOR UPDATE SKIP LOCKED
+            ) RETURNING id, account, data, stats;
+        """, (max_items,))
+        return [(account_id, data, stats) for _, account_id, data, stats in sorted(c.fetchall())]
+
+    @staticmethod
+    def get_status():
+        with db.cursor() as c:
+            c.execute("SELECT COUNT(*), EXTRACT(EPOCH FROM NOW() - MIN(created_at)) FROM ingest_queue;")
+            depth, lag = c.fetchone()
+        return {
+            'depth': depth,
+            'lag_s': float(lag) if lag is not None else 0.0,
+        }
 
 
 class Widget(object):
@@ -799,7 +1662,7 @@ class Account(object):
             #   - find specific accounts that users has GET permission for
             can_access_all_accounts = False
             specific_accounts = []
-            for permission in Permission.get_list(user_id):
+            for permission in Permission.get_compiled(user_id).permissions:
                 # we are only interested in GET methods: (or None)
                 if permission['resource_prefix'] is None or permission['resource_prefix'] == 'accounts':
                     can_access_all_accounts = True
@@ -833,9 +1696,58 @@ class Account(object):
             }
 
 
+class CompiledPermissions(object):
+    """
+        User's permissions, compiled into a trie of resource path segments so that access can be checked without
+        querying DB. Each node holds the methods which are allowed for the resource prefix it represents (and
+        everything below it); None means all methods.
+    """
+    ALL_METHODS = None
+
+    class Node(object):
+        __slots__ = ('children', 'methods')
+
+        def __init__(self):
+            self.children = {}
+            self.methods = set()
+
+        def allows(self, method):
+            return self.methods is CompiledPermissions.ALL_METHODS or method in self.methods
+
+    def __init__(self, permissions):
+        self.permissions = permissions  # as returned by Permission.get_list() - should not be modified
+        self.root = CompiledPermissions.Node()
+        for permission in permissions:
+            node = self.root
+            if permission['resource_prefix'] is not None:
+                for segment in permission['resource_prefix'].split('/'):
+                    node = node.children.setdefault(segment, CompiledPermissions.Node())
+            if permission['methods'] is None:
+                node.methods = CompiledPermissions.ALL_METHODS
+            elif node.methods is not CompiledPermissions.ALL_METHODS:
+                node.methods.update(permission['methods'])
+
+    def is_access_allowed(self, resource, method):
+        node = self.root
+        if node.allows(method):
+            return True
+        for segment in resource.split('/'):
+            node = node.children.get(segment)
+            if node is None:
+                return False
+            if node.allows(method):
+                return True
+        return False
+
+
 class Permission(object):
     # some of the resources (endpoints) are accessible to any authenticated user:
     NO_PERMISSION_CHECK_RESOURCES_READ = ["profile", "accounts", "profile/permissions", "bots"]
+    # user_id => CompiledPermissions; entries are invalidated (in all workers) via DB notifications whenever user's
+    # permissions change:
+    compiled_cache = LRUCache(PERMISSIONS_CACHE_SIZE)
+    PERMISSIONS_CHANGED_CHANNEL = 'permissions_changed'
+    LIST_STATEMENT = PreparedStatement('permissions_list', 'SELECT id, user_id, resource_prefix, methods FROM permissions WHERE user_id = %s ORDER BY resource_prefix, id;', ['integer'], read_only=True)
 
     def __init__(self, user_id, resource_prefix, methods):
         self.user_id = user_id
@@ -852,19 +1764,42 @@ class Permission(object):
     def get_list(user_id):
         with db.cursor() as c:
             ret = []
-            c.execute('SELECT id, user_id, resource_prefix, methods FROM permissions WHERE user_id = %s ORDER BY resource_prefix, id;', (user_id,))
+            Permission.LIST_STATEMENT.execute(c, (user_id,))
             for permission_id, user_id, resource_prefix, methods in c:
                 methods_as_list = None if not methods else [m.strip('{ }') for m in methods.split(',')]  # not sure why, but we get what we inserted (string instead of a list)... this is workaround
                 ret.append({'id': permission_id, 'resource_prefix': resource_prefix, 'methods': methods_as_list})
             return ret
 
+    @staticmethod
+    def get_compiled(user_id):
+        user_id = int(user_id)
+        compiled = Permission.compiled_cache.get(user_id)
+        if compiled is None:
+            # if permissions change while we are reading them, the notification might arrive before we are done:
+            generation = Permission.compiled_cache.generation
+            compiled = CompiledPermissions(Permission.get_list(user_id))
+            Permission.compiled_cache.set(user_id, compiled, generation)
+        return compiled
+
+    @staticmethod
+    def notify_permissions_changed(c, user_id):
+        Permission._on_permissions_changed_notification(str(user_id))
+        db_notify(c, Permission.PERMISSIONS_CHANGED_CHANNEL, str(user_id))
+
+    @staticmethod
+    def _on_permissions_changed_notification(payload):
+        if payload is None:
+            Permission.compiled_cache.clear()
+        else:
+            Permission.compiled_cache.invalidate(int(payload))
+
     def insert(self, granting_user_id, skip_checks=False):
         if not skip_checks:
             # make sure user is not granting permissions to themselves:
             if int(granting_user_id) == int(self.user_id):
                 raise AccessDeniedError("Can't grant permissions to yourself")
             # make sure that authenticated user's permissions are a superset of the ones that they wish to grant:
-            granting_user_permissions = Permission.get_list(granting_user_id)
+            granting_user_permissions = Permission.get_compiled(granting_user_id).permissions
             if not Permission.can_grant_permission(granting_user_permissions, self.resource_prefix, self.methods):
                 raise AccessDeniedError("Can't grant permission you don't have")
 
@@ -872,12 +1807,13 @@ class Permission(object):
             methods_array = None if self.methods is None else '{' + ",".join(self.methods) + '}'  # passing the list directly results in integrity error, this is another way - https://stackoverflow.com/a/15073439/593487
             c.execute("INSERT INTO permissions (user_id, resource_prefix, methods) VALUES (%s, %s, %s) RETURNING id;", (self.user_id, self.resource_prefix, methods_array,))
             account_id = c.fetchone()[0]
+            Permission.notify_permissions_changed(c, self.user_id)
             return account_id
 
     @staticmethod
     def has_all_permissions(user_permissions, target_user_id):
         """ Does the user have all the permissions that some other (target) user has? """
-        for target_permission in Permission.get_list(target_user_id):
+        for target_permission in Permission.get_compiled(target_user_id).permissions:
             if not Permission.can_grant_permission(user_permissions, target_permission['resource_prefix'], target_permission['methods']):
                 return False
         return True
@@ -892,18 +1828,8 @@ class Permission(object):
         if method == 'GET' and resource in Permission.NO_PERMISSION_CHECK_RESOURCES_READ:
             return True
 
-        with db.cursor() as c:
-            # with resource_prefix, make sure that it either matches the urls exactly, or that the url continues with '/' + anything (not just anything)
-            c.execute('SELECT id FROM permissions WHERE ' + \
-                '(user_id = %s) AND ' + \
-                "(resource_prefix IS NULL OR resource_prefix = %s OR %s LIKE resource_prefix || '/%%') AND " + \
-                '(methods IS NULL OR %s = ANY(methods));',
-                (user_id, resource, resource, method,))
-            res = c.fetchone()
-            if res:
-                return True
-            else:
-                return False
+        # resource_prefix must either match the resource exactly, or the resource must continue with '/' + anything (not just anything):
+        return Permission.get_compiled(user_id).is_access_allowed(resource, method)
 
     @staticmethod
     def delete(permission_id, user_id, granting_user_id):
@@ -912,6 +1838,8 @@ class Permission(object):
             raise AccessDeniedError("Can't grant permissions to yourself")
         with db.cursor() as c:
             c.execute('DELETE FROM permissions WHERE id = %s AND user_id = %s;', (permission_id, user_id,))
+            if c.rowcount:
+                Permission.notify_permissions_changed(c, user_id)
             return c.rowcount
 
 
@@ -947,6 +1875,9 @@ class Permission(object):
         return False
 
 
+db_listen(Permission.PERMISSIONS_CHANGED_CHANNEL, Permission._on_permissions_changed_notification)
+
+
 class User(object):
     """
         Users can be either persons or bots. Since the permissions system is the same, we are
@@ -978,6 +1909,50 @@ class User(object):
         }
 
 
+class BotLastLogins(object):
+    """
+        Bots authenticate with every request, so updating their last_login each time would mean a steady stream of
+        writes to a tiny table. Instead, we remember the time of the last login in memory and periodically write
+        all of them with a single UPDATE.
+    """
+    def __init__(self, flush_interval):
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self.pending = {}  # user_id => last login time (UTC)
+        self.thread = ForkSafeThread(self._run, 'bot-last-logins')
+
+    def start(self):
+        self.thread.start()
+
+    def record(self, user_id):
+        self.start()
+        with self.lock:
+            self.pending[user_id] = datetime.utcnow()
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        if not pending:
+            return
+        with db.cursor() as c:
+            psycopg2.extras.execute_values(c, """
+                UPDATE bots SET last_login = data.last_login
+                FROM (VALUES %s) AS data (user_id, last_login)
+                WHERE bots.user_id = data.user_id AND (bots.last_login IS NULL OR bots.last_login < data.last_login);
+            """, sorted(pending.items()), "(%s, %s::timestamp)", page_size=len(pending))
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except:
+                log.exception("Error writing bots' last login times")
+
+
+bot_last_logins = BotLastLogins(BOT_LAST_LOGIN_FLUSH_INTERVAL)
+
+
 class Bot(object):
     """
         There are two types of bots, account bots and systemwide bots. Account bots are tied to
@@ -987,6 +1962,12 @@ class Bot(object):
         it uses users_accounts table instead of a special field in bots table. Additionally,
         users_accounts table should be named persons_accounts (and only used for persons).
     """
+    # bot_token => (user_id, valid_until); entries are invalidated (in all workers) via DB notifications when a bot
+    # is removed:
+    token_cache = LRUCache(BOT_TOKENS_CACHE_SIZE)
+    BOTS_CHANGED_CHANNEL = 'bots_changed'
+    TOKEN_STATEMENT = PreparedStatement('bot_token', 'SELECT user_id FROM bots WHERE token = %s;', ['uuid'], read_only=True)
+
     def __init__(self, name, protocol, config, force_account=None, force_id=None):
         self.name = name
         self.protocol = protocol
@@ -1067,6 +2048,9 @@ class Bot(object):
                 if force_account != Bot.get_tied_to_account(user_id):
                     return 0
             c.execute("DELETE FROM users WHERE id = %s AND user_type = 'bot';", (user_id,))  # record from bots will be removed automatically (cascade)
+            if c.rowcount:
+                Bot.notify_bot_changed(c, user_id)
+                Permission.notify_permissions_changed(c, user_id)
             return c.rowcount
 
     @staticmethod
@@ -1131,22 +2115,37 @@ class Bot(object):
         except:
             log.info("Invalid bot token format")
             return None
-        # authenticate against DB:
-        with db.cursor() as c:
-            # instead of just SELECTing the value, update last_login too: (if bot_token is correct of course)
-            # c.execute("SELECT user_id FROM bots WHERE token = %s;", (bot_token,))
-            # this works, but with N requests it becomes performance critical:
-            # c.execute("UPDATE bots SET last_login = CURRENT_TIMESTAMP WHERE token = %s RETURNING user_id;", (bot_token,))
-            c.execute("SELECT user_id, last_login FROM bots WHERE token = %s;", (bot_token,))
-            res = c.fetchone()
-            if not res:
-                log.info("No such bot token")
-                return None
-            user_id, last_login = res
-            # update token only if it needs to be updated:
-            if last_login is None or calendar.timegm(last_login.timetuple()) < time.time() - 10:
-                c.execute("UPDATE bots SET last_login = CURRENT_TIMESTAMP WHERE token = %s;", (bot_token,))
-            return user_id
+
+        cached = Bot.token_cache.get(bot_token)
+        if cached is not None and cached[1] > time.time():
+            user_id = cached[0]
+        else:
+            # authenticate against DB:
+            with db.cursor() as c:
+                Bot.TOKEN_STATEMENT.execute(c, (bot_token,))
+                res = c.fetchone()
+                if not res:
+                    log.info("No such bot token")
+                    return None
+                user_id, = res
+            Bot.token_cache.set(bot_token, (user_id, time.time() + BOT_TOKENS_CACHE_TTL))
+
+        # last_login is not written immediately, see BotLastLogins:
+        bot_last_logins.record(user_id)
+        return user_id
+
+    @staticmethod
+    def notify_bot_changed(c, user_id):
+        Bot._on_bots_changed_notification(str(user_id))
+        db_notify(c, Bot.BOTS_CHANGED_CHANNEL, str(user_id))
+
+    @staticmethod
+    def _on_bots_changed_notification(payload):
+        if payload is None:
+            Bot.token_cache.clear()
+        else:
+            user_id = int(payload)
+            Bot.token_cache.invalidate_where(lambda k, v: v[0] == user_id)
 
     @staticmethod
     def ensure_default_systemwide_bots_exist():
@@ -1170,6 +2169,9 @@ class Bot(object):
             permission.insert(None, skip_checks=True)
 
 
+db_listen(Bot.BOTS_CHANGED_CHANNEL, Bot._on_bots_changed_notification)
+
+
 class Person(object):
     def __init__(self, name, email, username, password, timezone, email_confirmed, force_id=None):
         self.name = name
@@ -1373,6 +2375,8 @@ class Person(object):
     def delete(user_id):
         with db.cursor() as c:
             c.execute("DELETE FROM users WHERE id = %s and user_type = 'person';", (user_id,))  # record from persons will be removed automatically (cascade)
+            if c.rowcount:
+                Permission.notify_permissions_changed(c, user_id)
             return c.rowcount
 
     @staticmethod
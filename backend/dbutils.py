@@ -1,13 +1,19 @@
+from collections import defaultdict
 from contextlib import contextmanager
+import contextvars
+import io
 import os
+import select
 import sys
 import copy
 import json
+import threading
+import time
 import psycopg2
-from psycopg2.pool import ThreadedConnectionPool
-from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+import psycopg2.errors
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT, TRANSACTION_STATUS_IDLE
 
-from utils import log
+from utils import log, ForkSafeThread
 
 
 TIMESCALE_DB_EPOCH = 946857600  # 2000-01-03 00:00:00 GMT, Mon
@@ -17,44 +23,431 @@ class DBConnectionError(Exception):
     pass
 
 
+class DBPoolTimeoutError(DBConnectionError):
+    pass
+
+
+# Each (gunicorn) worker has its own pool, so max. number of DB connections is DB_POOL_MAX_SIZE * number of workers:
+DB_POOL_MIN_SIZE = int(os.environ.get('DB_POOL_MIN_SIZE', 1))
+DB_POOL_MAX_SIZE = int(os.environ.get('DB_POOL_MAX_SIZE', 20))
+# when all the connections are in use, wait (at most DB_POOL_TIMEOUT seconds) for one of them to be returned:
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 10))
+# connections which were idle for longer than this are checked (SELECT 1) before they are used:
+DB_POOL_HEALTH_CHECK_INTERVAL = float(os.environ.get('DB_POOL_HEALTH_CHECK_INTERVAL', 30))
+# When connecting through PgBouncer (transaction pooling), PgBouncer keeps the server connections, so we don't keep
+# idle connections above DB_POOL_MIN_SIZE, and we must not rely on session state (LISTEN, prepared statements,...).
+# DB notifications listener needs a session though, so it can connect directly to Postgres (DB_LISTEN_HOST/PORT):
+DB_PGBOUNCER = os.environ.get('DB_PGBOUNCER', 'false').lower() in ['true', 'yes', 'on', '1']
+# hot statements are prepared once per connection (see PreparedStatement) - unless we are behind PgBouncer:
+DB_PREPARED_STATEMENTS = os.environ.get('DB_PREPARED_STATEMENTS', 'false' if DB_PGBOUNCER else 'true').lower() in ['true', 'yes', 'on', '1']
+# every DB_EXPLAIN_SAMPLE_INTERVAL-th execution of each statement is also EXPLAINed, so that its planning (and, for
+# read-only statements, execution) time is known - see PreparedStatement.stats(). Setting it to 0 disables sampling:
+DB_EXPLAIN_SAMPLE_INTERVAL = int(os.environ.get('DB_EXPLAIN_SAMPLE_INTERVAL', 1000))
+# Optional (streaming) read replica for the heavy read-only queries (fetching values, paths,...), for example
+# "host=replica port=5432 dbname=grafolean user=admin password=admin". If replica lags behind the primary for more
+# than DB_REPLICA_MAX_LAG seconds (or is not available), the queries go to primary instead:
+DB_REPLICA_DSN = os.environ.get('DB_REPLICA_DSN')
+DB_REPLICA_MAX_LAG = float(os.environ.get('DB_REPLICA_MAX_LAG', 30))
+DB_REPLICA_CHECK_INTERVAL = float(os.environ.get('DB_REPLICA_CHECK_INTERVAL', 5))
+# streaming (server-side) cursors fetch the rows from DB in batches of this size:
+DB_STREAMING_ITERSIZE = int(os.environ.get('DB_STREAMING_ITERSIZE', 2000))
+
+
 db_pool = None
+# within a request, all the cursors share the same (lazily acquired) connection - see request_db_connection():
+_request_db_connection = contextvars.ContextVar('request_db_connection', default=None)
 
 
-# https://medium.com/@thegavrikstory/manage-raw-database-connection-pool-in-flask-b11e50cbad3
-@contextmanager
-def get_db_connection():
-    global db_pool
+def _checkout_db_connection():
+    """ Returns a connection from the pool (or None if DB is not available). """
     if db_pool is None:
         db_connect()
+    if db_pool is None:
+        # connecting to DB failed
+        return None
+    conn = None
     try:
-        if db_pool is None:
-            # connecting to DB failed
-            raise DBConnectionError()
         conn = db_pool.getconn()
-        if conn is None:
-            # pool wasn't able to return a valid connection
-            raise DBConnectionError()
-
         conn.autocommit = True
         conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
-    except (DBConnectionError, psycopg2.OperationalError):
+    except DBPoolTimeoutError:
+        log.warning(f"Timeout waiting for a DB connection (pool size: {db_pool.maxconn})")
+        raise
+    except psycopg2.OperationalError as ex:
+        # the other connections in the pool might still be fine, but this one (if we got it) is broken:
+        log.warning(f"Could not get a DB connection: {str(ex).strip()}")
+        if conn is not None:
+            db_pool.putconn(conn, close=True)
+        return None
+    return conn
+
+
+def _return_db_connection(conn):
+    if db_replica is not None and db_replica.putconn(conn):
+        return
+    if db_pool is not None:
+        db_pool.putconn(conn)
+
+
+def _checkout_replica_connection():
+    """ Returns a connection to the read replica, or None if there is no replica or it can't be used right now. """
+    if db_replica is None:
+        return None
+    return db_replica.getconn()
+
+
+class BlockingConnectionPool(object):
+    """
+        Thread-safe connection pool which, unlike psycopg2.pool.ThreadedConnectionPool, waits (up to `timeout` seconds)
+        for a connection to be returned when all `maxconn` connections are in use, instead of failing immediately.
+
+        Connections which were idle for longer than `health_check_interval` seconds are checked before they are handed
+        out, and broken connections are discarded (and replaced by new ones), so that a DB restart doesn't break the
+        whole pool.
+    """
+    def __init__(self, minconn, maxconn, timeout, health_check_interval, keep_idle=True, **connect_params):
+        self.minconn = minconn
+        self.maxconn = max(maxconn, 1)
+        self.timeout = timeout
+        self.health_check_interval = health_check_interval
+        self.keep_idle = keep_idle
+        self.connect_params = connect_params
+        self.cond = threading.Condition()
+        self.pid = os.getpid()
+        self.idle = []  # list of (connection, returned_at), most recently returned last
+        self.in_use = set()
+        self.connecting = 0
+        self.counters = { 'checkouts': 0, 'timeouts': 0, 'connects': 0, 'discarded': 0, 'wait_time_s': 0.0, 'max_wait_time_s': 0.0 }
+        for _ in range(minconn):
+            self.idle.append((self._connect(), time.monotonic()))
+
+    def _connect(self):
+        conn = psycopg2.connect(**self.connect_params)
+        with self.cond:
+            self.counters['connects'] += 1
+        return conn
+
+    @staticmethod
+    def _close(conn):
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    def _check_fork(self):
+        # connections can't be shared with parent process (gunicorn forks workers) - forget them without closing them:
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.idle, self.in_use, self.connecting = [], set(), 0
+
+    def getconn(self):
+        start = time.monotonic()
+        with self.cond:
+            self._check_fork()
+            while True:
+                if self.idle:
+                    conn, returned_at = self.idle.pop()
+                    self.in_use.add(conn)
+                    break
+                if len(self.in_use) + self.connecting < self.maxconn:
+                    conn, returned_at = None, None
+                    self.connecting += 1
+                    break
+                remaining = self.timeout - (time.monotonic() - start)
+                if remaining <= 0:
+                    self.counters['timeouts'] += 1
+                    raise DBPoolTimeoutError()
+                self.cond.wait(remaining)
+
+        try:
+            if conn is not None and not self._is_healthy(conn, returned_at):
+                with self.cond:
+                    self.in_use.discard(conn)
+                    self.counters['discarded'] += 1
+                    self.connecting += 1  # replace it with a new connection
+                self._close(conn)
+                conn = None
+            if conn is None:
+                try:
+                    conn = self._connect()
+                finally:
+                    with self.cond:
+                        self.connecting -= 1
+                        self.cond.notify()
+                with self.cond:
+                    self.in_use.add(conn)
+        finally:
+            wait_time = time.monotonic() - start
+            with self.cond:
+                self.counters['checkouts'] += 1
+                self.counters['wait_time_s'] += wait_time
+                self.counters['max_wait_time_s'] = max(self.counters['max_wait_time_s'], wait_time)
+        return conn
+
+    def _is_healthy(self, conn, returned_at):
+        if conn.closed:
+            return False
+        if time.monotonic() - returned_at < self.health_check_interval:
+            return True
+        try:
+            with conn.cursor() as c:
+                c.execute('SELECT 1;')
+            return True
+        except psycopg2.Error:
+            return False
+
+    def putconn(self, conn, close=False):
+        """ Returns the connection to the pool; with close=True (for broken connections), it is discarded. """
+        with self.cond:
+            self._check_fork()
+            if conn not in self.in_use:
+                # connection from before the fork or before closeall():
+                return
+        if close:
+            self._close(conn)
+        # don't hand out connections which are in the middle of a (failed) transaction:
+        if not conn.closed and conn.info.transaction_status != TRANSACTION_STATUS_IDLE:
+            try:
+                with conn.cursor() as c:
+                    c.execute('ROLLBACK;')
+            except psycopg2.Error:
+                pass
+        if conn.closed or conn.info.transaction_status != TRANSACTION_STATUS_IDLE:
+            with self.cond:
+                self.in_use.discard(conn)
+                self.counters['discarded'] += 1
+                self.cond.notify()
+            self._close(conn)
+            return
+        with self.cond:
+            self.in_use.discard(conn)
+            if self.keep_idle or len(self.idle) < self.minconn:
+                self.idle.append((conn, time.monotonic()))
+                conn = None
+            self.cond.notify()
+        if conn is not None:
+            self._close(conn)
+
+    def closeall(self):
+        with self.cond:
+            self._check_fork()
+            conns = [conn for conn, _ in self.idle] + list(self.in_use)
+            self.idle, self.in_use = [], set()
+            self.cond.notify_all()
+        for conn in conns:
+            self._close(conn)
+
+    def stats(self):
+        with self.cond:
+            return {
+                'min_size': self.minconn,
+                'max_size': self.maxconn,
+                'in_use': len(self.in_use),
+                'idle': len(self.idle),
+                **self.counters,
+            }
+
+
+class ReplicaRouter(object):
+    """
+        Keeps a pool of connections to the read replica and decides whether it can be used. Replication lag is checked
+        (at most every `check_interval` seconds) when the connection is requested; if the lag is too big or replica is
+        not available, getconn() returns None and the caller should use the primary instead.
+    """
+    # if the server is not in recovery, it is not a replica (but it can still be used for reads, e.g. when testing):
+    LAG_QUERY = """
+        SELECT CASE
+            WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+            ELSE EXTRACT(EPOCH FROM NOW() - pg_last_xact_replay_timestamp())
+        END;
+    """
+
+    def __init__(self, dsn, max_lag, check_interval):
+        self.dsn = dsn
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self.lock = threading.Lock()
+        self.pool = None
+        self.usable = False
+        self.lag = None
+        self.last_check = None
+        self.counters = { 'replica_checkouts': 0, 'fallbacks': 0, 'lag_checks': 0 }
+
+    def _get_pool(self):
+        if self.pool is None:
+            self.pool = BlockingConnectionPool(0, DB_POOL_MAX_SIZE, DB_POOL_TIMEOUT, DB_POOL_HEALTH_CHECK_INTERVAL,
+                keep_idle=not DB_PGBOUNCER, connection_factory=DBConnection, dsn=self.dsn,
+                connect_timeout=int(os.environ.get('DB_CONNECT_TIMEOUT', '10')))
+        return self.pool
+
+    def _check_lag(self):
+        """ Returns replication lag in seconds, or None if replica is not available. """
+        pool = self._get_pool()
+        conn = pool.getconn()
+        try:
+            conn.autocommit = True
+            with conn.cursor() as c:
+                c.execute(self.LAG_QUERY)
+                lag = c.fetchone()[0]
+            return None if lag is None else float(lag)
+        finally:
+            pool.putconn(conn)
+
+    def is_usable(self):
+        now = time.monotonic()
+        if self.last_check is not None and now - self.last_check < self.check_interval:
+            return self.usable
+        # only one of the threads checks the lag, the others use the last known state in the meantime:
+        if not self.lock.acquire(blocking=False):
+            return self.usable
         try:
-            if db_pool is not None:
-                db_pool.closeall()
+            self.last_check = now
+            self.counters['lag_checks'] += 1
+            try:
+                self.lag = self._check_lag()
+            except (DBConnectionError, psycopg2.Error) as ex:
+                log.warning(f"Read replica not available: {str(ex).strip()}")
+                self.lag = None
+            usable = self.lag is not None and self.lag <= self.max_lag
+            if usable != self.usable:
+                log.info("Read replica {} (lag: {}s)".format("is in use" if usable else "is not used", self.lag))
+            self.usable = usable
+            return usable
         finally:
-            db_pool = None  # make sure that we reconnect next time
+            self.lock.release()
+
+    def getconn(self):
+        if not self.is_usable():
+            self.counters['fallbacks'] += 1
+            return None
+        conn = None
+        try:
+            conn = self._get_pool().getconn()
+            conn.autocommit = True
+            conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+        except (DBConnectionError, psycopg2.Error) as ex:
+            log.warning(f"Could not get a read replica connection, using primary: {str(ex).strip()}")
+            if conn is not None:
+                self.pool.putconn(conn, close=True)
+            self.usable = False
+            self.counters['fallbacks'] += 1
+            return None
+        self.counters['replica_checkouts'] += 1
+        return conn
+
+    def putconn(self, conn):
+        """ Returns True if the connection was ours (and was returned to the pool). """
+        if self.pool is None or conn not in self.pool.in_use:
+            return False
+        self.pool.putconn(conn)
+        return True
+
+    def stats(self):
+        return {
+            'usable': self.usable,
+            'lag_s': self.lag,
+            'max_lag_s': self.max_lag,
+            'pool': self.pool.stats() if self.pool is not None else None,
+            **self.counters,
+        }
+
+
+db_replica = ReplicaRouter(DB_REPLICA_DSN, DB_REPLICA_MAX_LAG, DB_REPLICA_CHECK_INTERVAL) if DB_REPLICA_DSN else None
+
+
+class RequestDBConnection(object):
+    """
+        Connection which is shared by all the cursors within a single request (middleware and handler), so that the
+        request only checks out a single connection from the pool (or two, if read replica is used too). It is
+        acquired when it is first needed and returned to the pool when the request is finished, or earlier (see
+        release_request_db_connection()).
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.conn = None
+        self.replica_conn = None
+
+    def get(self, read_only=False):
+        with self.lock:
+            if read_only:
+                if self.replica_conn is not None and self.replica_conn.closed:
+                    conn, self.replica_conn = self.replica_conn, None
+                    _return_db_connection(conn)
+                if self.replica_conn is None:
+                    self.replica_conn = _checkout_replica_connection()
+                if self.replica_conn is not None:
+                    return self.replica_conn
+            if self.conn is not None and self.conn.closed:
+                # connection was lost, get a new one:
+                self.release()
+            if self.conn is None:
+                self.conn = _checkout_db_connection()
+            return self.conn
+
+    def release(self):
+        if self.conn is not None:
+            conn, self.conn = self.conn, None
+            _return_db_connection(conn)
+
+    def release_all(self):
+        self.release()
+        if self.replica_conn is not None:
+            conn, self.replica_conn = self.replica_conn, None
+            _return_db_connection(conn)
+
+
+@contextmanager
+def request_db_connection():
+    """
+        Makes all the db.cursor() calls within this block (including the ones in threads started via
+        run_in_threadpool(), which copies the context) use the same connection.
+    """
+    request_conn = RequestDBConnection()
+    token = _request_db_connection.set(request_conn)
+    try:
+        yield request_conn
+    finally:
+        _request_db_connection.reset(token)
+        with request_conn.lock:
+            request_conn.release_all()
+
+
+def release_request_db_connection():
+    """
+        Returns the connections of the current request (if any) to the pool; they are checked out again if needed.
+        Must be called before waiting for the work which uses connections of its own (parallel fetching, streaming,
+        ingest threads), otherwise concurrent requests could exhaust the pool while each of them holds a connection
+        and waits for another one.
+    """
+    request_conn = _request_db_connection.get()
+    if request_conn is not None:
+        with request_conn.lock:
+            request_conn.release_all()
+
+
+# https://medium.com/@thegavrikstory/manage-raw-database-connection-pool-in-flask-b11e50cbad3
+@contextmanager
+def get_db_connection(read_only=False):
+    request_conn = _request_db_connection.get()
+    if request_conn is not None:
+        yield request_conn.get(read_only)
+        return
+
+    conn = _checkout_replica_connection() if read_only else None
+    if conn is None:
+        conn = _checkout_db_connection()
+    if conn is None:
         yield None
         return
     try:
         yield conn
     finally:
-        if db_pool is not None:
-            db_pool.putconn(conn)
+        _return_db_connection(conn)
 
 
 @contextmanager
-def get_db_cursor():
-    with get_db_connection() as connection:
+def get_db_cursor(read_only=False):
+    with get_db_connection(read_only) as connection:
         if connection is None:
             yield InvalidDBCursor()
             return
@@ -71,6 +464,168 @@ def get_db_cursor():
             cursor.close()
 
 
+@contextmanager
+def get_db_streaming_cursor(read_only=False):
+    """
+        Server-side (named) cursor which fetches the rows in batches of DB_STREAMING_ITERSIZE as they are iterated
+        over, so that the whole result is never held in memory. Such a cursor only exists within a transaction, so it
+        gets a connection of its own (not the request connection) for as long as the results are being read.
+    """
+    release_request_db_connection()
+    conn = _checkout_replica_connection() if read_only else None
+    if conn is None:
+        conn = _checkout_db_connection()
+    if conn is None:
+        yield InvalidDBCursor()
+        return
+
+    try:
+        conn.autocommit = False
+        cursor = conn.cursor(name=f'stream_{id(conn)}')
+        cursor.itersize = DB_STREAMING_ITERSIZE
+        try:
+            yield cursor
+        finally:
+            if not conn.closed:
+                # closing the cursor fails if the transaction failed, but rollback cleans it up anyway:
+                try:
+                    cursor.close()
+                except psycopg2.Error:
+                    pass
+                conn.rollback()
+                conn.autocommit = True
+    finally:
+        _return_db_connection(conn)
+
+
+class DBConnection(psycopg2.extensions.connection):
+    """ Connection which keeps track of the statements that were prepared on it (they only exist within a session). """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared_statements = set()
+
+
+class PreparedStatement(object):
+    """
+        Statement which is prepared (parsed and analyzed once, and after a few executions also planned only once) on
+        each connection when it is first used there, and then executed by name. SQL uses %s placeholders (and must not
+        contain any other '%'), `param_types` are the SQL types of parameters.
+
+        If prepared statements are disabled (DB_PREPARED_STATEMENTS, PgBouncer), the SQL is simply executed.
+
+        Statements which don't write anything should be marked as `read_only`, so that they can be sampled with
+        EXPLAIN ANALYZE (which executes them).
+    """
+    registry = {}  # name => PreparedStatement
+
+    def __init__(self, name, sql, param_types, read_only=False):
+        self.name = name
+        self.param_types = param_types
+        self.read_only = read_only
+        parts = sql.split('%s')
+        if len(parts) != len(param_types) + 1:
+            raise ValueError(f"Number of placeholders doesn't match the number of param types in statement {name}")
+        self.prepare_sql = 'PREPARE {} ({}) AS {}'.format(name, ', '.join(param_types), ''.join(
+            part + (f'${i + 1}' if i < len(param_types) else '') for i, part in enumerate(parts)
+        ))
+        self.execute_sql = 'EXECUTE {} ({});'.format(name, ', '.join(f'%s::{t}' for t in param_types))
+        self.plain_sql = ''.join(part + (f'%s::{param_types[i]}' if i < len(param_types) else '') for i, part in enumerate(parts))
+        self.lock = threading.Lock()
+        self.counters = { 'prepares': 0, 'executions': 0, 'total_time_ms': 0.0, 'samples': 0, 'planning_ms': 0.0, 'execution_ms': 0.0 }
+        PreparedStatement.registry[name] = self
+
+    def execute(self, c, params):
+        start = time.perf_counter()
+        should_sample = False
+        try:
+            if not DB_PREPARED_STATEMENTS or not isinstance(c.connection, DBConnection):
+                c.execute(self.plain_sql, params)
+                return
+            try:
+                self._execute_prepared(c, params)
+            except (psycopg2.errors.InvalidSqlStatementName, psycopg2.errors.FeatureNotSupported) as ex:
+                # Either someone deallocated the statement, or the tables changed (migration) so that the result type
+                # is different ("cached plan must not change result type"). Prepare the statement again - we can only
+                # do this if we are not within a (now failed) transaction:
+                if c.connection.info.transaction_status != TRANSACTION_STATUS_IDLE:
+                    raise
+                c.connection.prepared_statements.discard(self.name)
+                if isinstance(ex, psycopg2.errors.FeatureNotSupported):
+                    c.execute(f'DEALLOCATE {self.name};')
+                self._execute_prepared(c, params)
+        finally:
+            with self.lock:
+                self.counters['executions'] += 1
+                self.counters['total_time_ms'] += (time.perf_counter() - start) * 1000.0
+                should_sample = DB_EXPLAIN_SAMPLE_INTERVAL > 0 and self.counters['executions'] % DB_EXPLAIN_SAMPLE_INTERVAL == 0
+        if should_sample:
+            self._sample(c, params)
+
+    def _prepare(self, c):
+        if self.name not in c.connection.prepared_statements:
+            c.execute(self.prepare_sql)
+            c.connection.prepared_statements.add(self.name)
+            with self.lock:
+                self.counters['prepares'] += 1
+
+    def _execute_prepared(self, c, params):
+        self._prepare(c)
+        c.execute(self.execute_sql, params)
+
+    def _sample(self, c, params):
+        # a separate cursor is used so that the results of the execution are still there for the caller; within a
+        # transaction a failed EXPLAIN would abort it, so we only sample outside of them:
+        if c.connection.info.transaction_status != TRANSACTION_STATUS_IDLE:
+            return
+        try:
+            with c.connection.cursor() as explain_cursor:
+                explained = self.explain(explain_cursor, params, prepared=DB_PREPARED_STATEMENTS and isinstance(c.connection, DBConnection))
+        except psycopg2.Error as ex:
+            log.warning(f"Could not explain statement {self.name}: {str(ex).strip()}")
+            return
+        with self.lock:
+            self.counters['samples'] += 1
+            self.counters['planning_ms'] += explained['planning_ms']
+            self.counters['execution_ms'] += explained['execution_ms'] or 0.0
+
+    def explain(self, c, params, prepared=True):
+        """
+            Returns planning and execution time (in ms) of the statement. Only read-only statements are executed
+            (EXPLAIN ANALYZE), for the others execution_ms is None. Compare the results with prepared=False to see
+            how much time is saved by preparing the statement.
+        """
+        options = 'ANALYZE, SUMMARY, FORMAT JSON' if self.read_only else 'SUMMARY, FORMAT JSON'
+        if prepared:
+            self._prepare(c)
+            c.execute(f'EXPLAIN ({options}) ' + self.execute_sql, params)
+        else:
+            c.execute(f'EXPLAIN ({options}) ' + self.plain_sql, params)
+        result = c.fetchone()[0][0]
+        return {
+            'planning_ms': result['Planning Time'],
+            'execution_ms': result.get('Execution Time'),
+        }
+
+    @classmethod
+    def stats(cls):
+        """ Returns the counters of the executed statements, with average planning and execution time of samples. """
+        result = {}
+        for name, statement in list(cls.registry.items()):
+            with statement.lock:
+                if not statement.counters['executions']:
+                    continue
+                counters = dict(statement.counters)
+            samples = counters.pop('samples')
+            planning_ms, execution_ms = counters.pop('planning_ms'), counters.pop('execution_ms')
+            result[name] = {
+                **counters,
+                'samples': samples,
+                'avg_planning_ms': planning_ms / samples if samples else None,
+                'avg_execution_ms': execution_ms / samples if samples and statement.read_only else None,
+            }
+        return result
+
+
 # In python it is not possible to throw an exception within the __enter__ phase of a with statement:
 #   https://www.python.org/dev/peps/pep-0377/
 # If we want to handle DB connection failures gracefully we return a cursor which will throw
@@ -80,27 +635,39 @@ class InvalidDBCursor(object):
         raise DBConnectionError()
 
 
-def db_connect():
-    global db_pool
-    host, dbname, user, password, connect_timeout = (
+def _db_connection_params(for_listening=False):
+    host, port, dbname, user, password, connect_timeout = (
         os.environ.get('DB_HOST', 'localhost'),
+        int(os.environ.get('DB_PORT', '5432')),
         os.environ.get('DB_DATABASE', 'grafolean'),
         os.environ.get('DB_USERNAME', 'admin'),
         os.environ.get('DB_PASSWORD', 'admin'),
         int(os.environ.get('DB_CONNECT_TIMEOUT', '10'))
     )
+    if for_listening:
+        host = os.environ.get('DB_LISTEN_HOST', host)
+        port = int(os.environ.get('DB_LISTEN_PORT', port))
+    return {
+        'database': dbname,
+        'user': user,
+        'password': password,
+        'host': host,
+        'port': port,
+        'connect_timeout': connect_timeout,
+    }
+
+
+def db_connect():
+    global db_pool
+    params = _db_connection_params()
     try:
-        log.info("Connecting to database, host: [{}], db: [{}], user: [{}]".format(host, dbname, user))
-        db_pool = ThreadedConnectionPool(1, 20,
-                              database=dbname,
-                              user=user,
-                              password=password,
-                              host=host,
-                              port=5432,
-                              connect_timeout=connect_timeout)
+        log.info("Connecting to database, host: [{}], db: [{}], user: [{}]".format(params['host'], params['database'], params['user']))
+        db_pool = BlockingConnectionPool(DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE, DB_POOL_TIMEOUT, DB_POOL_HEALTH_CHECK_INTERVAL, keep_idle=not DB_PGBOUNCER, connection_factory=DBConnection, **params)
     except:
         db_pool = None
         log.error("DB connection failed")
+        return
+    db_listener.start()
 
 
 def db_disconnect():
@@ -112,11 +679,139 @@ def db_disconnect():
     log.info("DB connection is closed")
 
 
+class DBNotificationListener(object):
+    """
+        Listens to Postgres notifications (LISTEN/NOTIFY) on a dedicated connection and dispatches them to registered
+        callbacks. This allows us to invalidate in-process caches in all workers whenever the data they hold changes.
+
+        The callbacks are called from the listener thread, with the payload of the notification. When the listener
+        (re)connects, it calls every callback with payload None, since notifications might have been missed in
+        the meantime - callbacks should clear their caches completely in this case.
+    """
+    POLL_TIMEOUT = 1.0
+    MAX_RECONNECT_DELAY = 30.0
+
+    def __init__(self):
+        self.callbacks = defaultdict(list)
+        self.lock = threading.Lock()
+        self.thread = ForkSafeThread(self._run, 'db-notifications-listener')
+
+    def subscribe(self, channel, callback):
+        with self.lock:
+            self.callbacks[channel].append(callback)
+
+    def start(self):
+        self.thread.start()
+
+    def _dispatch(self, channel, payload):
+        with self.lock:
+            callbacks = list(self.callbacks.get(channel, []))
+        for callback in callbacks:
+            try:
+                callback(payload)
+            except:
+                log.exception(f"Error handling DB notification on channel {channel}")
+
+    def _run(self):
+        reconnect_delay = 1.0
+        while True:
+            conn = None
+            try:
+                conn = psycopg2.connect(**_db_connection_params(for_listening=True))
+                conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+                reconnect_delay = 1.0
+                listening = set()
+                while True:
+                    with self.lock:
+                        channels = set(self.callbacks.keys())
+                    if channels != listening:
+                        with conn.cursor() as c:
+                            for channel in channels - listening:
+                                c.execute(f'LISTEN {channel};')
+                        # we might have missed some notifications before we started listening:
+                        for channel in channels - listening:
+                            self._dispatch(channel, None)
+                        listening = channels
+
+                    if select.select([conn], [], [], self.POLL_TIMEOUT) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        notification = conn.notifies.pop(0)
+                        self._dispatch(notification.channel, notification.payload)
+            except Exception as ex:
+                log.warning(f"DB notifications listener disconnected, reconnecting in {reconnect_delay}s: {str(ex).strip()}")
+            finally:
+                if conn is not None:
+                    conn.close()
+            time.sleep(reconnect_delay)
+            reconnect_delay = min(reconnect_delay * 2, self.MAX_RECONNECT_DELAY)
+
+
+db_listener = DBNotificationListener()
+
+
+def db_listen(channel, callback):
+    """ Registers a callback for notifications on a channel. See DBNotificationListener for details. """
+    db_listener.subscribe(channel, callback)
+
+
+def db_notify(c, channel, payload):
+    """ Notifies all the workers (including this one) that the data has changed. """
+    c.execute('SELECT pg_notify(%s, %s);', (channel, payload,))
+
+
+class IteratorFile(io.TextIOBase):
+    """
+        Read-only file-like object which feeds the strings from an iterator - allows us to stream data to COPY. If
+        the iterator raises an exception, psycopg2 aborts COPY with QueryCanceled - the original exception is kept
+        in `exception` so that the caller can re-raise it.
+    """
+    def __init__(self, iterator):
+        self._iterator = iterator
+        self._buffer = ''
+        self.exception = None
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) < size:
+            try:
+                self._buffer += next(self._iterator)
+            except StopIteration:
+                break
+            except Exception as ex:
+                self.exception = ex
+                raise
+        if size < 0:
+            size = len(self._buffer)
+        chunk, self._buffer = self._buffer[:size], self._buffer[size:]
+        return chunk
+
+
+def copy_escape(value):
+    """ Escapes a value for use in COPY (text format). """
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
 # This class is only needed until we replace all db.cursor() calls with get_db_cursor()
 class ThinDBWrapper(object):
     @staticmethod
-    def cursor():
-        return get_db_cursor()
+    def cursor(read_only=False):
+        """
+            With read_only=True, the cursor might use the read replica (if configured) - use it only for queries which
+            don't write anything and which can tolerate a (slightly) stale data.
+        """
+        return get_db_cursor(read_only)
+
+    @staticmethod
+    def streaming_cursor(read_only=False):
+        return get_db_streaming_cursor(read_only)
+
+    @staticmethod
+    def release_request_connection():
+        release_request_db_connection()
 db = ThinDBWrapper
 
 
@@ -607,3 +1302,50 @@ def migration_step_30():
     """ Persons should be able to select their timezone. """
     with db.cursor() as c:
         c.execute("ALTER TABLE persons ADD COLUMN timezone VARCHAR(64) NOT NULL DEFAULT 'UTC';")
+
+def migration_step_31():
+    """ Add ingest_queue, which holds the values that were received, but not yet saved (when INGEST_MODE=queue). """
+    with db.cursor() as c:
+        c.execute("""
+            CREATE TABLE ingest_queue (
+                id BIGSERIAL NOT NULL PRIMARY KEY,
+                account INTEGER NOT NULL REFERENCES accounts(id) ON DELETE CASCADE,
+                created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+                data JSONB NOT NULL,
+                stats JSONB NOT NULL
+            );
+        """)
+
+def migration_step_32():
+    """
+        Keep the first and last timestamp (and the last value) of each path, so that we don't need to scan all the
+        chunks of measurements to find them.
+    """
+    with db.cursor() as c:
+        c.execute("""
+            CREATE TABLE paths_ts_range (
+                path INTEGER NOT NULL PRIMARY KEY REFERENCES paths(id) ON DELETE CASCADE,
+                first_ts TIMESTAMP NOT NULL,
+                last_ts TIMESTAMP NOT NULL,
+                last_value NUMERIC NOT NULL
+            );
+        """)
+        # two index lookups per path are much cheaper than grouping the whole measurements table:
+        c.execute("""
+            INSERT INTO paths_ts_range (path, first_ts, last_ts, last_value)
+                SELECT p.id, f.ts, l.ts, l.value
+                FROM
+                    paths p
+                    CROSS JOIN LATERAL (SELECT ts FROM measurements WHERE path = p.id ORDER BY ts ASC LIMIT 1) f
+                    CROSS JOIN LATERAL (SELECT ts, value FROM measurements WHERE path = p.id ORDER BY ts DESC LIMIT 1) l;
+        """)
+
+def migration_step_33():
+    """
+        TimescaleDB 1.7 continuous aggregates are real-time by default - the views aggregate the raw values after the
+        materialization watermark on each query. Since we do that ourselves (see Measurement.FETCH_AGGR_REALTIME_STATEMENTS)
+        and only for the paths and intervals requested, views should return just the materialized buckets.
+    """
+    with db.cursor() as c:
+        for aggr_level in range(0, 7):
+            c.execute(f"ALTER VIEW measurements_aggr_{aggr_level} SET (timescaledb.materialized_only = true);")
@@ -10,6 +10,7 @@ from fastapi.middleware import Middleware
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.openapi.docs import get_redoc_html, get_swagger_ui_html, get_swagger_ui_oauth2_redirect_html
 from fastapi.staticfiles import StaticFiles
+from starlette.concurrency import run_in_threadpool
 import jsonschema
 import uvicorn
 
@@ -75,11 +76,13 @@ async def redoc_html():
     )
 
 
-from datatypes import ValidationError, Permission, Bot
+from datatypes import ValidationError, Permission, Bot, bot_last_logins
 import dbutils
 from utils import log
 from auth import JWT, AuthFailedException
 from api import CORS_DOMAINS, accounts_api, admin_api, auth_api, profile_api, users_api, status_api, plugins_api
+from api.common import mqtt_publisher
+from api.ingest import stats_accumulator
 import validators
 
 
@@ -147,7 +150,7 @@ async def grafolean_auth(request: Request, call_next):
             request.state.grafolean_auth['jwt'] = received_jwt
             user_id = received_jwt.data['user_id']
         elif query_params_bot_token is not None:
-            user_id = Bot.authenticate_token(query_params_bot_token)
+            user_id = await run_in_threadpool(Bot.authenticate_token, query_params_bot_token)
             user_is_bot = True
 
         if user_id is None:
@@ -157,7 +160,9 @@ async def grafolean_auth(request: Request, call_next):
         # check permissions:
         resource = request.url.path[len('/api/'):]
         resource = resource.rstrip('/')
-        is_allowed = Permission.is_access_allowed(
+        # check permissions (DB is accessed synchronously, so we do it in a thread to avoid blocking the event loop):
+        is_allowed = await run_in_threadpool(
+            Permission.is_access_allowed,
             user_id=user_id,
             resource=resource,
             method=request.method,
@@ -173,6 +178,8 @@ async def grafolean_auth(request: Request, call_next):
         return Response(status_code=401, content="Access denied")
     except HTTPException:
         raise
+    except dbutils.DBPoolTimeoutError:
+        return Response(status_code=503, content="Service overloaded, please retry", headers={'Retry-After': '1'})
     except:
         log.exception("Exception while checking access rights")
         return Response(status_code=500, content="Could not validate access")
@@ -180,6 +187,15 @@ async def grafolean_auth(request: Request, call_next):
     return await call_next(request)
 
 
+@app.on_event("shutdown")
+def flush_stats():
+    # account stats and bots' last logins are accumulated in memory, don't lose them:
+    stats_accumulator.flush()
+    bot_last_logins.flush()
+    # also give a chance to the queued MQTT notifications to be published:
+    mqtt_publisher.flush(timeout=2.0)
+
+
 # we are nice to the frontend - we allow call to (only) this path, so that if CORS is misconfigured, frontend can advise on proper solution:
 @app.middleware("http")
 async def status_info_no_cors(request: Request, call_next):
@@ -201,6 +217,26 @@ app.add_middleware(
 )
 
 
+class RequestDBConnectionMiddleware(object):
+    """
+        All the DB queries of a request (auth checks in middleware and handler) use a single connection from the pool,
+        which is returned to the pool once the response was sent - or earlier, before the request waits for the work
+        which uses connections of its own or for a (large) body (see dbutils.release_request_db_connection()).
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        with dbutils.request_db_connection():
+            await self.app(scope, receive, send)
+
+
+# must be added last so that it wraps all the other middlewares:
+app.add_middleware(RequestDBConnectionMiddleware)
+
+
 @app.exception_handler(ValidationError)
 @app.exception_handler(jsonschema.exceptions.ValidationError)
 def handle_invalid_usage(request: Request, error: Exception):
@@ -211,6 +247,12 @@ def handle_invalid_usage(request: Request, error: Exception):
     return Response(content='Input validation failed: {}'.format(str_error), status_code=400)
 
 
+@app.exception_handler(dbutils.DBPoolTimeoutError)
+def handle_db_pool_timeout(request: Request, error: Exception):
+    # all DB connections are in use - tell the client to retry instead of failing:
+    return Response(content='Service overloaded, please retry', status_code=503, headers={'Retry-After': '1'})
+
+
 if __name__ == "__main__":
 
     log.info("Starting main")
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+"""
+    Saves the values from ingest_queue to measurements, updates account stats and publishes the changes via MQTT.
+    Values are appended to ingest_queue by the API when INGEST_MODE=queue. Multiple consumers can run at the same
+    time; each queued request is processed by exactly one of them.
+"""
+import os
+import signal
+import sys
+import threading
+import time
+
+from dotenv import load_dotenv
+import psycopg2
+
+
+try:
+    # the same as in grafolean.py, load the environment variables from .env:
+    load_dotenv(os.path.join(os.path.dirname(os.path.abspath(__file__)), '.env'))
+except:
+    pass
+
+
+from api.common import mqtt_publisher
+from api.ingest import publish_values_changes, save_values_and_stats, save_values_and_stats_multiple, stats_accumulator
+from datatypes import IngestQueue, ValidationError
+from dbutils import db, db_listen
+from utils import log
+
+
+INGEST_QUEUE_BATCH_SIZE = int(os.environ.get('INGEST_QUEUE_BATCH_SIZE', 500))  # max. number of queued requests saved together
+INGEST_QUEUE_POLL_INTERVAL = float(os.environ.get('INGEST_QUEUE_POLL_INTERVAL', 5))  # we are woken up by notifications, but check regularly anyway
+ERROR_RETRY_DELAY = 5.0  # doubled after each consecutive error, up to ERROR_RETRY_MAX_DELAY
+ERROR_RETRY_MAX_DELAY = 300.0
+
+
+def consume_batch(max_items):
+    """
+        Saves (at most max_items) queued requests and removes them from the queue. Returns the number of requests
+        processed. If the process crashes after values were saved but before the items are removed, they will be
+        saved again - values are simply overwritten, but stats could be counted twice. The same happens if saving
+        fails for reasons other than the values themselves (DB not available, deadlock,...) - the error is raised
+        and the items are left in the queue.
+    """
+    with db.cursor() as c:
+        c.execute("BEGIN;")
+        try:
+            items = IngestQueue.dequeue(c, max_items)
+            if not items:
+                c.execute("COMMIT;")
+                return 0
+
+            try:
+                results = save_values_and_stats_multiple(items)
+            except Exception:
+                log.exception(f"Saving a batch of {len(items)} queued requests failed, saving them one by one")
+                results = []
+                for account_id, data, stats_updates in items:
+                    try:
+                        results.append(save_values_and_stats(account_id, data, stats_updates))
+                    except (ValidationError, psycopg2.IntegrityError, psycopg2.DataError):
+                        # retrying would not help, these values can never be saved:
+                        log.exception(f"Dropping queued values for account {account_id}")
+                        results.append(None)
+            c.execute("COMMIT;")
+        except:
+            c.execute("ROLLBACK;")
+            raise
+
+    for (account_id, data, _), newly_created_paths in zip(items, results):
+        if newly_created_paths is None:
+            continue
+        try:
+            publish_values_changes(account_id, data, newly_created_paths)
+        except Exception:
+            log.exception("Publishing changes via MQTT failed")
+    return len(items)
+
+
+def main():
+    # make sure that accumulated stats are written when we are stopped:
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        consume_forever()
+    finally:
+        stats_accumulator.flush()
+        mqtt_publisher.flush(timeout=2.0)
+
+
+def consume_forever():
+    wakeup = threading.Event()
+    db_listen(IngestQueue.CHANNEL, lambda payload: wakeup.set())
+    log.info("Ingest consumer started")
+    retry_delay = ERROR_RETRY_DELAY
+    while True:
+        wakeup.clear()
+        try:
+            n_processed = consume_batch(INGEST_QUEUE_BATCH_SIZE)
+        except Exception:
+            log.exception(f"Error consuming ingest queue, retrying in {retry_delay}s")
+            time.sleep(retry_delay)
+            retry_delay = min(retry_delay * 2, ERROR_RETRY_MAX_DELAY)
+            continue
+        retry_delay = ERROR_RETRY_DELAY
+        if n_processed:
+            log.debug(f"Saved {n_processed} queued requests")
+        if n_processed < INGEST_QUEUE_BATCH_SIZE:
+            wakeup.wait(INGEST_QUEUE_POLL_INTERVAL)
+
+
+if __name__ == "__main__":
+    main()
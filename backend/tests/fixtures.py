@@ -22,6 +22,8 @@ os.environ['DB_USERNAME'] = 'pytest'
 os.environ['DB_PASSWORD'] = 'pytest'
 os.environ['MQTT_HOSTNAME'] = 'localhost'
 os.environ['MQTT_PORT'] = '1883'
+# account stats are written only when tests flush them explicitly:
+os.environ['STATS_FLUSH_INTERVAL'] = '3600'
 
 # we need to setup this env var before importing `app` so we can later test CORS headers:
 VALID_FRONTEND_ORIGINS = [
@@ -34,7 +36,9 @@ os.environ['GRAFOLEAN_CORS_DOMAINS'] = ",".join(VALID_FRONTEND_ORIGINS)
 
 
 from grafolean import app
+from api.admin import mqtt_auth_cache
 from api.common import SuperuserJWTToken
+from api.ingest import stats_accumulator
 from dbutils import db, migrate_if_needed
 from utils import log
 from auth import JWT
@@ -74,6 +78,9 @@ def _delete_all_from_db():
     # don't forget to clear memoization cache:
     clear_all_lru_cache()
     SuperuserJWTToken.clear_cache()
+    JWT.clear_cache()
+    mqtt_auth_cache.clear()
+    stats_accumulator.clear()
 
 
 @pytest.fixture
@@ -1,12 +1,21 @@
+import asyncio
+import collections
+import concurrent.futures
 import copy
+import datetime
 import json
+import jwt
 import math
 import os
 import queue
 import re
+import struct
 import sys
+import threading
 import time
+import urllib.parse
 
+import psycopg2.extensions
 import pytest
 
 
@@ -19,10 +28,19 @@ from fixtures import (
     person_authorization_header, mqtt_client_factory, MqttMessage, mqtt_message_queue_factory, mqtt_messages, mqtt_wait_for_message,
 )
 
-from api.common import SuperuserJWTToken
-from dbutils import TIMESCALE_DB_EPOCH
+import api.accounts
+import api.admin
+import api.ingest
+from api.admin import mqtt_auth_cache
+from api.common import MQTTPublisher, SuperuserJWTToken
+from api.ingest import stats_accumulator, values_batcher
+import datatypes
+from datatypes import Bot, IngestQueue, Measurement, Path, Permission, bot_last_logins
+import dbutils
+from dbutils import db, TIMESCALE_DB_EPOCH
 from utils import log
 from auth import JWT
+import ingest_consumer
 
 
 def setup_module():
@@ -121,6 +139,694 @@ def test_values_post_new_path_mqtt(app_client, admin_authorization_header, accou
     j = json.loads(mqtt_message.payload)
     assert j == [{'p': 'qqqq.wwww.asdf', 'id': j[0]["id"] }]
 
+def test_values_put_mqtt_persistent_connection(app_client, admin_authorization_header, account_id, mqtt_messages):
+    """
+        Changes are published via MQTT over a single (persistent) connection.
+    """
+    for i in range(3):
+        data = [{'p': 'qqqq.persistent', 't': 1234567890 + i, 'v': i}]
+        r = app_client.put(f'/api/accounts/{account_id}/values/', json=data, headers={'Authorization': admin_authorization_header})
+        assert r.status_code == 204, r.text
+        mqtt_message = mqtt_wait_for_message(mqtt_messages, [f'changed/accounts/{account_id}/values/qqqq.persistent'])
+        assert json.loads(mqtt_message.payload) == {'t': 1234567890 + i, 'v': i}
+        if i == 0:
+            r = app_client.get('/api/admin/metrics', headers={'Authorization': admin_authorization_header})
+            mqtt_metrics_before = r.json()['mqtt']
+
+    r = app_client.get('/api/admin/metrics', headers={'Authorization': admin_authorization_header})
+    mqtt_metrics = r.json()['mqtt']
+    assert mqtt_metrics['connects'] == mqtt_metrics_before['connects']
+    assert mqtt_metrics['published'] >= mqtt_metrics_before['published'] + 2
+    assert mqtt_metrics['dropped_overflow'] == 0
+    assert mqtt_metrics['circuit_open'] is False
+
+def test_mqtt_publisher_broker_unreachable(app_client, monkeypatch):
+    """
+        When broker is unreachable, publishing doesn't block; messages are buffered (up to a limit) and once the
+        circuit breaker opens, they are dropped.
+    """
+    token_threads = set()
+    get_valid_token = SuperuserJWTToken.get_valid_token
+    def recording_get_valid_token(superuser_identifier):
+        token_threads.add(threading.current_thread())
+        return get_valid_token(superuser_identifier)
+    monkeypatch.setattr(SuperuserJWTToken, 'get_valid_token', recording_get_valid_token)
+    publisher = MQTTPublisher('127.0.0.1', 1, queue_size=2, circuit_breaker_timeout=0.5, max_age=60)
+
+    start = time.monotonic()
+    for i in range(5):
+        publisher.publish([(f'changed/test/{i}', '1')])
+    assert time.monotonic() - start < 0.5
+    stats = publisher.stats()
+    assert stats['circuit_open'] is False
+    # at most 2 messages are buffered (and 1 might be waiting for the connection), the oldest ones are dropped:
+    assert stats['buffered'] == 2
+    assert stats['dropped_overflow'] in [2, 3]
+    assert stats['published'] == 0
+
+    time.sleep(1.5)
+    stats = publisher.stats()
+    assert stats['circuit_open'] is True
+    assert stats['buffered'] == 0
+    assert stats['dropped_overflow'] + stats['dropped_circuit_open'] == 5
+
+    publisher.publish([('changed/test/x', '1')])
+    assert publisher.stats()['dropped_circuit_open'] == stats['dropped_circuit_open'] + 1
+    # credentials (which might need DB) are never obtained by the publishing thread:
+    assert token_threads and threading.current_thread() not in token_threads
+    publisher.client.loop_stop()
+
+def test_values_put_many_paths_mqtt(app_client, admin_authorization_header, account_id, mqtt_messages):
+    """
+        Put values for many paths at once (some existing, some new, some repeated), make sure that only
+        the new paths are reported as created, each of them exactly once.
+    """
+    data = [{'p': 'qqqq.existing', 't': 1234567890, 'v': 1}]
+    r = app_client.put(f'/api/accounts/{account_id}/values/', json=data, headers={'Authorization': admin_authorization_header})
+    assert r.status_code == 204, r.text
+    mqtt_wait_for_message(mqtt_messages, [f'changed/accounts/{account_id}/paths'])
+
+    new_paths = [f'qqqq.new.{i}' for i in range(50)]
+    data = [{'p': p, 't': 1234567890 + j, 'v': j} for p in new_paths + ['qqqq.existing'] for j in range(2)]
+    r = app_client.put(f'/api/accounts/{account_id}/values/', json=data, headers={'Authorization': admin_authorization_header})
+    assert r.status_code == 204, r.text
+
+    mqtt_message = mqtt_wait_for_message(mqtt_messages, [f'changed/accounts/{account_id}/paths'])
+    j = json.loads(mqtt_message.payload)
+    assert [x['p'] for x in j] == new_paths
+    assert len(set(x['id'] for x in j)) == len(new_paths)
+
+    args = {
+        "p": ",".join(['qqqq.existing', 'qqqq.new.0', 'qqqq.new.49']),
+        "t0": 1234567890,
+        "t1": 1234567891,
+    }
+    r = app_client.post(f'/api/accounts/{account_id}/getvalues/', json=args, headers={'Authorization': admin_authorization_header})
+    assert r.status_code == 200, r.text
+    actual = r.json()
+    assert actual['paths']['qqqq.existing']['data'] == [{'t': 1234567890.0, 'v': 0.0}, {'t': 1234567891.0, 'v': 1.0}]
+    assert actual['paths']['qqqq.new.49']['data'] == [{'t': 1234567890.0, 'v': 0.0}, {'t': 1234567891.0, 'v': 1.0}]
+
+def test_values_put_bulk(app_client, admin_authorization_header, account_id, monkeypatch):
+    """
+        Put values in bulk (via COPY), make sure upsert semantics are the same as with normal inserts.
+    """
+    monkeypatch.setattr(Measurement, 'BULK_INSERT_THRESHOLD', 10)
+    data = [{'p': 'qqqq.bulk.1', 't': 1234567890, 'v': 1}]
+    r = app_client.put(f'/api/accounts/{account_id}/values/', json=data, headers={'Authorization': admin_authorization_header})
+    assert r.status_code == 204, r.text
+
+    # the existing value is overwritten, and for duplicates the last value wins:
+    data = [{'p': f'qqqq.bulk.{i % 2}', 't': 1234567890 + i // 2, 'v': i} for i in range(20)]
+    data.append({'p': 'qqqq.bulk.1', 't': 1234567890, 'v': '7.01e-04'})
+    r = app_client.put(f'/api/accounts/{account_id}/values/', json=data, headers={'Authorization': admin_authorization_header})
+    assert r.status_code == 204, r.text
+
+    args = {
+        "p": "qqqq.bulk.0,qqqq.bulk.1",
+        "t0": 1234567890,
+        "t1": 1234567999,
+    }
+    r = app_client.post(f'/api/accounts/{account_id}/getvalues/', json=args, headers={'Authorization': admin_authorization_header})
+    assert r.status_code == 200, r.text
+    actual = r.json()
+    assert actual['paths']['qqqq.bulk.0']['data'] == [{'t': 1234567890.0 + i, 'v': float(2 * i)} for i in range(10)]
+    assert actual['paths']['qqqq.bulk.1']['data'] == [{'t': 1234567890.0, 'v': 0.000701}] + [{'t': 1234567890.0 + i, 'v': float(2 * i + 1)} for i in range(1, 10)]
+
+    # invalid input doesn't save anything:
+    data = [{'p': 'qqqq.bulk.0', 't': 1234567990 + i, 'v': i} for i in range(20)]
+    data[15]['v'] = 'not a number'
+    r = app_client.put(f'/api/accounts/{account_id}/values/', json=data, headers={'Authorization': admin_authorization_header})
+    assert r.status_code == 400, r.text
+    r = app_client.post(f'/api/accounts/{account_id}/getvalues/', json=args, headers={'Authorization': admin_authorization_header})
+    assert len(r.json()['paths']['qqqq.bulk.0']['data']) == 10
+
+def test_values_get_multiple_paths(app_client, admin_authorization_header, account_id):
+    """
+        All paths are fetched with a single query, but each of them has its own t0 and its own limit (and thus its own
+        next_data_point).
+    """
+    data = [{'p': f'qqqq.multi.{i}', 't': 1234567890 + j, 'v': 10 * i + j} for i in range(3) for j in range(5)]
+    r = app_client.put(f'/api/accounts/{account_id}/values/', json=data, headers={'Authorization': admin_authorization_header})
+    assert r.status_code == 204, r.text
+
+    executions_before = Measurement.FETCH_RAW_STATEMENTS['ASC'].counters['executions']
+    args = {
+        "p": "qqqq.multi.0,qqqq.multi.1,qqqq.multi.2",
+        "t0": "1234567890,1234567893,1234567894",
+        "t1": 1234567899,
+        "limit": 2,
+    }
+    r = app_client.post(f'/api/accounts/{account_id}/getvalues/', json=args, headers={'Authorization': admin_authorization_header})
+    assert r.status_code == 200, r.text
+    assert Measurement.FETCH_RAW_STATEMENTS['ASC'].counters['executions'] == executions_before + 1
+    assert r.json()['paths'] == {
+        'qqqq.multi.0': {'next_data_point': 1234567892.0, 'data': [{'t': 1234567890.0, 'v': 0.0}, {'t': 1234567891.0, 'v': 1.0}]},
+        'qqqq.multi.1': {'next_data_point': None, 'data': [{'t': 1234567893.0, 'v': 13.0}, {'t': 1234567894.0, 'v': 14.0}]},
+        'qqqq.multi.2': {'next_data_point': None, 'data': [{'t': 1234567894.0, 'v': 24.0}]},
+    }
+
+    args['sort'] = 'desc'
+    args['t0'] = 1234567890
+    r = app_client.post(f'/api/accounts/{account_id}/getvalues/', json=args, headers={'Authorization': admin_authorization_header})
+    assert r.status_code == 200, r.text
+    assert r.json()['paths']['qqqq.multi.2'] == {'next_data_point': 1234567892.0, 'data': [{'t': 1234567894.0, 'v': 24.0}, {'t': 1234567893.0, 'v': 23.0}]}
+
+@pytest.mark.parametrize("paths_per_unit,slice_interval", [
+    (1, 3600),  # each path is a unit
+    (10, 2),  # single path group, time range split into slices
+    (2, 2),  # both
+])
+def test_values_get_parallel(app_client, admin_authorization_header, account_id, monkeypatch, paths_per_unit, slice_interval):
+    """
+        Values can be fetched in parallel units (groups of paths, time slices); results must be the same as when
+        they are fetched with a single query.
+    """
+    data = [{'p': f'qqqq.parallel.{i}', 't': 1234567890 + j, 'v': 10 * i + j} for i in range(3) for j in range(0, 10 - 2 * i)]
+    r = app_client.put(f'/api/accounts/{account_id}/values/', json=data, headers={'Authorization': admin_authorization_header})
+    assert r.status_code == 204, r.text
+
+    requests_args = [
+        {"p": "qqqq.parallel.0,qqqq.parallel.1,qqqq.parallel.2", "t0": 1234567890, "t1": 1234567899},
+        {"p": "qqqq.parallel.0,qqqq.parallel.1,qqqq.parallel.2", "t0": "1234567891,1234567890,1234567893", "t1": 1234567898, "limit": 3},
+        {"p": "qqqq.parallel.0,qqqq.parallel.1,qqqq.parallel.2", "t0": 1234567890, "t1": 1234567899, "limit": 4, "sort": "desc"},
+        {"p": "qqqq.parallel.2,qqqq.parallel.0", "t0": 1234567890, "t1": 1234567899, "limit": 1, "sort": "desc"},
+    ]
+    monkeypatch.setattr(datatypes, 'FETCH_PARALLEL_WORKERS', 1)
+    expected = []
+    for args in requests_args:
+        r = app_client.post(f'/api/accounts/{account_id}/getvalues/', json=args, headers={'Authorization': admin_authorization_header})
+        assert r.status_code == 200, r.text
+        expected.append(r.json())
+
+    monkeypatch.setattr(datatypes, 'FETCH_PARALLEL_WORKERS', 4)
+    monkeypatch.setattr(datatypes, 'FETCH_PATHS_PER_UNIT', paths_per_unit)
+    monkeypatch.setattr(datatypes, 'FETCH_SLICE_INTERVAL', slice_interval)
+    # no matter how many slices there are, at most limit + 1 values are fetched for each path:
+    fetched_counts = collections.Counter()
+    fetch_unit = Measurement._fetch_unit
+    def counting_fetch_unit(path_ids, *args, **kwargs):
+        paths_rows = fetch_unit(path_ids, *args, **kwargs)
+        fetched_counts.update({path_id: len(rows) for path_id, rows in zip(path_ids, paths_rows)})
+        return paths_rows
+    monkeypatch.setattr(Measurement, '_fetch_unit', counting_fetch_unit)
+    executions_before = Measurement.FETCH_RAW_STATEMENTS['ASC'].counters['executions']
+    for args, expected_result in zip(requests_args, expected):
+        fetched_counts.clear()
+        r = app_client.post(f'/api/accounts/{account_id}/getvalues/', json=args, headers={'Authorization': admin_authorization_header})
+        assert r.status_code == 200, r.text
+        assert r.json() == expected_result
+        assert max(fetched_counts.values(), default=0) <= args.get('limit', Measurement.MAX_DATAPOINTS_RETURNED) + 1
+    assert Measurement.FETCH_RAW_STATEMENTS['ASC'].counters['executions'] - executions_before > 2
+
+@pytest.mark.parametrize("url,args", [
+    ['getvalues', {"p": "qqqq.stream.0,qqqq.stream.1,qqqq.stream.2", "t0": 1234567890, "t1": 1234567899, "limit": 20}],
+    ['getvalues', {"p": "qqqq.stream.0,qqqq.stream.1,qqqq.stream.2", "t0": "1234567891,1234567890,1234567893", "t1": 1234567898, "limit": 3}],
+    ['getvalues', {"p": "qqqq.stream.2,qqqq.stream.0", "t0": 1234567890, "t1": 1234567899, "limit": 4, "sort": "desc"}],
+    ['getaggrvalues', {"p": "qqqq.stream.0,qqqq.stream.1,qqqq.stream.2", "t0": 1234560000, "t1": 1234590000, "a": 0}],
+])
+def test_values_get_streaming(app_client, admin_authorization_header, account_id, monkeypatch, url, args):
+    """
+        Large results are streamed from a server-side cursor; the response must be the same as when the values are
+        fetched into memory, and the connection must be returned to the pool afterwards.
+    """
+    data = [{'p': f'qqqq.stream.{i}', 't': 1234567890 + j, 'v': 10 * i + j} for i in range(3) for j in range(0, 10 - 4 * i)]
+    r = app_client.put(f'/api/accounts/{account_id}/values/', json=data, headers={'Authorization': admin_authorization_header})
+    assert r.status_code == 204, r.text
+
+    monkeypatch.setattr(datatypes, 'FETCH_STREAMING_THRESHOLD', 1000000)
+    r = app_client.post(f'/api/accounts/{account_id}/{url}/', json=args, headers={'Authorization': admin_authorization_header})
+    assert r.status_code == 200, r.text
+    assert 'content-length' in r.headers
+    expected = r.json()
+
+    monkeypatch.setattr(datatypes, 'FETCH_STREAMING_THRESHOLD', 0)
+    monkeypatch.setattr(api.accounts, 'VALUES_JSON_CHUNK_SIZE', 2)
+    r = app_client.post(f'/api/accounts/{account_id}/{url}/', json=args, headers={'Authorization': admin_authorization_header})
+    assert r.status_code == 200, r.text
+    assert 'content-length' not in r.headers
+    assert r.json() == expected
+    assert dbutils.db_pool.stats()['in_use'] == 0
+
+def test_values_get_unlimited_not_streamed(app_client, admin_authorization_header, account_id):
+    """
+        Raw values are only streamed if the client requested a large limit - the default one doesn't tell us anything
+        about the size of the result.
+    """
+    data = [{'p': f'qqqq.unlimited.{i}', 't': 1234567890 + j, 'v': j} for i in range(2) for j in range(10)]
+    r = app_client.put(f'/api/accounts/{account_id}/values/', json=data, headers={'Authorization': admin_authorization_header})
+    assert r.status_code == 204, r.text
+    assert 2 * (Measurement.MAX_DATAPOINTS_RETURNED + 1) > datatypes.FETCH_STREAMING_THRESHOLD
+
+    args = {"p": "qqqq.unlimited.0,qqqq.unlimited.1", "t0": 1234567890, "t1": 1234567899}
+    r = app_client.post(f'/api/accounts/{account_id}/getvalues/', json=args, headers={'Authorization': admin_authorization_header})
+    assert r.status_code == 200, r.text
+    assert 'content-length' in r.headers
+    assert len(r.json()['paths']['qqqq.unlimited.1']['data']) == 10
+
+    args["limit"] = Measurement.MAX_DATAPOINTS_RETURNED
+    r = app_client.post(f'/api/accounts/{account_id}/getvalues/', json=args, headers={'Authorization': admin_authorization_header})
+    assert r.status_code == 200, r.text
+    assert 'content-length' not in r.headers
+
+def _parse_binary_values(content):
+    paths = {}
+    offset = 0
+    while offset < len(content):
+        path_len, = struct.unpack_from('<I', content, offset)
+        offset += 4
+        path = content[offset:offset + path_len].decode('utf-8')
+        offset += path_len
+        n, n_columns, next_data_point = struct.unpack_from('<IId', content, offset)
+        offset += 16
+        columns = []
+        for _ in range(n_columns):
+            columns.append(list(struct.unpack_from(f'<{n}d', content, offset)))
+            offset += 8 * n
+        paths[path] = (None if math.isnan(next_data_point) else next_data_point, columns)
+    return paths
+
+@pytest.mark.parametrize("streaming_threshold", [0, 1000000])
+@pytest.mark.parametrize("url,args", [
+    ['getvalues', {"p": "qqqq.fmt.0,qqqq.fmt.1,qqqq.fmt.2", "t0": "1234567891,1234567890,1234567893", "t1": 1234567898, "limit": 3}],
+    ['getvalues', {"p": "qqqq.fmt.2,qqqq.fmt.0", "t0": 1234567890, "t1": 1234567899, "sort": "desc"}],
+    ['getaggrvalues', {"p": "qqqq.fmt.0,qqqq.fmt.1,qqqq.fmt.2", "t0": 1234560000, "t1": 1234590000, "a": 0}],
+])
+def test_values_get_formats(app_client, admin_authorization_header, account_id, monkeypatch, streaming_threshold, url, args):
+    """
+        Values can be requested (via Accept header) in columnar JSON or in binary format instead of the default JSON.
+    """
+    data = [{'p': f'qqqq.fmt.{i}', 't': 1234567890 + j, 'v': 10 * i + j + 0.5} for i in range(3) for j in range(0, 10 - 2 * i)]
+    r = app_client.put(f'/api/accounts/{account_id}/values/', json=data, headers={'Authorization': admin_authorization_header})
+    assert r.status_code == 204, r.text
+    monkeypatch.setattr(datatypes, 'FETCH_STREAMING_THRESHOLD', streaming_threshold)
+    columns = ['t', 'v'] if url == 'getvalues' else ['t', 'v', 'minv', 'maxv']
+
+    # unsupported formats fall back to JSON:
+    r = app_client.post(f'/api/accounts/{account_id}/{url}/', json=args, headers={'Authorization': admin_authorization_header, 'Accept': 'text/html, */*;q=0.1'})
+    assert r.status_code == 200, r.text
+    assert r.headers['content-type'] == 'application/json'
+    expected = r.json()['paths']
+    assert all(path_data['data'] for path_data in expected.values())
+
+    r = app_client.post(f'/api/accounts/{account_id}/{url}/', json=args, headers={
+        'Authorization': admin_authorization_header,
+        'Accept': 'application/vnd.grafolean.float64le;q=0.5, application/vnd.grafolean.columnar+json',
+    })
+    assert r.status_code == 200, r.text
+    assert r.headers['content-type'] == 'application/vnd.grafolean.columnar+json'
+    assert r.headers['vary'] == 'Accept'
+    assert r.json()['paths'] == {
+        path: {
+            'next_data_point': path_data['next_data_point'],
+            **{c: [point[c] for point in path_data['data']] for c in columns},
+        } for path, path_data in expected.items()
+    }
+
+    r = app_client.post(f'/api/accounts/{account_id}/{url}/', json=args, headers={'Authorization': admin_authorization_header, 'Accept': 'application/vnd.grafolean.float64le'})
+    assert r.status_code == 200, r.text
+    assert r.headers['content-type'] == 'application/vnd.grafolean.float64le'
+    assert _parse_binary_values(r.content) == {
+        path: (path_data['next_data_point'], [[point[c] for point in path_data['data']] for c in columns])
+        for path, path_data in expected.items()
+    }
+
+@pytest.mark.parametrize("streaming_threshold", [0, 1000000])
+def test_values_get_max_points(app_client, admin_authorization_header, account_id, monkeypatch, streaming_threshold):
+    """
+        Raw values can be downsampled (LTTB) to max_points per path; next_data_point is not affected.
+    """
+    data = [{'p': 'qqqq.lttb', 't': 1234567800 + j, 'v': 100 if j == 42 else j % 2} for j in range(100)]
+    r = app_client.put(f'/api/accounts/{account_id}/values/', json=data, headers={'Authorization': admin_authorization_header})
+    assert r.status_code == 204, r.text
+    monkeypatch.setattr(datatypes, 'FETCH_STREAMING_THRESHOLD', streaming_threshold)
+
+    args = {"p": "qqqq.lttb", "t0": 1234567800, "t1": 1234567999, "limit": 90, "max_points": 10}
+    r = app_client.post(f'/api/accounts/{account_id}/getvalues/', json=args, headers={'Authorization': admin_authorization_header})
+    assert r.status_code == 200, r.text
+    path_data = r.json()['paths']['qqqq.lttb']
+    assert path_data['next_data_point'] == 1234567890.0
+    assert len(path_data['data']) == 10
+    assert path_data['data'][0] == {'t': 1234567800.0, 'v': 0.0}
+    assert path_data['data'][-1] == {'t': 1234567889.0, 'v': 1.0}
+    assert {'t': 1234567842.0, 'v': 100.0} in path_data['data']
+
+    r = app_client.post(f'/api/accounts/{account_id}/getvalues/', json=args, headers={'Authorization': admin_authorization_header, 'Accept': 'application/vnd.grafolean.columnar+json'})
+    assert r.status_code == 200, r.text
+    assert r.json()['paths']['qqqq.lttb']['t'] == [d['t'] for d in path_data['data']]
+
+    for invalid_args in [{"max_points": 2}, {"max_points": "abc"}, {"max_points": 10, "a": 0}]:
+        r = app_client.post(f'/api/accounts/{account_id}/{"getaggrvalues" if "a" in invalid_args else "getvalues"}/', json={**args, **invalid_args}, headers={'Authorization': admin_authorization_header})
+        assert r.status_code == 400, r.text
+
+def _materialize_continuous_aggregates():
+    """ Continuous aggregates (if TimescaleDB is used) are normally materialized by background jobs. """
+    with db.cursor() as c:
+        try:
+            c.execute("SELECT view_name::text FROM timescaledb_information.continuous_aggregates;")
+        except psycopg2.ProgrammingError:
+            return
+        for view_name, in c.fetchall():
+            c.execute(f"REFRESH MATERIALIZED VIEW {view_name};")
+
+@pytest.mark.parametrize("streaming_threshold", [0, 1000000])
+@pytest.mark.parametrize("args", [
+    {"a": 0},
+    {"a": 0, "sort": "desc", "limit": 3},
+    {"a": 1, "t0": "1330005600,1330002000"},
+])
+def test_aggrvalues_get_realtime(app_client, admin_authorization_header, account_id, monkeypatch, streaming_threshold, args):
+    """
+        Buckets after the materialization watermark of a continuous aggregate are computed from raw values; the result
+        must be the same as if the aggregate was fully materialized.
+    """
+    t_from = 1330002000  # aligned with TimescaleDB epoch (for 1h and 3h buckets)
+    data = [{'p': f'qqqq.realtime.{i}', 't': t_from + j * 900, 'v': 10 * i + j} for i in range(2) for j in range(40)]
+    r = app_client.put(f'/api/accounts/{account_id}/values/', json=data, headers={'Authorization': admin_authorization_header})
+    assert r.status_code == 204, r.text
+    monkeypatch.setattr(datatypes, 'FETCH_STREAMING_THRESHOLD', streaming_threshold)
+    _materialize_continuous_aggregates()
+    # everything is materialized:
+    monkeypatch.setattr(Measurement, '_get_aggr_watermarks_from_db', classmethod(lambda cls, c=None: {}))
+    monkeypatch.setattr(datatypes, 'AGGR_WATERMARK_CHECK_INTERVAL', 0)
+    monkeypatch.setattr(Measurement, 'aggr_watermarks_checked_at', None)
+
+    args = {"p": "qqqq.realtime.0,qqqq.realtime.1", "t0": t_from, "t1": t_from + 10 * 3600, **args}
+    r = app_client.post(f'/api/accounts/{account_id}/getaggrvalues/', json=args, headers={'Authorization': admin_authorization_header})
+    assert r.status_code == 200, r.text
+    expected = r.json()
+    assert all(len(path_data['data']) > 1 for path_data in expected['paths'].values())
+
+    # the watermark is not necessarily aligned to buckets:
+    realtime_executions = lambda: sum(statement.counters['executions'] for statement in Measurement.FETCH_AGGR_REALTIME_STATEMENTS.values())
+    executions_before = realtime_executions()
+    for watermark in [t_from - 7200, t_from + 2 * 3600 + 1200, t_from + 6 * 3600, t_from + 20 * 3600]:
+        monkeypatch.setattr(Measurement, 'get_aggr_watermark', classmethod(lambda cls, aggr_level: datetime.datetime.utcfromtimestamp(watermark)))
+        r = app_client.post(f'/api/accounts/{account_id}/getaggrvalues/', json=args, headers={'Authorization': admin_authorization_header})
+        assert r.status_code == 200, r.text
+        assert r.json() == expected
+    if streaming_threshold > 0:
+        # the last watermark is after the requested interval, so no raw values were needed:
+        assert realtime_executions() == executions_before + 3
+
+@pytest.mark.parametrize("args", [
+    {"a": 0},
+    {"a": 0, "sort": "desc", "limit": 3},
+    {"a": 1, "t0": "1330005600,1330002000"},
+])
+def test_aggrvalues_get_cached(app_client, admin_authorization_header, account_id, monkeypatch, args):
+    """
+        Aggregated buckets before the watermark are cached; the results must be the same as without the cache, even
+        when late values change the already cached buckets.
+    """
+    t_from = 1330002000
+    data = [{'p': f'qqqq.cached.{i}', 't': t_from + j * 900, 'v': 10 * i + j} for i in range(2) for j in range(40)]
+    r = app_client.put(f'/api/accounts/{account_id}/values/', json=data, headers={'Authorization': admin_authorization_header})
+    assert r.status_code == 204, r.text
+    args = {"p": "qqqq.cached.0,qqqq.cached.1", "t0": t_from, "t1": t_from + 10 * 3600, **args}
+
+    def _get_values(use_cache=True):
+        monkeypatch.setattr(datatypes, 'AGGR_CACHE_MAX_BYTES', 1000000 if use_cache else 0)
+        r = app_client.post(f'/api/accounts/{account_id}/getaggrvalues/', json=args, headers={'Authorization': admin_authorization_header})
+        assert r.status_code == 200, r.text
+        return r.json()
+
+    watermark = [datetime.datetime.utcfromtimestamp(t_from + 6 * 3600 + 1200)]
+    monkeypatch.setattr(Measurement, '_get_aggr_watermarks_from_db', classmethod(lambda cls, c=None: {aggr_level: watermark[0] for aggr_level in range(Measurement.MAX_AGGR_LEVEL + 1)}))
+    monkeypatch.setattr(datatypes, 'AGGR_WATERMARK_CHECK_INTERVAL', 0)
+    monkeypatch.setattr(Measurement, 'aggr_watermarks_checked_at', None)
+    expected = _get_values(use_cache=False)
+    hits_before = Measurement.aggr_buckets_cache.stats()['hits']
+    assert _get_values() == expected
+    assert _get_values() == expected
+    r = app_client.get('/api/admin/metrics', headers={'Authorization': admin_authorization_header})
+    assert r.status_code == 200
+    stats = r.json()['caches']['aggr_buckets']
+    if "limit" in args:
+        # results were cut, so we don't know if we have all the buckets:
+        assert stats['entries'] == 0
+    else:
+        assert stats['entries'] == 2 and stats['size'] > 0
+        assert stats['hits'] == hits_before + 2
+
+    # a late value changes an already cached bucket:
+    r = app_client.put(f'/api/accounts/{account_id}/values/', json=[{'p': 'qqqq.cached.0', 't': t_from + 3600, 'v': 1000}], headers={'Authorization': admin_authorization_header})
+    assert r.status_code == 204, r.text
+    expected = _get_values(use_cache=False)
+    assert _get_values() == expected
+    assert _get_values() == expected
+    # the path is not cached again until the watermark moves on:
+    path_ids = Path._get_path_ids(account_id, ['qqqq.cached.0', 'qqqq.cached.1'])
+    assert path_ids[0] in Measurement.aggr_cache_late_paths
+    assert [k[0] for k in Measurement.aggr_buckets_cache._data] == ([] if "limit" in args else [path_ids[1]])
+
+    # once it does, the late path is forgotten and cached again:
+    watermark[0] += datetime.timedelta(seconds=900)
+    assert _get_values() == expected
+    assert path_ids[0] not in Measurement.aggr_cache_late_paths
+    assert sorted(k[0] for k in Measurement.aggr_buckets_cache._data) == ([] if "limit" in args else sorted(path_ids))
+
+@pytest.mark.parametrize("bulk_insert_threshold", [1000, 2])
+def test_values_paths_ts_range(app_client, admin_authorization_header, account_id, monkeypatch, bulk_insert_threshold):
+    """
+        First and last timestamp (and the last value) of each path are kept up to date when values are written, even
+        if they arrive out of order, and are used when t0 is omitted.
+    """
+    monkeypatch.setattr(Measurement, 'BULK_INSERT_THRESHOLD', bulk_insert_threshold)
+    data = [
+        { 'p': 'qqqq.range', 't': 1234567895, 'v': 5 },
+        { 'p': 'qqqq.range', 't': 1234567893, 'v': 3 },
+    ]
+    r = app_client.put(f'/api/accounts/{account_id}/values/', json=data, headers={'Authorization': admin_authorization_header})
+    assert r.status_code == 204, r.text
+    path_id = Path._get_path_ids(account_id, ['qqqq.range'])[0]
+    r = app_client.get(f'/api/accounts/{account_id}/paths/{path_id}', headers={'Authorization': admin_authorization_header})
+    assert r.status_code == 200, r.text
+    assert r.json() == {'path': 'qqqq.range', 't0': 1234567893.0, 't1': 1234567895.0, 'v': 5.0}
+
+    # older values extend the range but don't change the last value; newer ones do:
+    data = [
+        { 'p': 'qqqq.range', 't': 1234567891, 'v': 1 },
+        { 'p': 'qqqq.range', 't': 1234567897, 'v': 7 },
+        { 'p': 'qqqq.range', 't': 1234567897, 'v': 8 },
+    ]
+    r = app_client.put(f'/api/accounts/{account_id}/values/', json=data, headers={'Authorization': admin_authorization_header})
+    assert r.status_code == 204, r.text
+    r = app_client.get(f'/api/accounts/{account_id}/paths/{path_id}', headers={'Authorization': admin_authorization_header})
+    assert r.json() == {'path': 'qqqq.range', 't0': 1234567891.0, 't1': 1234567897.0, 'v': 8.0}
+
+    r = app_client.put(f'/api/accounts/{account_id}/values/', json=[{ 'p': 'qqqq.range', 't': 1234567892, 'v': 2 }], headers={'Authorization': admin_authorization_header})
+    assert r.status_code == 204, r.text
+    r = app_client.get(f'/api/accounts/{account_id}/paths/{path_id}', headers={'Authorization': admin_authorization_header})
+    assert r.json() == {'path': 'qqqq.range', 't0': 1234567891.0, 't1': 1234567897.0, 'v': 8.0}
+
+    # without t0, the values are fetched from the first one on:
+    r = app_client.get(f'/api/accounts/{account_id}/values/qqqq.range/?t1=1234567899', headers={'Authorization': admin_authorization_header})
+    assert r.status_code == 200, r.text
+    assert [d['t'] for d in r.json()['paths']['qqqq.range']['data']] == [1234567891.0, 1234567892.0, 1234567893.0, 1234567895.0, 1234567897.0]
+
+def test_values_put_concurrent_batched(app_client, admin_authorization_header, account_id, monkeypatch):
+    """
+        Put values from many concurrent requests, make sure they are written together and that an invalid
+        request doesn't affect the others.
+    """
+    monkeypatch.setattr(values_batcher, 'max_delay', 0.2)
+    counters_before = dict(values_batcher.counters)
+
+    def put_value(i):
+        data = [{'p': f'qqqq.concurrent.{i}', 't': 1234567890, 'v': 'not a number' if i == 3 else i}]
+        return app_client.put(f'/api/accounts/{account_id}/values/', json=data, headers={'Authorization': admin_authorization_header})
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=10) as executor:
+        responses = list(executor.map(put_value, range(10)))
+    assert [r.status_code for r in responses] == [400 if i == 3 else 204 for i in range(10)]
+    assert values_batcher.counters['requests'] - counters_before['requests'] == 10
+    assert values_batcher.counters['batches'] - counters_before['batches'] < 10
+
+    args = {
+        "p": ",".join(f'qqqq.concurrent.{i}' for i in range(10) if i != 3),
+        "t0": 1234567890,
+        "t1": 1234567890,
+    }
+    r = app_client.post(f'/api/accounts/{account_id}/getvalues/', json=args, headers={'Authorization': admin_authorization_header})
+    assert r.status_code == 200, r.text
+    actual = r.json()
+    for i in range(10):
+        if i != 3:
+            assert actual['paths'][f'qqqq.concurrent.{i}']['data'] == [{'t': 1234567890.0, 'v': float(i)}]
+
+def test_values_batch_invalid_new_paths(app_client, admin_authorization_header, account_id):
+    """
+        Paths created by a request are reported as newly created even if it was batched together with an invalid
+        request.
+    """
+    fallbacks_before = values_batcher.counters['fallbacks']
+    batch = [
+        (account_id, [{'p': 'qqqq.batched.invalid', 't': 1234567890, 'v': 'not a number'}], {}, concurrent.futures.Future()),
+        (account_id, [{'p': 'qqqq.batched.new', 't': 1234567890, 'v': 1}], {}, concurrent.futures.Future()),
+        (account_id, [{'p': 'qqqq.batched.new2', 't': 1234567890, 'v': 2}], {}, concurrent.futures.Future()),
+    ]
+    values_batcher._write_batch(batch)
+    with pytest.raises(datatypes.ValidationError):
+        batch[0][3].result()
+    assert [p.path for p in batch[1][3].result()] == ['qqqq.batched.new']
+    assert [p.path for p in batch[2][3].result()] == ['qqqq.batched.new2']
+    assert values_batcher.counters['fallbacks'] == fallbacks_before
+    with pytest.raises(datatypes.PathNotInDBError):
+        Path._get_path_ids(account_id, ['qqqq.batched.invalid'])
+
+def test_values_ingest_queue(app_client, admin_authorization_header, account_id, mqtt_messages, monkeypatch):
+    """
+        With INGEST_MODE=queue, values are only validated and queued; they are saved (and changes published) by
+        ingest consumer.
+    """
+    monkeypatch.setattr(api.accounts, 'INGEST_MODE', api.ingest.INGEST_MODE_QUEUE)
+    monkeypatch.setattr(api.admin, 'INGEST_MODE', api.ingest.INGEST_MODE_QUEUE)
+
+    data = [{'p': 'qqqq.queued', 't': 1234567890, 'v': 12.5}]
+    r = app_client.put(f'/api/accounts/{account_id}/values/', json=data, headers={'Authorization': admin_authorization_header})
+    assert r.status_code == 202, r.text
+    r = app_client.post(f'/api/accounts/{account_id}/values/', json=[{'p': 'qqqq.queued', 'v': 13}], headers={'Authorization': admin_authorization_header})
+    assert r.status_code == 202, r.text
+    # invalid values are rejected immediately:
+    data = [{'p': 'qqqq.queued', 't': 1234567890, 'v': 'not a number'}]
+    r = app_client.put(f'/api/accounts/{account_id}/values/', json=data, headers={'Authorization': admin_authorization_header})
+    assert r.status_code == 400, r.text
+
+    r = app_client.get('/api/admin/ingest-queue', headers={'Authorization': admin_authorization_header})
+    assert r.status_code == 200, r.text
+    assert r.json()['mode'] == 'queue'
+    assert r.json()['depth'] == 2
+    assert r.json()['lag_s'] >= 0
+
+    assert ingest_consumer.consume_batch(100) == 2
+    assert ingest_consumer.consume_batch(100) == 0
+
+    mqtt_wait_for_message(mqtt_messages, [f'changed/accounts/{account_id}/values/qqqq.queued'])
+    r = app_client.get('/api/admin/ingest-queue', headers={'Authorization': admin_authorization_header})
+    assert r.json()['depth'] == 0
+    assert r.json()['lag_s'] == 0
+    args = {"p": "qqqq.queued", "t0": 1234567890, "t1": 1234567890}
+    r = app_client.post(f'/api/accounts/{account_id}/getvalues/', json=args, headers={'Authorization': admin_authorization_header})
+    assert r.json()['paths']['qqqq.queued']['data'] == [{'t': 1234567890.0, 'v': 12.5}]
+
+@pytest.mark.parametrize("error, dropped", [
+    (datatypes.ValidationError("Invalid input format"), True),
+    (psycopg2.OperationalError("server closed the connection unexpectedly"), False),
+])
+def test_values_ingest_queue_errors(app_client, admin_authorization_header, account_id, monkeypatch, error, dropped):
+    """
+        Queued values which can't be saved are dropped, but if saving fails for some other reason, they stay queued.
+    """
+    monkeypatch.setattr(api.accounts, 'INGEST_MODE', api.ingest.INGEST_MODE_QUEUE)
+    for i in range(2):
+        r = app_client.put(f'/api/accounts/{account_id}/values/', json=[{'p': f'qqqq.queued.{i}', 't': 1234567890, 'v': i}], headers={'Authorization': admin_authorization_header})
+        assert r.status_code == 202, r.text
+
+    def save_values_and_stats(account_id, data, stats_updates):
+        if data[0]['p'] == 'qqqq.queued.1':
+            raise error
+        return api.ingest.save_values_and_stats(account_id, data, stats_updates)
+
+    def save_values_and_stats_multiple(items):
+        raise error
+
+    monkeypatch.setattr(ingest_consumer, 'save_values_and_stats', save_values_and_stats)
+    monkeypatch.setattr(ingest_consumer, 'save_values_and_stats_multiple', save_values_and_stats_multiple)
+    if dropped:
+        assert ingest_consumer.consume_batch(100) == 2
+    else:
+        with pytest.raises(psycopg2.OperationalError):
+            ingest_consumer.consume_batch(100)
+    assert IngestQueue.get_status()['depth'] == (0 if dropped else 2)
+
+async def _asgi_request(app, method, path, headers={}, body=b'', body_ready=None):
+    """
+        Calls ASGI app directly (on the current event loop) and returns the status code of the response. If
+        body_ready (asyncio.Event) is given, the body is only sent once it is set.
+    """
+    scope = {
+        'type': 'http',
+        'asgi': {'version': '3.0'},
+        'http_version': '1.1',
+        'method': method,
+        'scheme': 'http',
+        'path': path,
+        'raw_path': path.encode(),
+        'query_string': b'',
+        'root_path': '',
+        'headers': [(k.lower().encode(), v.encode()) for k, v in headers.items()],
+        'client': ('testclient', 50000),
+        'server': ('testserver', 80),
+    }
+    response_complete = asyncio.Event()
+    request_sent = False
+    status_code = None
+
+    async def receive():
+        nonlocal request_sent
+        if not request_sent:
+            request_sent = True
+            if body_ready is not None:
+                await body_ready.wait()
+            return {'type': 'http.request', 'body': body, 'more_body': False}
+        await response_complete.wait()
+        return {'type': 'http.disconnect'}
+
+    async def send(message):
+        nonlocal status_code
+        if message['type'] == 'http.response.start':
+            status_code = message['status']
+        elif message['type'] == 'http.response.body' and not message.get('more_body', False):
+            response_complete.set()
+
+    await app(scope, receive, send)
+    return status_code
+
+@pytest.mark.parametrize("slow_request", ["put", "getvalues"])
+def test_values_put_doesnt_block_event_loop(app_client, admin_authorization_header, account_id, monkeypatch, slow_request):
+    """
+        While a (slow) PUT or POST (getvalues) of values is being processed, other requests on the same event loop
+        are still served.
+    """
+    monkeypatch.setattr(values_batcher, 'max_delay', 0)
+    save_values_batch_to_db = Measurement.save_values_batch_to_db
+    def slow_save_values_batch_to_db(batch):
+        time.sleep(1.0)
+        return save_values_batch_to_db(batch)
+    monkeypatch.setattr(Measurement, 'save_values_batch_to_db', slow_save_values_batch_to_db)
+    fetch_data = Measurement.fetch_data
+    def slow_fetch_data(*args, **kwargs):
+        time.sleep(1.0)
+        return fetch_data(*args, **kwargs)
+    monkeypatch.setattr(Measurement, 'fetch_data', slow_fetch_data)
+
+    headers = {'Authorization': admin_authorization_header, 'Content-Type': 'application/json'}
+    if slow_request == 'put':
+        method, url, expected_status_code = 'PUT', f'/api/accounts/{account_id}/values', 204
+        body = json.dumps([{'p': 'qqqq.slow', 't': 1234567890, 'v': 1}]).encode()
+    else:
+        r = app_client.put(f'/api/accounts/{account_id}/values/', json=[{'p': 'qqqq.slow', 't': 1234567890, 'v': 1}], headers={'Authorization': admin_authorization_header})
+        assert r.status_code == 204, r.text
+        method, url, expected_status_code = 'POST', f'/api/accounts/{account_id}/getvalues', 200
+        body = json.dumps({'p': 'qqqq.slow', 't0': 1234567890, 't1': 1234567891, 'limit': 10}).encode()
+
+    async def slow_and_get():
+        slow_task = asyncio.ensure_future(_asgi_request(app_client.app, method, url, headers, body))
+        await asyncio.sleep(0.2)
+        get_start = time.monotonic()
+        get_status_code = await _asgi_request(app_client.app, 'GET', f'/api/accounts/{account_id}', headers)
+        get_duration = time.monotonic() - get_start
+        slow_was_done = slow_task.done()
+        slow_status_code = await slow_task
+        return get_status_code, get_duration, slow_was_done, slow_status_code
+
+    get_status_code, get_duration, slow_was_done, slow_status_code = asyncio.run(slow_and_get())
+    assert get_status_code == 200
+    assert slow_status_code == expected_status_code
+    assert not slow_was_done
+    assert get_duration < 0.5
+
 def test_values_put_get_via_post(app_client, admin_authorization_header, account_id, mqtt_messages):
     """
         Put a value, get a value - this time get it via POST.
@@ -608,6 +1314,9 @@ def test_value_put_path_get_put(app_client, admin_authorization_header, account_
     assert r.status_code == 200
     expected = {
         "path": PATH,
+        "t0": 1234567890.123456,
+        "t1": 1234567890.123456,
+        "v": 111.22,
     }
     actual = r.json()
     assert expected == actual
@@ -625,10 +1334,21 @@ def test_value_put_path_get_put(app_client, admin_authorization_header, account_
     assert r.status_code == 200
     expected = {
         "path": NEW_PATH,
+        "t0": 1234567890.123456,
+        "t1": 1234567890.123456,
+        "v": 111.22,
     }
     actual = r.json()
     assert expected == actual
 
+    # the (cached) old path must no longer point to the renamed path:
+    data = [{'p': PATH, 't': 1234567891.0, 'v': 333.0}]
+    r = app_client.put('/api/accounts/{}/values/'.format(account_id), json=data, headers={'Authorization': admin_authorization_header})
+    assert r.status_code == 204
+    r = app_client.get(f'/api/accounts/{account_id}/values/{NEW_PATH}/?t0=1234567890&t1=1234567892', headers={'Authorization': admin_authorization_header})
+    assert r.status_code == 200
+    assert r.json()['paths'][NEW_PATH]['data'] == [{'t': 1234567890.123456, 'v': 111.22}]
+
     # delete it:
     r = app_client.delete(f'/api/accounts/{account_id}/paths/{path_id}', headers={'Authorization': admin_authorization_header})
     assert r.status_code == 204, r.text
@@ -636,6 +1356,18 @@ def test_value_put_path_get_put(app_client, admin_authorization_header, account_
     r = app_client.get(f'/api/accounts/{account_id}/paths/{path_id}', headers={'Authorization': admin_authorization_header})
     assert r.status_code == 404
 
+    # putting values to the deleted path creates it anew:
+    data = [{'p': NEW_PATH, 't': 1234567891.0, 'v': 444.0}]
+    r = app_client.put('/api/accounts/{}/values/'.format(account_id), json=data, headers={'Authorization': admin_authorization_header})
+    assert r.status_code == 204
+    r = app_client.get(f'/api/accounts/{account_id}/values/{NEW_PATH}/?t0=1234567890&t1=1234567892', headers={'Authorization': admin_authorization_header})
+    assert r.status_code == 200
+    assert r.json()['paths'][NEW_PATH]['data'] == [{'t': 1234567891.0, 'v': 444.0}]
+
+    r = app_client.get('/api/admin/metrics', headers={'Authorization': admin_authorization_header})
+    assert r.status_code == 200
+    assert r.json()['caches']['path_ids']['hits'] > 0
+
 def test_accounts(app_client):
     """
         Create first admin, login, make sure you get X-JWT-Token. Try to create another first admin, fail.
@@ -703,6 +1435,351 @@ def test_jwt_expiry_refresh(app_client, first_admin_id):
     assert r.status_code == 200
 
 
+def test_jwt_key_ring_cache(app_client, first_admin_id):
+    """
+        Private keys are cached in memory, and so are the decoded tokens; a key created by another worker (unknown
+        key id) must still be found.
+    """
+    data = { 'username': USERNAME_ADMIN, 'password': PASSWORD_ADMIN }
+    r = app_client.post('/api/auth/login', json=data)
+    assert r.status_code == 200
+    admin_authorization_header = r.headers.get('X-JWT-Token', None)
+
+    hits_before = JWT.decoded_cache.hits
+    for _ in range(3):
+        r = app_client.get('/api/admin/accounts', headers={'Authorization': admin_authorization_header})
+        assert r.status_code == 200
+    assert JWT.decoded_cache.hits >= hits_before + 2
+
+    # our key expires (but can still be used for decoding); another worker creates a new key and issues a token:
+    with db.cursor() as c:
+        c.execute("UPDATE private_jwt_keys SET use_until = EXTRACT(EPOCH FROM NOW()) - 1;")
+        c.execute("INSERT INTO private_jwt_keys (key) VALUES ('other-worker-key') RETURNING id;")
+        other_key_id = str(c.fetchone()[0])
+    other_worker_header = 'Bearer {}:{}'.format(other_key_id, jwt.encode({'user_id': first_admin_id, 'session_id': 'abc', 'exp': time.time() + 60}, 'other-worker-key', algorithm='HS256'))
+
+    r = app_client.get('/api/admin/accounts', headers={'Authorization': other_worker_header})
+    assert r.status_code == 200
+    r = app_client.get('/api/admin/accounts', headers={'Authorization': admin_authorization_header})
+    assert r.status_code == 200
+    # the cached key has expired, so the new one is used for signing:
+    key_id, _ = JWT._private_jwt_key_for_encoding()
+    assert key_id == other_key_id
+
+    # unknown key:
+    assert JWT._private_jwt_key_for_decoding('987654') is None
+
+
+def test_mqtt_auth_aclcheck_cache(app_client, admin_authorization_header, person_id, person_authorization_header, account_id):
+    """
+        Mosquitto auth plugin decisions are cached, but the cache is invalidated when user's permissions change.
+    """
+    token = urllib.parse.quote(person_authorization_header)
+    def aclcheck(topic, acc=1):
+        return app_client.post('/api/admin/mqtt-auth-plug/aclcheck', data={'acc': acc, 'topic': topic}, headers={'Authorization': token})
+
+    topic = f'changed/accounts/{account_id}/values/qqqq.wwww'
+    hits_before = mqtt_auth_cache.hits
+    for _ in range(3):
+        assert aclcheck(topic).status_code == 401
+    assert aclcheck('something/else').status_code == 401
+    assert aclcheck(topic, acc=2).status_code == 401
+    assert mqtt_auth_cache.hits == hits_before + 2
+
+    data = { 'resource_prefix': f'accounts/{account_id}', 'methods': ['GET'] }
+    r = app_client.post('/api/persons/{}/permissions'.format(person_id), json=data, headers={'Authorization': admin_authorization_header})
+    assert r.status_code == 201
+    # the decision is invalidated via DB notification:
+    for _ in range(50):
+        r = aclcheck(topic)
+        if r.status_code == 200:
+            break
+        time.sleep(0.1)
+    assert r.status_code == 200
+    assert aclcheck(topic).status_code == 200
+    assert aclcheck(topic, acc=2).status_code == 401
+
+    r = app_client.get('/api/admin/metrics', headers={'Authorization': admin_authorization_header})
+    assert r.status_code == 200
+    assert r.json()['caches']['mqtt_auth']['hits'] >= 3
+
+
+def test_permissions_cache_invalidated_while_compiling(app_client, first_admin_id, monkeypatch):
+    """
+        If permissions change while they are being read, the (possibly stale) result is not cached.
+    """
+    Permission.compiled_cache.clear()
+    get_list = Permission.get_list
+    def get_list_and_notify(user_id):
+        permissions = get_list(user_id)
+        # the notification about a change arrives before the permissions are compiled:
+        Permission._on_permissions_changed_notification(str(user_id))
+        return permissions
+    monkeypatch.setattr(Permission, 'get_list', staticmethod(get_list_and_notify))
+    assert Permission.is_access_allowed(first_admin_id, 'accounts/123', 'GET')
+    assert Permission.compiled_cache.get(first_admin_id) is None
+
+    monkeypatch.setattr(Permission, 'get_list', staticmethod(get_list))
+    assert Permission.is_access_allowed(first_admin_id, 'accounts/123', 'GET')
+    assert Permission.compiled_cache.get(first_admin_id) is not None
+
+def test_request_db_connection(app_client, admin_authorization_header, account_id, monkeypatch):
+    """
+        All the queries within a request (auth checks and handler) use a single connection from the pool.
+    """
+    checkouts = []
+    original_checkout = dbutils._checkout_db_connection
+    def counting_checkout():
+        conn = original_checkout()
+        checkouts.append(conn)
+        return conn
+    monkeypatch.setattr(dbutils, '_checkout_db_connection', counting_checkout)
+
+    JWT.clear_cache()
+    Permission.compiled_cache.clear()
+    r = app_client.get('/api/admin/accounts', headers={'Authorization': admin_authorization_header})
+    assert r.status_code == 200
+    r = app_client.get(f'/api/accounts/{account_id}/entities', headers={'Authorization': admin_authorization_header})
+    assert r.status_code == 200
+    assert len(checkouts) == 2
+
+    # outside of requests, each cursor gets its own connection:
+    with db.cursor() as c1, db.cursor() as c2:
+        assert c1.connection is not c2.connection
+    with dbutils.request_db_connection():
+        with db.cursor() as c1, db.cursor() as c2:
+            assert c1.connection is c2.connection
+
+
+def test_request_db_connection_released_before_fanout(app_client, admin_authorization_header, account_id, monkeypatch):
+    """
+        Requests which fetch values in parallel (on connections of their own) release the request connection first,
+        otherwise concurrent requests could take all the connections and then wait for each other.
+    """
+    data = [{'p': f'qqqq.fanout.{i}', 't': 1234567890, 'v': i} for i in range(2)]
+    r = app_client.put(f'/api/accounts/{account_id}/values/', json=data, headers={'Authorization': admin_authorization_header})
+    assert r.status_code == 204, r.text
+    monkeypatch.setattr(datatypes, 'FETCH_PARALLEL_WORKERS', 4)
+    monkeypatch.setattr(datatypes, 'FETCH_PATHS_PER_UNIT', 1)
+    fetch_unit = Measurement._fetch_unit
+    def slow_fetch_unit(*args, **kwargs):
+        time.sleep(0.3)  # make sure that both of the requests are fetching at the same time
+        return fetch_unit(*args, **kwargs)
+    monkeypatch.setattr(Measurement, '_fetch_unit', slow_fetch_unit)
+
+    pool = dbutils.BlockingConnectionPool(0, 2, 2.0, 30, **dbutils._db_connection_params())
+    monkeypatch.setattr(dbutils, 'db_pool', pool)
+    # path ids are looked up (on the request connection) before fetching:
+    Path.path_ids_cache.clear()
+    try:
+        headers = {'Authorization': admin_authorization_header, 'Content-Type': 'application/json'}
+        body = json.dumps({'p': 'qqqq.fanout.0,qqqq.fanout.1', 't0': 1234567890, 't1': 1234567891, 'limit': 10}).encode()
+        async def fetch_concurrently():
+            return await asyncio.gather(*[
+                _asgi_request(app_client.app, 'POST', f'/api/accounts/{account_id}/getvalues', headers, body) for _ in range(2)
+            ])
+        assert asyncio.run(fetch_concurrently()) == [200, 200]
+        assert pool.stats()['timeouts'] == 0
+        assert pool.stats()['in_use'] == 0
+    finally:
+        pool.closeall()
+
+
+@pytest.mark.parametrize("method,url,body,expected_status_code", [
+    ('PUT', 'values', [{'p': 'qqqq.slowbody', 't': 1234567890, 'v': 1}], 204),
+    ('POST', 'values', [{'p': 'qqqq.slowbody', 'v': 1}], 204),
+    ('POST', 'getvalues', {'p': 'qqqq.slowbody', 't0': 1234567890, 't1': 1234567891}, 200),
+    ('POST', 'getaggrvalues', {'p': 'qqqq.slowbody', 't0': 1234567890, 't1': 1234567891, 'a': 0}, 200),
+])
+def test_request_db_connection_released_while_reading_body(app_client, admin_authorization_header, account_id, method, url, body, expected_status_code):
+    """
+        The request connection (checked out for authentication) is not held while a slow client uploads the body.
+    """
+    r = app_client.put(f'/api/accounts/{account_id}/values/', json=[{'p': 'qqqq.slowbody', 't': 1234567890, 'v': 1}], headers={'Authorization': admin_authorization_header})
+    assert r.status_code == 204, r.text
+    JWT.clear_cache()
+    Permission.compiled_cache.clear()
+    headers = {'Authorization': admin_authorization_header, 'Content-Type': 'application/json'}
+
+    async def slow_upload():
+        body_ready = asyncio.Event()
+        task = asyncio.ensure_future(_asgi_request(app_client.app, method, f'/api/accounts/{account_id}/{url}', headers, json.dumps(body).encode(), body_ready))
+        await asyncio.sleep(0.2)
+        in_use = dbutils.db_pool.stats()['in_use']
+        body_ready.set()
+        return in_use, await task
+
+    in_use, status_code = asyncio.run(slow_upload())
+    assert in_use == 0
+    assert status_code == expected_status_code
+
+
+def test_db_pool_blocking(app_client):
+    """
+        When all the connections are in use, pool waits for one to be returned (or times out) instead of failing.
+        Broken connections are replaced.
+    """
+    pool = dbutils.BlockingConnectionPool(1, 2, 0.5, 30, **dbutils._db_connection_params())
+    try:
+        conn1 = pool.getconn()
+        conn2 = pool.getconn()
+        assert pool.stats()['in_use'] == 2
+        with pytest.raises(dbutils.DBPoolTimeoutError):
+            pool.getconn()
+        assert pool.stats()['timeouts'] == 1
+
+        # connection returned while we wait is handed out to us:
+        threading.Timer(0.1, pool.putconn, (conn1,)).start()
+        conn3 = pool.getconn()
+        assert conn3 is conn1
+        assert pool.stats()['max_wait_time_s'] >= 0.1
+
+        # broken connection is discarded, and a new one is created instead:
+        conn2.close()
+        pool.putconn(conn2)
+        conn4 = pool.getconn()
+        assert conn4 is not conn2 and not conn4.closed
+        with conn4.cursor() as c:
+            c.execute('SELECT 1;')
+        # connection left in a transaction is rolled back:
+        with conn4.cursor() as c:
+            c.execute('BEGIN;')
+        pool.putconn(conn4)
+        assert pool.getconn() is conn4
+        assert conn4.info.transaction_status == psycopg2.extensions.TRANSACTION_STATUS_IDLE
+        assert pool.stats()['discarded'] == 1
+    finally:
+        pool.closeall()
+
+    # with keep_idle=False (PgBouncer), connections above min size are closed when returned:
+    pool = dbutils.BlockingConnectionPool(0, 2, 0.5, 30, keep_idle=False, **dbutils._db_connection_params())
+    try:
+        conn = pool.getconn()
+        pool.putconn(conn)
+        assert conn.closed
+        assert pool.stats()['idle'] == 0
+    finally:
+        pool.closeall()
+
+
+class _BrokenDBConnection(dbutils.DBConnection):
+    """ Connection which fails when it is set up after checkout (as if it died while it was idle). """
+    def set_isolation_level(self, level):
+        raise psycopg2.OperationalError("server closed the connection unexpectedly")
+
+
+def test_db_pool_checkout_failure(app_client, monkeypatch):
+    """
+        If a connection can't be set up after it was taken from the pool, it is discarded (and the pool doesn't
+        shrink).
+    """
+    pool = dbutils.BlockingConnectionPool(0, 1, 0.5, 30, **{**dbutils._db_connection_params(), 'connection_factory': _BrokenDBConnection})
+    monkeypatch.setattr(dbutils, 'db_pool', pool)
+    try:
+        for _ in range(3):
+            assert dbutils._checkout_db_connection() is None
+        assert pool.stats()['in_use'] == 0
+        assert pool.stats()['discarded'] == 3
+        assert pool.stats()['timeouts'] == 0
+    finally:
+        pool.closeall()
+
+
+def test_prepared_statements(app_client, admin_authorization_header, account_id, monkeypatch):
+    """
+        Hot statements are prepared once per connection and then executed by name; results are the same when
+        prepared statements are disabled.
+    """
+    statement = dbutils.PreparedStatement('test_statement', 'SELECT %s + 1, %s;', ['integer', 'text'])
+    assert statement.prepare_sql == 'PREPARE test_statement (integer, text) AS SELECT $1 + 1, $2;'
+    assert statement.plain_sql == 'SELECT %s::integer + 1, %s::text;'
+
+    data = [{'p': 'qqqq.wwww', 't': 1234567890.123456, 'v': 111.22}, {'p': 'qqqq.eeee', 't': 1234567890.123456, 'v': 5}]
+    url = f'/api/accounts/{account_id}/values/qqqq.wwww/?t0=1234567890&t1=1234567891&limit=10'
+    r = app_client.put(f'/api/accounts/{account_id}/values/', json=data, headers={'Authorization': admin_authorization_header})
+    assert r.status_code == 204
+    executions_before = Measurement.FETCH_RAW_STATEMENTS['ASC'].counters['executions']
+    for _ in range(3):
+        r = app_client.get(url, headers={'Authorization': admin_authorization_header})
+        assert r.status_code == 200, r.text
+        expected = r.json()
+    assert expected['paths']['qqqq.wwww']['data'] == [{'t': 1234567890.123456, 'v': 111.22}]
+    assert Measurement.FETCH_RAW_STATEMENTS['ASC'].counters['executions'] == executions_before + 3
+
+    with db.cursor() as c:
+        assert isinstance(c.connection, dbutils.DBConnection)
+        Path.PATH_ID_STATEMENT.execute(c, (account_id, 'qqqq.wwww'))
+        path_id = c.fetchone()[0]
+        assert 'path_id' in c.connection.prepared_statements
+        explained = Measurement.FETCH_RAW_STATEMENTS['ASC'].explain(c, ([path_id], [datetime.datetime(2009, 2, 1)], datetime.datetime(2009, 3, 1), 10))
+        assert explained['planning_ms'] >= 0 and explained['execution_ms'] >= 0
+        # statements which write are only planned, not executed:
+        if Measurement.UPSERT_STATEMENT.name in c.connection.prepared_statements:
+            c.connection.prepared_statements.discard(Measurement.UPSERT_STATEMENT.name)
+            c.execute(f'DEALLOCATE {Measurement.UPSERT_STATEMENT.name};')
+        explained = Measurement.UPSERT_STATEMENT.explain(c, ([path_id], [datetime.datetime(2009, 2, 14)], ['42']))
+        assert explained['planning_ms'] >= 0 and explained['execution_ms'] is None
+        c.execute('SELECT COUNT(*) FROM measurements WHERE path = %s AND ts = %s;', (path_id, datetime.datetime(2009, 2, 14)))
+        assert c.fetchone()[0] == 0
+
+    # some of the executions are sampled to measure planning and execution time:
+    monkeypatch.setattr(dbutils, 'DB_EXPLAIN_SAMPLE_INTERVAL', 1)
+    r = app_client.get(url, headers={'Authorization': admin_authorization_header})
+    assert r.status_code == 200, r.text
+    assert r.json() == expected
+    r = app_client.get('/api/admin/metrics', headers={'Authorization': admin_authorization_header})
+    stats = r.json()['prepared_statements']['measurements_raw_asc']
+    assert stats['executions'] >= 4
+    assert stats['samples'] >= 1 and stats['avg_planning_ms'] >= 0 and stats['avg_execution_ms'] >= 0
+    monkeypatch.setattr(dbutils, 'DB_EXPLAIN_SAMPLE_INTERVAL', 0)
+
+    monkeypatch.setattr(dbutils, 'DB_PREPARED_STATEMENTS', False)
+    r = app_client.put(f'/api/accounts/{account_id}/values/', json=data, headers={'Authorization': admin_authorization_header})
+    assert r.status_code == 204
+    r = app_client.get(url, headers={'Authorization': admin_authorization_header})
+    assert r.status_code == 200
+    assert r.json() == expected
+
+
+def test_read_replica_routing(app_client, admin_authorization_header, account_id, monkeypatch):
+    """
+        Read-only queries go to replica (here: the same DB), unless the replication lag is too big.
+    """
+    params = dbutils._db_connection_params()
+    del params['connect_timeout']
+    replica = dbutils.ReplicaRouter(psycopg2.extensions.make_dsn(**params), 10, 0)
+    monkeypatch.setattr(dbutils, 'db_replica', replica)
+
+    data = [{'p': 'qqqq.wwww', 't': 1234567890.123456, 'v': 111.22}]
+    r = app_client.put(f'/api/accounts/{account_id}/values/', json=data, headers={'Authorization': admin_authorization_header})
+    assert r.status_code == 204
+    assert replica.counters['replica_checkouts'] == 0  # writes always go to primary
+
+    url = f'/api/accounts/{account_id}/values/qqqq.wwww/?t0=1234567890&t1=1234567891'
+    r = app_client.get(url, headers={'Authorization': admin_authorization_header})
+    assert r.status_code == 200
+    assert r.json()['paths']['qqqq.wwww']['data'] == [{'t': 1234567890.123456, 'v': 111.22}]
+    assert replica.counters['replica_checkouts'] == 1
+    assert replica.usable and replica.lag == 0
+    r = app_client.get(f'/api/accounts/{account_id}/paths/?filter=qqqq.*', headers={'Authorization': admin_authorization_header})
+    assert r.status_code == 200
+    assert replica.counters['replica_checkouts'] == 2
+    assert replica.stats()['pool']['in_use'] == 0
+
+    # replica lags behind too much - primary is used instead:
+    replica.max_lag = -1
+    r = app_client.get(url, headers={'Authorization': admin_authorization_header})
+    assert r.status_code == 200
+    assert r.json()['paths']['qqqq.wwww']['data'] == [{'t': 1234567890.123456, 'v': 111.22}]
+    assert replica.counters['replica_checkouts'] == 2
+    assert replica.counters['fallbacks'] == 1
+    assert not replica.usable
+
+    r = app_client.get('/api/admin/metrics', headers={'Authorization': admin_authorization_header})
+    assert r.json()['db_replica']['fallbacks'] == 1
+    replica.pool.closeall()
+
+
 def test_jwt_total_expiry(app_client, first_admin_id):
     """
         Login, get X-JWT-Token which expired before 1s, read the new token from header, check it
@@ -1396,6 +2473,34 @@ def test_account_bots(app_client, bot_id, admin_authorization_header, person_aut
     assert actual['list'] == []
 
 
+def test_bot_token_cache_last_login(app_client, account_id, bot_id, bot_token, admin_authorization_header):
+    """
+        Bot tokens are cached and last_login is written periodically; when bot is removed, its token stops working.
+    """
+    data = {
+        'resource_prefix': 'accounts/{}/values/'.format(account_id),
+        'methods': [ 'POST' ],
+    }
+    r = app_client.post('/api/bots/{}/permissions'.format(bot_id), json=data, headers={'Authorization': admin_authorization_header})
+    assert r.status_code == 201
+
+    hits_before = Bot.token_cache.stats()['hits']
+    for i in range(3):
+        r = app_client.post('/api/accounts/{}/values/?b={}'.format(account_id, bot_token), json=[{'p': 'qqqq.wwww', 'v': i}])
+        assert r.status_code == 204, r.text
+    assert Bot.token_cache.stats()['hits'] - hits_before >= 2
+
+    r = app_client.get('/api/bots/{}'.format(bot_id), headers={'Authorization': admin_authorization_header})
+    assert r.json()['last_login'] is None
+    bot_last_logins.flush()
+    r = app_client.get('/api/bots/{}'.format(bot_id), headers={'Authorization': admin_authorization_header})
+    assert abs(r.json()['last_login'] - time.time()) < 10
+
+    r = app_client.delete('/api/bots/{}'.format(bot_id), headers={'Authorization': admin_authorization_header})
+    assert r.status_code == 204
+    r = app_client.post('/api/accounts/{}/values/?b={}'.format(account_id, bot_token), json=[{'p': 'qqqq.wwww', 'v': 1}])
+    assert r.status_code == 401
+
 @pytest.mark.parametrize("listener", [
     "superuser",
     "person",
@@ -1429,12 +2534,14 @@ def test_bot_post_values_mqtt_last_login(app_client, account_id, bot_id, bot_tok
     data = [{'p': 'qqqq.wwww', 'v': 111.22}]
     r = app_client.post('/api/accounts/{}/values/?b={}'.format(account_id, bot_token), json=data)
     assert r.status_code == 204
+    # stats are published when they are written:
+    stats_accumulator.flush()
 
     expected_mqtt_topics = [
         f'changed/accounts/{account_id}/values/qqqq.wwww',
+        f'changed/accounts/{account_id}/paths',
         f'changed/accounts/{account_id}/values/system.stats.inserted',
         f'changed/accounts/{account_id}/values/system.stats.changed',
-        f'changed/accounts/{account_id}/paths',
     ]
     for expected_mqtt_topic in expected_mqtt_topics:
         mqtt_message = mqtt_messages.get(timeout=3.0)
@@ -13,6 +13,8 @@ from fixtures import (
     app_client, _delete_all_from_db, admin_authorization_header, first_admin_id, account_id_factory, account_id,
     mqtt_client_factory, MqttMessage, mqtt_message_queue_factory, mqtt_messages,
 )
+from api.ingest import stats_accumulator
+from datatypes import Stats
 from const import SYSTEM_PATH_UPDATED_COUNT
 
 
@@ -40,6 +42,8 @@ def test_values_put_get_simple(app_client, admin_authorization_header, account_i
     data = [{'p': 'qqqq.wwww', 't': 1234567890.123456, 'v': 111.22}]
     r = app_client.put('/api/accounts/{}/values/'.format(account_id), json=data, headers={'Authorization': admin_authorization_header})
     assert r.status_code == 204, r.text
+    # stats are written periodically, don't wait for it:
+    stats_accumulator.flush()
     end_time = math.ceil(time.time() / 60) * 60
 
     r = app_client.get(f'/api/accounts/{account_id}/values/{SYSTEM_PATH_UPDATED_COUNT}/?t0={start_time}&t1={end_time}', headers={'Authorization': admin_authorization_header})
@@ -78,6 +82,7 @@ def test_values_put_get_simple(app_client, admin_authorization_header, account_i
     data = [{'p': 'qqqq.wwww', 't': 1234567890.123456, 'v': 111.22}, {'p': 'qqqq.aaaa', 't': 1234567222, 'v': 333}]
     r = app_client.put('/api/accounts/{}/values/'.format(account_id), json=data, headers={'Authorization': admin_authorization_header})
     assert r.status_code == 204, r.text
+    stats_accumulator.flush()
 
     r = app_client.get(f'/api/accounts/{account_id}/values/{SYSTEM_PATH_UPDATED_COUNT}/?t0={start_time}&t1={end_time}', headers={'Authorization': admin_authorization_header})
     assert r.status_code == 200, r.text
@@ -90,3 +95,54 @@ def test_values_put_get_simple(app_client, admin_authorization_header, account_i
         actual_total_count += data['v']
     expected_total_count = 3.0
     assert expected_total_count == actual_total_count
+
+
+def test_stats_coalesced(app_client, admin_authorization_header, account_id, mqtt_messages):
+    """
+        Stats counters from many requests are kept in memory and written (and published) together.
+    """
+    start_time = math.floor(time.time() / 60) * 60
+    for i in range(5):
+        data = [{'p': f'qqqq.wwww{i}', 't': 1234567890, 'v': i}]
+        r = app_client.put('/api/accounts/{}/values/'.format(account_id), json=data, headers={'Authorization': admin_authorization_header})
+        assert r.status_code == 204, r.text
+    end_time = math.ceil(time.time() / 60) * 60
+
+    # nothing is written until the stats are flushed:
+    assert sum(v for (_, p, _), v in stats_accumulator.pending.items() if p == SYSTEM_PATH_UPDATED_COUNT) == 5
+
+    stats_accumulator.flush()
+    r = app_client.get(f'/api/accounts/{account_id}/values/{SYSTEM_PATH_UPDATED_COUNT}/?t0={start_time}&t1={end_time}', headers={'Authorization': admin_authorization_header})
+    assert r.status_code == 200, r.text
+    assert sum(d['v'] for d in r.json()['paths'][SYSTEM_PATH_UPDATED_COUNT]['data']) == 5.0
+
+    stats_messages = []
+    while True:
+        try:
+            mqtt_message = mqtt_messages.get(timeout=1.0)
+        except:
+            break
+        if mqtt_message.topic == f'changed/accounts/{account_id}/values/{SYSTEM_PATH_UPDATED_COUNT}':
+            stats_messages.append(json.loads(mqtt_message.payload))
+    assert [m['v'] for m in stats_messages] == [5.0]
+
+
+def test_stats_write_failure_doesnt_fail_request(app_client, admin_authorization_header, account_id, monkeypatch):
+    """
+        If the stats counters can't be written, the values are still saved (and reported as such), and the counters
+        are written with the next flush.
+    """
+    monkeypatch.setattr(stats_accumulator, 'flush_interval', 0)
+    update_stats_multiple = Stats.update_stats_multiple
+    def failing_update_stats_multiple(stats_updates):
+        raise Exception("Stats are not available")
+    monkeypatch.setattr(Stats, 'update_stats_multiple', failing_update_stats_multiple)
+
+    data = [{'p': 'qqqq.wwww', 't': 1234567890, 'v': 1}]
+    r = app_client.put('/api/accounts/{}/values/'.format(account_id), json=data, headers={'Authorization': admin_authorization_header})
+    assert r.status_code == 204, r.text
+    assert sum(v for (_, p, _), v in stats_accumulator.pending.items() if p == SYSTEM_PATH_UPDATED_COUNT) == 1
+
+    monkeypatch.setattr(Stats, 'update_stats_multiple', update_stats_multiple)
+    stats_accumulator.flush()
+    assert stats_accumulator.pending == {}
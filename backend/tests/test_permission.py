@@ -2,7 +2,7 @@ import sys, os
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 import pytest
 
-from datatypes import Permission
+from datatypes import CompiledPermissions, Permission
 
 PERMISSION_ADMIN = {
     'resource_prefix': None,
@@ -38,3 +38,21 @@ PERMISSION_ACCOUNT_234_GET = {
 def test_Permission_can_grant_permission(granting_user_permissions, requested_resource_prefix, requested_methods, expected):
     assert expected == Permission.can_grant_permission(granting_user_permissions, requested_resource_prefix, requested_methods)
 
+
+
+@pytest.mark.parametrize("user_permissions,resource,method,expected", [
+    # valid:
+    ([PERMISSION_ADMIN], 'accounts/123', 'POST', True),
+    ([PERMISSION_ACCOUNT_123], 'accounts/123', 'DELETE', True),
+    ([PERMISSION_ACCOUNT_123], 'accounts/123/values/asdf', 'PUT', True),
+    ([PERMISSION_ACCOUNT_123, PERMISSION_ACCOUNT_234_GET], 'accounts/234/values', 'GET', True),
+    ([PERMISSION_ACCOUNT_234_GET, {'resource_prefix': 'accounts/234/values', 'methods': ['POST']}], 'accounts/234/values/a.b', 'POST', True),
+    # invalid:
+    ([], 'accounts/123', 'GET', False),
+    ([PERMISSION_ACCOUNT_123], 'accounts/1234', 'GET', False),
+    ([PERMISSION_ACCOUNT_123], 'accounts', 'GET', False),
+    ([PERMISSION_ACCOUNT_123, PERMISSION_ACCOUNT_234_GET], 'accounts/234/values', 'POST', False),
+    ([PERMISSION_ACCOUNT_234_GET, {'resource_prefix': 'accounts/234/values', 'methods': ['POST']}], 'accounts/234/bots', 'POST', False),
+])
+def test_CompiledPermissions_is_access_allowed(user_permissions, resource, method, expected):
+    assert expected == CompiledPermissions(user_permissions).is_access_allowed(resource, method)
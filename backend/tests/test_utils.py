@@ -0,0 +1,82 @@
+import sys, os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import pytest
+
+from utils import LRUCache, lttb_indices
+
+
+def test_LRUCache_evicts_least_recently_used():
+    cache = LRUCache(2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1  # 'a' is now more recently used than 'b'
+    cache.set('c', 3)
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+
+
+def test_LRUCache_invalidate():
+    cache = LRUCache(10)
+    for i in range(5):
+        cache.set(('acc', i), i * 10)
+    cache.invalidate(('acc', 0))
+    cache.invalidate_where(lambda k, v: v >= 30)
+    assert cache.get(('acc', 0)) is None
+    assert cache.get(('acc', 1)) == 10
+    assert cache.get(('acc', 2)) == 20
+    assert cache.get(('acc', 3)) is None
+    cache.clear()
+    assert cache.get(('acc', 1)) is None
+
+
+def test_LRUCache_stats():
+    cache = LRUCache(10)
+    assert cache.stats()['hit_rate'] is None
+    cache.set('a', 1)
+    cache.get('a')
+    cache.get('a')
+    cache.get('a')
+    cache.get('b')
+    assert cache.stats() == {'size': 1, 'maxsize': 10, 'hits': 3, 'misses': 1, 'hit_rate': 0.75}
+
+
+def test_LRUCache_sizeof():
+    cache = LRUCache(10, sizeof=len)
+    cache.set('a', 'xxxx')
+    cache.set('b', 'xxxx')
+    cache.set('a', 'xxx')  # replacing a value updates its size
+    assert cache.stats()['size'] == 7
+    cache.set('c', 'xxxxx')  # 'b' is evicted to stay within 10
+    assert cache.get('b') is None
+    assert cache.get('a') == 'xxx'
+    cache.set('d', 'x' * 11)  # larger than the cache itself, never kept
+    assert cache.get('d') is None
+    assert cache.stats() == {'size': 0, 'maxsize': 10, 'hits': 1, 'misses': 2, 'hit_rate': 1 / 3, 'entries': 0}
+
+
+def test_LRUCache_generation():
+    cache = LRUCache(10)
+    generation = cache.generation
+    cache.invalidate('b')  # value of 'a' was computed before an invalidation, it might be stale
+    cache.set('a', 1, generation)
+    assert cache.get('a') is None
+    cache.set('a', 1, cache.generation)
+    assert cache.get('a') == 1
+
+
+def test_lttb_indices():
+    xs = list(range(100))
+    ys = [0.0] * 100
+    ys[42] = 10.0  # spike must survive downsampling
+    indices = lttb_indices(xs, ys, 10)
+    assert len(indices) == 10
+    assert indices[0] == 0 and indices[-1] == 99
+    assert indices == sorted(indices)
+    assert 42 in indices
+
+
+def test_lttb_indices_nothing_to_downsample():
+    assert lttb_indices([1, 2, 3], [1, 2, 3], 3) == [0, 1, 2]
+    assert lttb_indices([1, 2, 3], [1, 2, 3], 10) == [0, 1, 2]
+    assert lttb_indices([], [], 10) == []
@@ -1,8 +1,11 @@
+from collections import OrderedDict
 from colors import color
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
 import json
 import logging
 import os
+import threading
 
 import requests
 
@@ -17,6 +20,171 @@ logging.addLevelName(logging.ERROR, color('ERR', bg='red'))
 log = logging.getLogger("{}.{}".format(__name__, "base"))
 
 
+class LRUCache(object):
+    """
+        Thread-safe, size-bounded LRU cache which keeps track of its hit rate. Unlike functools.lru_cache it allows
+        us to invalidate individual entries, which is needed when the cached records change (possibly in another
+        worker - see dbutils.db_listen()).
+
+        By default maxsize is the number of entries. If `sizeof` is given, it is called on each value and maxsize
+        is the upper limit for the sum of the sizes (for example in bytes) instead.
+
+        A value might be computed from records which change (and are invalidated) before it is stored. To avoid
+        caching such stale values, read `generation` before computing the value and pass it to set().
+    """
+    def __init__(self, maxsize, sizeof=None):
+        self.maxsize = maxsize
+        self.sizeof = sizeof
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._sizes = {}
+        self._total_size = 0
+        self._lock = threading.Lock()
+        self.generation = 0  # incremented whenever entries are invalidated
+
+    def _size(self):
+        return self._total_size if self.sizeof else len(self._data)
+
+    def _remove(self, key):
+        del self._data[key]
+        if self.sizeof:
+            self._total_size -= self._sizes.pop(key)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, generation=None):
+        """ If generation is given and the cache was invalidated since then, the value is not stored. """
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            if key in self._data:
+                self._remove(key)
+            self._data[key] = value
+            if self.sizeof:
+                self._sizes[key] = self.sizeof(value)
+                self._total_size += self._sizes[key]
+            while self._data and self._size() > self.maxsize:
+                self._remove(next(iter(self._data)))
+
+    def invalidate(self, key):
+        with self._lock:
+            self.generation += 1
+            if key in self._data:
+                self._remove(key)
+
+    def invalidate_where(self, predicate):
+        """ Removes all entries for which predicate(key, value) is true. """
+        with self._lock:
+            self.generation += 1
+            for key in [k for k, v in self._data.items() if predicate(k, v)]:
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._data.clear()
+            self._sizes.clear()
+            self._total_size = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            result = {
+                'size': self._size(),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else None,
+            }
+            if self.sizeof:
+                result['entries'] = len(self._data)
+            return result
+
+
+class ForkSafeThread(object):
+    """
+        Lazily started daemon thread, started anew after fork (gunicorn workers are forked, and threads do not
+        survive forking). If given, on_start() is called just before the thread is (re)started, so that the owner
+        can reset any state which was inherited from the parent process.
+    """
+    def __init__(self, target, name, on_start=None):
+        self.target = target
+        self.name = name
+        self.on_start = on_start
+        self.lock = threading.Lock()
+        self.thread = None
+        self.pid = None
+
+    def start(self):
+        with self.lock:
+            if self.thread is not None and self.thread.is_alive() and self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            if self.on_start is not None:
+                self.on_start()
+            self.thread = threading.Thread(target=self.target, name=self.name, daemon=True)
+            self.thread.start()
+
+
+class ForkSafeThreadPool(object):
+    """ Lazily created thread pool, recreated after fork (see ForkSafeThread). """
+    def __init__(self, max_workers, thread_name_prefix):
+        self.max_workers = max_workers
+        self.thread_name_prefix = thread_name_prefix
+        self.lock = threading.Lock()
+        self.executor = None
+        self.pid = None
+
+    def get(self):
+        with self.lock:
+            if self.executor is None or self.pid != os.getpid():
+                self.pid = os.getpid()
+                self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix=self.thread_name_prefix)
+            return self.executor
+
+
+def lttb_indices(xs, ys, max_points):
+    """
+        Largest-Triangle-Three-Buckets downsampling: returns the indices of (at most max_points) points which keep
+        the visual shape of the series. The first and the last point are always kept; the rest are split into
+        buckets, and from each bucket the point is selected which forms the largest triangle with the previously
+        selected point and with the average of the next bucket.
+    """
+    n = len(xs)
+    if max_points >= n or max_points < 3:
+        return list(range(n))
+
+    every = (n - 2) / (max_points - 2)
+    indices = [0]
+    a = 0
+    for i in range(max_points - 2):
+        avg_start = int((i + 1) * every) + 1
+        avg_end = min(int((i + 2) * every) + 1, n)
+        avg_x = sum(xs[avg_start:avg_end]) / (avg_end - avg_start)
+        avg_y = sum(ys[avg_start:avg_end]) / (avg_end - avg_start)
+
+        ax, ay = xs[a], ys[a]
+        max_area, next_a = -1.0, None
+        for j in range(int(i * every) + 1, int((i + 1) * every) + 1):
+            area = abs((ax - avg_x) * (ys[j] - ay) - (ax - xs[j]) * (avg_y - ay))
+            if area > max_area:
+                max_area, next_a = area, j
+        indices.append(next_a)
+        a = next_a
+    indices.append(n - 1)
+    return indices
+
+
 # 'full', 'none', 'basic' (default)
 TELEMETRY_LEVEL = os.environ.get('TELEMETRY', 'basic')
 
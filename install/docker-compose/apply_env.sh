@@ -17,6 +17,7 @@ echo "" > /grafolean/backend/.env
 [ -n "${MQTT_WS_PORT}" ] && echo "MQTT_WS_PORT=${MQTT_WS_PORT}" >> /grafolean/backend/.env
 [ -n "${GRAFOLEAN_CORS_DOMAINS}" ] && echo "GRAFOLEAN_CORS_DOMAINS=${GRAFOLEAN_CORS_DOMAINS}" >> /grafolean/backend/.env
 [ -n "${TELEMETRY}" ] && echo "TELEMETRY=${TELEMETRY}" >> /grafolean/backend/.env
+[ -n "${INGEST_MODE}" ] && echo "INGEST_MODE=${INGEST_MODE}" >> /grafolean/backend/.env
 
 # telemetry details can be hard-coded and are public:
 TELEMETRY_ACCOUNT="1990041850"